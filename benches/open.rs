@@ -0,0 +1,33 @@
+#![feature(test)]
+extern crate test;
+
+mod tempfile {
+    use maketemp::TempFile;
+    use test::Bencher;
+    
+    #[bench]
+    fn open(b:&mut Bencher) {
+        b.iter(|| {
+            let obj = match TempFile::open() {
+                Ok(v) => { v },
+                Err(msg) => { panic!("{}",msg); }
+            };
+            test::black_box(obj);
+        });
+    }
+}
+mod tempdir {
+    use maketemp::TempDir;
+    use test::Bencher;
+    
+    #[bench]
+    fn open(b:&mut Bencher) {
+        b.iter(|| {
+            let obj = match TempDir::open() {
+                Ok(v) => { v },
+                Err(msg) => { panic!("{}",msg); }
+            };
+            test::black_box(obj);
+        });
+    }
+}
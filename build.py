@@ -2,75 +2,693 @@
 # coding:utf-8
 
 import argparse
+import concurrent.futures
+import ctypes
+import ctypes.util
+import fcntl
+import fnmatch
+import gzip
 import hashlib
+import heapq
 import json
+import multiprocessing
 import os
+import platform
 import re
+import select
 import shutil
+import signal
+import socket
+import socketserver
+import stat
+import sqlite3
+import statistics
+import struct
 import subprocess
 import sys
+import tarfile
 import tempfile
 import textwrap
+import threading
 import time
+import traceback
 
 class CargoTestReport(object):
     
-    def __init__(self,records):
+    def __init__(self,records=[]):
         """
         新しいCargoTestReportインスタンスを生成します。
         
+        - レコードを保持せず、追加されるたびに統計情報を更新します
+        
         - `records` - テストレコード
         """
-        self.__records = records
+        self.__stats   = { "test_count":0,"passed":0,"failed":0,"allowed_fail":0,"ignored":0,"exec_time":0 }
+        self.__fails   = []
+        self.__results = {}
+        for t in records:
+            self.add(t)
+    
+    def add(self,t):
+        """
+        テストレコードを追加します。
+        
+        - テストの結果は、ターゲット（`target`。tests/<name>.rs など）とテスト名の組で区別します
+        
+        - `t` - テストレコード
+        """
+        event = t.get("event")
+        if t["type"] == "suite":
+            if event == "started":
+                self.__stats["test_count"] += t.get("test_count",0)
+            elif event in [ "ok","failed" ]:
+                self.__stats["passed"] += t.get("passed",0)
+                self.__stats["failed"] += t.get("failed",0)
+                self.__stats["allowed_fail"] += t.get("allowed_fail",0)
+                self.__stats["ignored"] += t.get("ignored",0)
+                self.__stats["exec_time"] += t.get("exec_time",0)
+        elif t["type"] == "test" and "name" in t:
+            if event in [ "ok","failed","ignored" ]:
+                self.__results[(t.get("target",""),t["name"])] = { "event":event,"exec_time":t.get("exec_time",0) }
+            if event == "failed":
+                self.__fails.append(t)
     
     def stats(self):
         """
         統計情報を返します。
         """
-        res = { "test_count":0,"passed":0,"failed":0,"allowed_fail":0,"ignored":0,"exec_time":0 }
-        for t in self.__records:
-            if t["type"] != "suite":
-                continue
-            if t["event"] == "started":
-                res["test_count"] += t["test_count"]
-            elif t["event"] == "ok":
-                res["passed"] += t["passed"]
-                res["failed"] += t["failed"]
-                res["allowed_fail"] += t["allowed_fail"]
-                res["ignored"] += t["ignored"]
-                res["exec_time"] += t["exec_time"]
-            else:
-                continue
-        return res
+        return dict(self.__stats)
     
     def fails(self):
         """
         失敗したテストの情報を返します。
         """
-        fails = []
-        for t in self.__records:
-            if t["type"] != "test":
+        return list(self.__fails)
+    
+    def results(self):
+        """
+        テストごとの結果（`event` と `exec_time`）を、ターゲットとテスト名の組をキーにして返します。
+        """
+        return dict(self.__results)
+    
+    def slowest(self,n):
+        """
+        実行時間の長いテストを、長い順に返します（キーはターゲットとテスト名の組）。
+        
+        - `n` - 件数
+        """
+        return heapq.nlargest(n,self.__results.items(),key=lambda r: r[1]["exec_time"])
+
+class CargoTestStream(object):
+    
+    def __init__(self,report,testreport_file):
+        """
+        新しいCargoTestStreamインスタンスを生成します。
+        
+        - `cargo test` の JSON 出力を1行ずつ受け取り、レポートの更新、ファイルへの書き出し、進捗の表示を行います
+        
+        - `report`          - 更新するレポート
+        - `testreport_file` - ユニットテストレポートの出力先ファイルパス
+        """
+        self.__report   = report
+        self.__lock     = threading.Lock()
+        self.__count    = 0
+        self.__finished = 0
+        self.__source   = { "target":"" }
+        
+        if not os.path.exists(os.path.dirname(testreport_file)):
+            os.makedirs(os.path.dirname(testreport_file))
+        self.__file = open(testreport_file,"w")
+        self.__file.write("[")
+    
+    def handler(self):
+        """
+        1つの `cargo test` プロセスの出力を1行ずつ受け取る関数を返します。
+        
+        - プロセスごとに、いま実行しているテストターゲットを覚えておくため、プロセスごとに作成します
+        """
+        source = { "target":"" }
+        return lambda line: self.feed(line,source)
+    
+    def feed(self,line,source=None):
+        """
+        `cargo test` の出力を1行受け取ります。
+        
+        - テストのレコード（`type` を持つ JSON オブジェクト）以外の行はそのまま出力します
+        - cargo の `Running <ターゲット> (<パス>)` / `Doc-tests <名前>` の行から、続くレコードのターゲットを判別します
+          - 判別するには、cargo の標準エラー出力も同じパイプで受け取ります
+        
+        - `line`   - 出力（バイト列）
+        - `source` - 出力元のプロセスの状態。None の場合は、すべての呼び出しで共有する状態を使います
+        """
+        if source is None:
+            source = self.__source
+        
+        text = line.decode("utf-8","replace").rstrip("\r\n")
+        try:
+            t = json.loads(text)
+        except ValueError:
+            t = None
+        
+        if not isinstance(t,dict) or not "type" in t:
+            m = re.match(r"^\s*Running (.+?)(?: \(.*\))?$",text) or re.match(r"^\s*(Doc-tests \S+)$",text)
+            if m is not None:
+                # 古い cargo はビルドしたファイルのパスを出力するので、ハッシュを取り除く
+                source["target"] = re.sub(r"-[0-9a-f]{16}$","",m[1])
+            print(text)
+            return
+        
+        t["target"] = source["target"]
+        with self.__lock:
+            self.__file.write(("\n" if self.__count == 0 else ",\n") + json.dumps(t))
+            self.__count += 1
+            self.__report.add(t)
+            
+            if t["type"] != "test" or not "name" in t:
+                return
+            if not t.get("event") in [ "ok","failed","ignored" ]:
+                return
+            self.__finished += 1
+            
+            total = self.__report.stats()["test_count"]
+            if t["event"] == "ok":
+                print("[%d/%d] ok     %s (%.3f s)" % (self.__finished,total,t["name"],t.get("exec_time",0)))
+            elif t["event"] == "ignored":
+                print("[%d/%d] ignore %s" % (self.__finished,total,t["name"]))
+            else:
+                print("[%d/%d] FAIL   %s (%.3f s)" % (self.__finished,total,t["name"],t.get("exec_time",0)))
+                if "stdout" in t:
+                    print(re.sub(r"(?m)^","    ",t["stdout"].rstrip("\n")))
+    
+    def close(self):
+        """
+        レポートのファイルを閉じます。
+        """
+        self.__file.write("\n]\n")
+        self.__file.close()
+
+def load_cargo_test_report(path):
+    """
+    ユニットテストレポートをロードします。
+    
+    - 1行ずつ読み込むため、レコード全体をメモリーに展開しません
+    
+    - `path` - パス
+    """
+    ctr = CargoTestReport()
+    with open(path,"r") as f:
+        for l in f:
+            l = l.strip().lstrip("[").rstrip("],").strip()
+            if l == "":
+                continue
+            ctr.add(json.loads(l))
+    return ctr
+
+class CargoBenchReport(object):
+    
+    # criterion の時間の単位（ns に換算する係数）
+    UNITS = { "ps":0.001,"ns":1,"µs":1000,"us":1000,"ms":1000000,"s":1000000000 }
+    
+    def __init__(self,results={}):
+        """
+        新しいCargoBenchReportインスタンスを生成します。
+        
+        - `cargo bench` の出力（libtest の JSON、または criterion のテキスト）を1行ずつ受け取り、ベンチマークごとの ns/iter を集計します
+        
+        - `results` - ベンチマークごとの結果（`ns` と `deviation`）
+        """
+        self.__results = dict(results)
+        self.__name    = None
+    
+    def feed(self,line):
+        """
+        `cargo bench` の出力を1行受け取ります。
+        
+        - 結果の行は要約して出力し、それ以外の行はそのまま出力します
+        
+        - `line` - 出力（バイト列）
+        """
+        text = line.decode("utf-8","replace").rstrip("\r\n")
+        try:
+            t = json.loads(text)
+        except ValueError:
+            t = None
+        
+        if isinstance(t,dict):
+            if t.get("type") == "bench":
+                self.add(t["name"],t["median"],t["deviation"])
+            return
+        
+        # criterion: `<name>  time:   [<low> <unit> <estimate> <unit> <high> <unit>]`
+        # - 名前が長い場合は、名前と時間が別の行に出力される
+        m = re.match(r"^(\S.*?)?\s+time:\s+\[([\d.]+) (\S+) ([\d.]+) (\S+) ([\d.]+) (\S+)\]",text)
+        if m is None:
+            if re.match(r"^\S",text) and not re.match(r"^(Benchmarking|Found|Gnuplot|WARNING) ",text):
+                self.__name = text.strip()
+            print(text)
+            return
+        
+        name = m[1].strip() if m[1] is not None else self.__name
+        low  = float(m[2]) * CargoBenchReport.UNITS[m[3]]
+        ns   = float(m[4]) * CargoBenchReport.UNITS[m[5]]
+        high = float(m[6]) * CargoBenchReport.UNITS[m[7]]
+        self.add(name,ns,high - low)
+    
+    def add(self,name,ns,deviation):
+        """
+        ベンチマークの結果を追加します。
+        
+        - `name`      - ベンチマーク名
+        - `ns`        - 1回あたりの実行時間（ns）
+        - `deviation` - ばらつき（ns）
+        """
+        self.__results[name] = { "ns":ns,"deviation":deviation }
+        print("bench  %-40s %14.1f ns/iter (+/- %.1f)" % (name,ns,deviation))
+    
+    def results(self):
+        """
+        ベンチマークごとの結果（`ns` と `deviation`）を返します。
+        """
+        return dict(self.__results)
+    
+    def compare(self,baseline,threshold,patterns):
+        """
+        基準の結果と比べて threshold % 以上遅くなったベンチマークを返します。
+        
+        - `baseline`  - 基準の結果
+        - `threshold` - しきい値（%）
+        - `patterns`  - 対象にするベンチマーク名のパターン（fnmatch 形式）
+        """
+        res = []
+        for name,r in self.__results.items():
+            if not name in baseline or not any(fnmatch.fnmatchcase(name,p) for p in patterns):
+                continue
+            base  = baseline[name]["ns"]
+            ratio = (r["ns"] - base) / base * 100 if 0 < base else 0
+            if threshold < ratio:
+                res.append((name,base,r["ns"],ratio))
+        return sorted(res,key=lambda r: r[3],reverse=True)
+
+def save_bench_report(path,report,commit):
+    """
+    ベンチマークの結果を保存します。
+    
+    - `path`   - パス
+    - `report` - ベンチマークの結果
+    - `commit` - コミットID。不明な場合は None
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    
+    tmp = path + ".tmp"
+    with open(tmp,"w") as f:
+        json.dump({ "commit":commit,"created_at":time.time(),"results":report.results() },f,indent=2,sort_keys=True)
+    os.replace(tmp,path)
+
+def load_bench_report(path):
+    """
+    保存したベンチマークの結果をロードします。ファイルがない場合は None を返します。
+    
+    - `path` - パス
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path,"r") as f:
+        return CargoBenchReport(json.load(f)["results"])
+
+# フィーチャーとテストの絞り込みが同じ、直近の実行
+RUNS_OF_CONFIG = "SELECT id FROM runs WHERE features = ? AND test_filter = ? ORDER BY id DESC LIMIT ?"
+
+class TestHistory(object):
+    
+    def __init__(self,path):
+        """
+        新しいTestHistoryインスタンスを生成します。
+        
+        - テストの実行結果を SQLite に追記し、遅いテスト・遅くなったテスト・不安定なテストを調べられるようにします
+        - 実行はフィーチャーと実行したテストの絞り込み（空文字列はすべてのテスト）で区別し、同じものどうしだけを比べます
+        
+        - `path` - データベースファイルのパス
+        """
+        self.__path = path
+    
+    def record(self,report,commit,features,test_filter=""):
+        """
+        テストの実行結果を記録します。
+        
+        - テストを1つも実行していない場合（ビルドに失敗した場合など）は記録しません
+        
+        - `report`      - テストレポート
+        - `commit`      - コミットID。不明な場合は None
+        - `features`    - フィーチャー
+        - `test_filter` - 実行したテストの絞り込み。すべてのテストを実行した場合は空文字列
+        """
+        if len(report.results()) == 0:
+            return
+        
+        con = self.__connect()
+        try:
+            with con:
+                cur = con.execute(
+                    "INSERT INTO runs (started_at,commit_id,features,host,test_filter) VALUES (?,?,?,?,?)",
+                    (time.time(),commit,json.dumps(sorted(features)),platform.node(),test_filter)
+                )
+                con.executemany(
+                    "INSERT INTO results (run_id,target,name,outcome,duration) VALUES (?,?,?,?,?)",
+                    [ (cur.lastrowid,target,name,r["event"],r["exec_time"]) for (target,name),r in report.results().items() ]
+                )
+        finally:
+            con.close()
+    
+    def latest_features(self):
+        """
+        最後に記録した実行のフィーチャーを返します。記録がない場合は空のリストを返します。
+        """
+        con = self.__connect()
+        try:
+            row = con.execute("SELECT features FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+        finally:
+            con.close()
+        return [] if row is None else json.loads(row[0])
+    
+    def slowest(self,limit,window,features=[],test_filter=""):
+        """
+        直近の実行で平均実行時間が長いテストを返します。
+        
+        - `limit`       - 件数
+        - `window`      - 対象にする直近の実行の数
+        - `features`    - 対象にする実行のフィーチャー
+        - `test_filter` - 対象にする実行のテストの絞り込み
+        """
+        con = self.__connect()
+        try:
+            return con.execute(
+                "SELECT target,name,AVG(duration),MAX(duration),COUNT(*) FROM results"
+                " WHERE run_id IN (" + RUNS_OF_CONFIG + ") AND outcome = 'ok'"
+                " GROUP BY target,name ORDER BY AVG(duration) DESC LIMIT ?",
+                (json.dumps(sorted(features)),test_filter,window,limit)
+            ).fetchall()
+        finally:
+            con.close()
+    
+    def regressions(self,threshold,window,features=[],test_filter=""):
+        """
+        最新の実行時間が、それ以前の実行時間の中央値より threshold % 以上長くなったテストを返します。
+        
+        - `threshold`   - しきい値（%）
+        - `window`      - 中央値を求める、直近の実行の数
+        - `features`    - 対象にする実行のフィーチャー
+        - `test_filter` - 対象にする実行のテストの絞り込み
+        """
+        res = []
+        for (target,name),durations in self.__durations(window + 1,features,test_filter).items():
+            if len(durations) < 2:
                 continue
-            if t["event"] != "failed":
+            latest = durations[-1]
+            base   = statistics.median(durations[:-1])
+            # 計測誤差に埋もれるほど短いテストは対象にしない
+            if base < 0.001:
                 continue
-            fails.append(t)
-        return fails
+            ratio = (latest - base) / base * 100
+            if threshold < ratio:
+                res.append((target,name,base,latest,ratio))
+        return sorted(res,key=lambda r: r[4],reverse=True)
+    
+    def flaky(self,window,features=[],test_filter=""):
+        """
+        直近の実行で、成功と失敗の両方があるテストを返します。
+        
+        - `window`      - 対象にする直近の実行の数
+        - `features`    - 対象にする実行のフィーチャー
+        - `test_filter` - 対象にする実行のテストの絞り込み
+        """
+        con = self.__connect()
+        try:
+            return con.execute(
+                "SELECT target,name,SUM(outcome = 'ok'),SUM(outcome = 'failed'),COUNT(DISTINCT commit_id) FROM results"
+                " JOIN runs ON runs.id = results.run_id"
+                " WHERE run_id IN (" + RUNS_OF_CONFIG + ")"
+                " GROUP BY target,name HAVING SUM(outcome = 'ok') > 0 AND SUM(outcome = 'failed') > 0"
+                " ORDER BY SUM(outcome = 'failed') DESC",
+                (json.dumps(sorted(features)),test_filter,window)
+            ).fetchall()
+        finally:
+            con.close()
+    
+    def __durations(self,window,features,test_filter):
+        con = self.__connect()
+        try:
+            rows = con.execute(
+                "SELECT target,name,duration FROM results"
+                " WHERE run_id IN (" + RUNS_OF_CONFIG + ") AND outcome = 'ok'"
+                " ORDER BY run_id",
+                (json.dumps(sorted(features)),test_filter,window)
+            ).fetchall()
+        finally:
+            con.close()
+        
+        res = {}
+        for target,name,duration in rows:
+            res.setdefault((target,name),[]).append(duration)
+        return res
+    
+    def __connect(self):
+        d = os.path.dirname(self.__path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        
+        con = sqlite3.connect(self.__path,timeout=30)
+        con.executescript(textwrap.dedent("""\
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                commit_id TEXT,
+                features TEXT NOT NULL,
+                host TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                run_id INTEGER NOT NULL REFERENCES runs (id),
+                name TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                duration REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS results_run_id ON results (run_id);
+            CREATE INDEX IF NOT EXISTS results_name ON results (name,run_id);
+        """))
+        # 絞り込みを記録する前のデータベース（すべてのテストを実行したものとみなす）
+        if not "test_filter" in [ r[1] for r in con.execute("PRAGMA table_info(runs)") ]:
+            with con:
+                con.execute("ALTER TABLE runs ADD COLUMN test_filter TEXT NOT NULL DEFAULT ''")
+        # ターゲットを記録する前のデータベース（ターゲットは不明として空文字列）
+        if not "target" in [ r[1] for r in con.execute("PRAGMA table_info(results)") ]:
+            with con:
+                con.execute("ALTER TABLE results ADD COLUMN target TEXT NOT NULL DEFAULT ''")
+        return con
+
+class OpHistory(object):
+    
+    def __init__(self,path):
+        """
+        新しいOpHistoryインスタンスを生成します。
+        
+        - 操作ごとの実行時間を SQLite に追記し、次の実行時間を見積もれるようにします
+        
+        - `path` - データベースファイルのパス
+        """
+        self.__path = path
+    
+    def record(self,records,keys,commit):
+        """
+        操作の実行時間を記録します。
+        
+        - 失敗した操作とキャンセルされた操作は記録しません
+        
+        - `records` - トレースの記録
+        - `keys`    - 操作の id と op_key() の辞書
+        - `commit`  - コミットID。不明な場合は None
+        """
+        rows = [
+            (keys[r["id"]],r["id"],r["op"],r["status"],r["end"] - r["start"])
+            for r in records if r["status"] in [ "ok","restored","skipped" ]
+        ]
+        if len(rows) == 0:
+            return
+        
+        con = self.__connect()
+        try:
+            with con:
+                cur = con.execute(
+                    "INSERT INTO runs (started_at,commit_id,host) VALUES (?,?,?)",
+                    (time.time(),commit,platform.node())
+                )
+                con.executemany(
+                    "INSERT INTO ops (run_id,key,id,op,status,duration) VALUES (?,?,?,?,?,?)",
+                    [ (cur.lastrowid,) + r for r in rows ]
+                )
+        finally:
+            con.close()
+    
+    def medians(self,keys,window):
+        """
+        操作ごとに、直近の実行時間の中央値を返します。記録がない操作は含みません。
+        
+        - `keys`   - 操作の op_key() と結果（ok / restored / skipped）の組のリスト
+        - `window` - 中央値を求める、直近の実行の数
+        """
+        if not os.path.exists(self.__path):
+            return {}
+        
+        con = self.__connect()
+        try:
+            res = {}
+            for key,status in keys:
+                rows = con.execute(
+                    "SELECT duration FROM ops WHERE key = ? AND status = ? ORDER BY rowid DESC LIMIT ?",
+                    (key,status,window)
+                ).fetchall()
+                if 0 < len(rows):
+                    res[(key,status)] = statistics.median([ r[0] for r in rows ])
+            return res
+        finally:
+            con.close()
+    
+    def __connect(self):
+        d = os.path.dirname(self.__path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        
+        con = sqlite3.connect(self.__path,timeout=30)
+        con.executescript(textwrap.dedent("""\
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                commit_id TEXT,
+                host TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS ops (
+                run_id INTEGER NOT NULL REFERENCES runs (id),
+                key TEXT NOT NULL,
+                id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                status TEXT NOT NULL,
+                duration REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ops_key ON ops (key,status);
+        """))
+        return con
+
+# インストールされていることを確認した rustup のコンポーネント
+# - 常駐サーバーでは、確認結果を使い回す
+INSTALLED_COMPONENTS = set()
+
+def has_rust_component(project_dir,name):
+    """
+    rustup のコンポーネントがインストールされているかどうかを返します。
+    
+    - インストールされていた場合は結果を覚えておき、次からは rustup を実行しません
+    
+    - `project_dir` - プロジェクトのディレクトリーパス
+    - `name`        - コンポーネント名
+    """
+    if (project_dir,name) in INSTALLED_COMPONENTS:
+        return True
+    
+    st = run_process([
+        "rustup","component","list","--installed"
+    ],cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr)
+    if st.returncode != 0:
+        raise Exception("unexpected error occurred. stop. (%d)" % (st.returncode))
+    if re.search(r"(?m)^%s-.*$" % (re.escape(name)),st.stdout.decode("utf-8")) is None:
+        return False
+    
+    INSTALLED_COMPONENTS.add((project_dir,name))
+    return True
+
+# プロジェクトのディレクトリーごとの `rustc -vV` の出力
+TOOLCHAIN_VERSIONS = {}
+
+def rust_toolchain_version(project_dir):
+    """
+    プロジェクトで使われる rustc のバージョン情報（`rustc -vV` の出力）を返します。
+    
+    - 一度調べたプロジェクトは、結果を使い回します
+    
+    - `project_dir` - プロジェクトのディレクトリーパス
+    """
+    if project_dir in TOOLCHAIN_VERSIONS:
+        return TOOLCHAIN_VERSIONS[project_dir]
+    
+    st = run_process([ "rustc","-vV" ],cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr)
+    if st.returncode != 0:
+        raise Exception("error occurred. stop. (%d)" % (st.returncode))
+    TOOLCHAIN_VERSIONS[project_dir] = st.stdout.decode("utf-8").strip()
+    return TOOLCHAIN_VERSIONS[project_dir]
+
+def llvm_tools_dir(project_dir):
+    """
+    llvm-tools-preview のツールがあるディレクトリーのパスを返します。
+    
+    - `project_dir` - プロジェクトのディレクトリーパス
+    """
+    st = run_process([ "rustc","--print","sysroot" ],cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr)
+    if st.returncode != 0:
+        raise Exception("error occurred. stop. (%d)" % (st.returncode))
+    sysroot = st.stdout.decode("utf-8").strip()
+    
+    st = run_process([ "rustc","-vV" ],cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr)
+    if st.returncode != 0:
+        raise Exception("error occurred. stop. (%d)" % (st.returncode))
+    m = re.search(r"(?m)^host: (.*)$",st.stdout.decode("utf-8"))
+    if m is None:
+        raise Exception("unexpected stdout. (%s)" % (st.stdout.decode("utf-8")))
+    
+    return os.path.join(sysroot,"lib","rustlib",m[1].strip(),"bin")
+
+def git_commit(dir):
+    """
+    現在のコミットIDを返します。git リポジトリーでない場合は None を返します。
+    
+    - `dir` - ディレクトリーのパス
+    """
+    try:
+        st = run_process([ "git","rev-parse","HEAD" ],cwd=dir,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    if st.returncode != 0:
+        return None
+    return st.stdout.decode("utf-8").strip()
 
 class VirtualBoxMachine(object):
     
-    def __init__(self,name):
-        running = False
-        for vm in self.__running_vms():
-            if vm == name:
-                running = True
+    def __init__(self,name,vboxmanage="VBoxManage",running_vms=None,boot_timeout=300):
+        """
+        新しいVirtualBoxMachineインスタンスを生成します。
         
-        if not running:
-            self.__launch(name)
+        - 仮想マシンが起動していない場合は起動し、コマンドを実行できるようになるまで待ちます
+        
+        - `name`         - 仮想マシンの名前
+        - `vboxmanage`   - VBoxManage のパス
+        - `running_vms`  - 起動中の仮想マシンの名前のリスト。None の場合は VBoxManage で調べます
+        - `boot_timeout` - 起動を待つ最大の秒数
+        """
+        self.__vbm = vboxmanage
+        
+        if running_vms is None:
+            running_vms = VirtualBoxMachine.running_vms(vboxmanage)
+        
+        if not name in running_vms:
+            self.__launch(name,boot_timeout)
         
         self.__name = name
     
+    def name(self):
+        """
+        仮想マシンの名前を返します。
+        """
+        return self.__name
+    
     def close(self):
-        st = subprocess.run([ "VBoxManage","controlvm",self.__name,"poweroff" ],stdout=sys.stdout,stderr=sys.stderr)
+        st = run_process([ self.__vbm,"controlvm",self.__name,"poweroff" ],stdout=sys.stdout,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
     
@@ -79,21 +697,29 @@ class VirtualBoxMachine(object):
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
     
+    def shell(self,script):
+        """
+        仮想マシンでシェルスクリプトを実行し、終了コードを返します。
+        
+        - `script` - シェルスクリプト
+        """
+        return self.__command(self.__name,[ "/bin/sh","-c",script ]).returncode
+    
     def mkdir(self,guestdir):
-        a = [ "VBoxManage","guestcontrol",self.__name,"mkdir","--username","root","--password","sukima",guestdir ]
+        a = [ self.__vbm,"guestcontrol",self.__name,"mkdir","--username","root","--password","sukima",guestdir ]
         
-        st = subprocess.run(a,stdout=sys.stdout,stderr=sys.stderr)
+        st = run_process(a,stdout=sys.stdout,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
     
     def mktemp(self,is_directory):
-        a = [ "VBoxManage","guestcontrol",self.__name,"mktemp","--username","root","--password","sukima" ]
+        a = [ self.__vbm,"guestcontrol",self.__name,"mktemp","--username","root","--password","sukima" ]
         if is_directory:
             a.append("--directory")
             a.extend([ "--tmpdir","/tmp" ])
         a.append("tmp-XXX")
         
-        st = subprocess.run(a,stdout=subprocess.PIPE,stderr=sys.stderr)
+        st = run_process(a,stdout=subprocess.PIPE,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
         
@@ -103,32 +729,44 @@ class VirtualBoxMachine(object):
         raise Exception("unexpected stdout. (%s)" % (so))
     
     def copyfrom(self,guestdir,hostdir):
-        a = [ "VBoxManage","guestcontrol",self.__name,"copyfrom","--username","root","--password","sukima","--recursive","--target-directory",hostdir,guestdir ]
+        a = [ self.__vbm,"guestcontrol",self.__name,"copyfrom","--username","root","--password","sukima","--recursive","--target-directory",hostdir,guestdir ]
         
-        st = subprocess.run(a,stdout=sys.stdout,stderr=sys.stderr)
+        st = run_process(a,stdout=sys.stdout,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
     
     def copyto(self,hostdir,guestdir):
-        a = [ "VBoxManage","guestcontrol",self.__name,"copyto","--username","root","--password","sukima","--recursive",hostdir,guestdir ]
+        a = [ self.__vbm,"guestcontrol",self.__name,"copyto","--username","root","--password","sukima","--recursive",hostdir,guestdir ]
         
-        st = subprocess.run(a,stdout=sys.stdout,stderr=sys.stderr)
+        st = run_process(a,stdout=sys.stdout,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
     
-    def __launch(self,name):
-        st = subprocess.run([ "VBoxManage","startvm",name ],stdout=sys.stdout,stderr=sys.stderr)
+    def __launch(self,name,boot_timeout):
+        st = run_process([ self.__vbm,"startvm",name ],stdout=sys.stdout,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
         
+        # ゲストのサービスが応答するまで、間隔を延ばしながら待つ
+        deadline = time.time() + boot_timeout
+        delay    = 0.25
         while True:
-            st = self.__command(name,[ "/bin/echo","hello" ])
+            st = self.__command(name,[ "/bin/echo","hello" ],subprocess.DEVNULL)
             if st.returncode == 0:
                 break
-            time.sleep(1)
+            if deadline < time.time() + delay:
+                raise Exception("virtual machine is not ready. stop. (%s: %d s)" % (name,boot_timeout))
+            time.sleep(delay)
+            delay = min(delay * 2,5)
     
-    def __running_vms(self):
-        st = subprocess.run([ "VBoxManage","list","runningvms" ],stdout=subprocess.PIPE,stderr=sys.stderr)
+    @staticmethod
+    def running_vms(vboxmanage):
+        """
+        起動中の仮想マシンの名前のリストを返します。
+        
+        - `vboxmanage` - VBoxManage のパス
+        """
+        st = run_process([ vboxmanage,"list","runningvms" ],stdout=subprocess.PIPE,stderr=sys.stderr)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
         
@@ -137,13 +775,69 @@ class VirtualBoxMachine(object):
             vms.append(m[1])
         return vms
     
-    def __command(self,name,args):
-        a = [ "VBoxManage","guestcontrol",name,"run","--username","root","--password","sukima","--exe" ]
+    def __command(self,name,args,stdout=None):
+        args = list(args)
+        
+        a = [ self.__vbm,"guestcontrol",name,"run","--username","root","--password","sukima","--exe" ]
         a.append(args.pop(0))
         a.extend([ "--","." ])
         a.extend(args)
         
-        return subprocess.run(a,stdout=sys.stdout,stderr=sys.stderr)
+        return run_process(a,stdout=stdout,stderr=sys.stderr)
+
+class VirtualBoxRegistry(object):
+    
+    def __init__(self,vboxmanage):
+        """
+        新しいVirtualBoxRegistryインスタンスを生成します。
+        
+        - build.py の実行中、仮想マシンのセッションを使い回します
+        - 起動中の仮想マシンの一覧は、最初に一度だけ調べます
+        
+        - `vboxmanage` - VBoxManage のパス
+        """
+        self.__vbm      = vboxmanage
+        self.__lock     = threading.Lock()
+        self.__locks    = {}
+        self.__machines = {}
+        self.__running  = None
+    
+    def open(self,name,boot_timeout=300):
+        """
+        仮想マシンを返します。起動していない場合は起動します。
+        
+        - `name`         - 仮想マシンの名前
+        - `boot_timeout` - 起動を待つ最大の秒数
+        """
+        with self.__lock:
+            lock = self.__locks.setdefault(name,threading.Lock())
+        
+        # 仮想マシンごとにロックし、別の仮想マシンの起動は並行して待てるようにする
+        with lock:
+            if name in self.__machines:
+                return self.__machines[name]
+            
+            with self.__lock:
+                if self.__running is None:
+                    self.__running = VirtualBoxMachine.running_vms(self.__vbm)
+                running = list(self.__running)
+            
+            vbm = VirtualBoxMachine(name,self.__vbm,running,boot_timeout)
+            self.__machines[name] = vbm
+            return vbm
+    
+    def close(self,name):
+        """
+        仮想マシンを終了します。
+        
+        - `name` - 仮想マシンの名前
+        """
+        vbm = self.open(name)
+        vbm.close()
+        with self.__lock:
+            del self.__machines[name]
+            if self.__running is not None and name in self.__running:
+                self.__running.remove(name)
 
 class Cargo(object):
     
@@ -158,7 +852,7 @@ class Cargo(object):
         """
         args = [ self.__cargo_file,"build","--release" ]
         env = os.environ
-        st = subprocess.run(args,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
+        st = run_process(args,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
     
@@ -175,102 +869,122 @@ class Cargo(object):
             cargs.extend(args)
         
         env = os.environ
-        st = subprocess.run(cargs,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
+        st = run_process(cargs,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
-
-    def test(self,project_dir,features,testreport_file,covreport_dir,threads):
+    
+    def test(self,project_dir,features,testreport_file,covreport_dir,threads,shards=1,history=None,cov_formats=[ "html","cobertura" ],changed=None,target_dir=None):
         """
         ユニットテストを実行します。
         
         - covreport_dir を指定すると、カバレッジ測定も合わせて行います
+        - shards を指定すると、テストを前回の実行時間で均等に分け、別々のプロセスで並行実行します
+        - changed を指定すると、前回失敗したテストを先に実行し（失敗した場合はそこで止めます）、
+          続けて変更されたファイルの影響を受けるテストターゲットだけを実行します（カバレッジ測定する場合は、残りのテストをすべて実行します）
+        - target_dir を指定すると、ビルドの出力とカバレッジのプロファイルをそのディレクトリーに分けます（別のフィーチャーのテストと並行実行するため）
         
         - `project_dir`     - プロジェクトのディレクトリーパス
         - `features`        - フィーチャー
         - `testreport_file` - ユニットテストレポートの出力先ファイルパス
         - `covreport_dir`   - カバレッジレポートの出力先ディレクトリーパス。不要の場合は None を指定可能
         - `threads`         - テストを並行実行する数
+        - `shards`          - テストを分けて実行するプロセスの数
+        - `history`         - 実行結果の記録先。不要の場合は None を指定可能
+        - `cov_formats`     - カバレッジレポートの形式（html / cobertura / lcov）
+        - `changed`         - 前回成功したときから変更されたファイル（project_dir からの相対パス）。すべて実行する場合は None
+        - `target_dir`      - ビルドの出力先ディレクトリーパス（CARGO_TARGET_DIR）。None の場合は既定の出力先
         """
-        # llvm-tools-preview がインストールされているかどうかをチェック
-        # - カバレッジ測定に必要
-        st = subprocess.run([
-            "rustup","component","list","--installed"
-        ],cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr)
-        if st.returncode != 0:
-            raise Exception("unexpected error occurred. stop. (%d)" % (st.returncode))
-        if re.search(r"(?m)^llvm-tools-preview-.*$",st.stdout.decode("utf-8")) is None:
-            raise Exception("please install `llvm-tools-preview` component by `rustup component add`.")
-        
-        # テストレポートより新しい更新がない場合はスキップする
-        if os.path.exists(testreport_file):
-            t = cargo_project_last_modification_timestamp(project_dir)
-            if t < os.stat(testreport_file).st_mtime:
-                print("[SKIP] cargo test (%s: no modified)" % (project_dir))
-                return
+        if covreport_dir is not None:
+            # llvm-tools-preview がインストールされているかどうかをチェック
+            # - カバレッジ測定に必要
+            if not has_rust_component(project_dir,"llvm-tools-preview"):
+                raise Exception("please install `llvm-tools-preview` component by `rustup component add`.")
         
-        args = [ self.__cargo_file,"test" ]
+        cargs = [ self.__cargo_file,"test" ]
         if 0 < len(features):
-            args.append("--features")
-            args.extend(features)
-        args.extend([ "--","-Z","unstable-options","--format","json","--report-time" ])
+            cargs.extend([ "--features",",".join(features) ])
+        targs = [ "-Z","unstable-options","--format","json","--report-time" ]
         if threads is not None:
-            args.append("--test-threads=%d" % (threads))
+            targs.append("--test-threads=%d" % (threads))
+        
+        # シャードの振り分けに使うため、前回の実行時間と失敗したテストを読んでおく
+        timings = {}
+        failed  = []
+        if os.path.exists(testreport_file):
+            prev = load_cargo_test_report(testreport_file)
+            # シャードはテスト名で振り分ける（すべてのターゲットで同じ名前のテストを実行する）ため、名前ごとに合計する
+            for (target,name),r in prev.results().items():
+                timings[name] = timings.get(name,0) + r["exec_time"]
+            failed = sorted(set([ t["name"] for t in prev.fails() ]))
+        if changed is None:
+            failed = []
         
-        profdir = os.path.join(project_dir,"tmp")
+        profdir = os.path.join(project_dir,"tmp") if target_dir is None else os.path.join(target_dir,"profraw")
         utstts  = None
         
-        env = os.environ
+        env = dict(os.environ)
         env["RUSTC_BOOTSTRAP"] = "1"
-        env["RUSTFLAGS"] = "-Zinstrument-coverage"
-        env["LLVM_PROFILE_FILE"] = os.path.join(profdir,"cov-%p-%m.profraw")
+        if target_dir is not None:
+            env["CARGO_TARGET_DIR"] = target_dir
+        if covreport_dir is not None:
+            env["RUSTFLAGS"] = "-Cinstrument-coverage"
+            env["LLVM_PROFILE_FILE"] = os.path.join(profdir,"cov-%p-%m.profraw")
+        
+        # 履歴で同じ絞り込みの実行どうしを比べるため（すべてのテストを実行した場合は空文字列）
+        test_filter = "" if len(failed) == 0 else "previously-failed"
         
+        ctr = CargoTestReport()
         try:
-            if not os.path.exists(os.path.dirname(testreport_file)):
-                os.makedirs(os.path.dirname(testreport_file))
-            
-            with open(testreport_file,"w+b") as f:
-                utstts = subprocess.run(args,cwd=project_dir,stdout=f,stderr=sys.stderr,env=env)
-            # テストレポートをjson形式に正す
-            with open(testreport_file,"r+") as f:
-                data = f.read()
-                
-                data = re.sub(r"(?m)\}$","},",data)
-                data = re.sub(r",[\s]*\Z","",data)
+            ts = CargoTestStream(ctr,testreport_file)
+            try:
+                if 0 < len(failed):
+                    # 前回失敗したテストが、まだ失敗するかどうかを先に知らせる
+                    print("re-running %d previously failed tests first." % (len(failed)))
+                    utstts = self.__test_failed(project_dir,cargs,targs,env,failed,ts)
                 
-                f.seek(0)
-                f.write("[")
-                f.write(data)
-                f.write("]")
-            
-            # カバレッジレポートを作成
-            # - HTML形式
-            # - Cobertura形式
-            st = subprocess.run([
-                "grcov",profdir,"-s",project_dir,"--binary-path",os.path.join(project_dir,"target/debug/"),"-t","html","--branch","--ignore-not-existing","-o",covreport_dir
-            ],cwd=project_dir,stdout=sys.stdout,stderr=sys.stderr,env=env)
-            st = subprocess.run([
-                "grcov",profdir,"-s",project_dir,"--binary-path",os.path.join(project_dir,"target/debug/"),"-t","cobertura","--branch","--ignore-not-existing","-o",os.path.join(covreport_dir,"cobertura.xml")
-            ],cwd=project_dir,stdout=sys.stdout,stderr=sys.stderr,env=env)
+                if utstts is None or utstts.returncode == 0:
+                    targets = None
+                    if changed is not None and covreport_dir is None:
+                        targets = affected_test_targets(project_dir,changed,features,self.required_features(project_dir))
+                    if targets is None:
+                        test_filter = ""
+                    elif 0 < len(targets):
+                        test_filter = " ".join(targets)
+                    
+                    skips = []
+                    if 0 < len(failed):
+                        skips.append("--exact")
+                        for name in failed:
+                            skips.extend([ "--skip",name ])
+                    
+                    if targets is None and 1 < shards:
+                        utstts = self.__test_sharded(project_dir,cargs,targs,env,shards,timings,ts,failed)
+                    elif targets is None:
+                        utstts = run_process(cargs + [ "--" ] + targs + skips,cwd=project_dir,stderr=subprocess.STDOUT,env=env,stdout_handler=ts.handler())
+                    elif 0 < len(targets):
+                        print("running test targets affected by %d changed files: %s" % (len(changed)," ".join(targets)))
+                        utstts = run_process(cargs + targets + [ "--" ] + targs + skips,cwd=project_dir,stderr=subprocess.STDOUT,env=env,stdout_handler=ts.handler())
+                    else:
+                        print("no test targets affected by %d changed files." % (len(changed)))
+                        if utstts is None:
+                            utstts = subprocess.CompletedProcess(cargs,0)
+            finally:
+                ts.close()
+            
+            if covreport_dir is not None:
+                self.__coverage(project_dir,cargs,env,profdir,covreport_dir,cov_formats)
         finally:
             if os.path.exists(profdir):
                 shutil.rmtree(profdir)
-            
-            # 2021.11.30 yocotch
-            # 後続の処理で os.environ を参照すると、含まれたままになってしまうため、ここで削除する
-            del env["RUSTC_BOOTSTRAP"]
-            del env["RUSTFLAGS"]
-            del env["LLVM_PROFILE_FILE"]
         
-        titems = []
-        with open(testreport_file,"rb") as f:
-            titems = json.load(f)
-        ctr = CargoTestReport(titems)
+        if history is not None:
+            history.record(ctr,git_commit(project_dir),features,test_filter)
         
         if utstts.returncode != 0:
             fails = []
             for t in ctr.fails():
-                fails.append(t["name"] + ":")
-                fails.append(re.sub(r"(?m)^","    ",t["stdout"]))
+                fails.append("%s (%s):" % (t["name"],t.get("target","")))
+                fails.append(re.sub(r"(?m)^","    ",t.get("stdout","")))
             
             raise Exception("error occurred. stop. (%d)\n\n%s" % (utstts.returncode,"\n".join(fails)))
         
@@ -279,240 +993,3212 @@ class Cargo(object):
             "%d tests, %d passed, %d failed, %d allowed_fail, %d ignored.\ntotal time %.3f s."
             % (sts["test_count"],sts["passed"],sts["failed"],sts["allowed_fail"],sts["ignored"],sts["exec_time"])
         )
-
-    def doc(self,project_dir,out_dir):
+        print("slowest tests:")
+        for (target,name),r in ctr.slowest(5):
+            print("  %8.3f s  %s (%s)" % (r["exec_time"],name,target))
+    
+    def bench(self,project_dir,features,benchreport_dir,baseline_dir,baseline=None,save_baseline=None,threshold=10,gate=[ "*" ],harness="libtest"):
         """
-        ドキュメントを作成します。
+        ベンチマークを実行します。
         
-        - `project_dir` - プロジェクトのディレクトリーパス
-        - `out_dir`     - ドキュメントの出力先ディレクトリーのパス。`None`の場合はデフォルトの出力先に出力されます（targets）。
+        - 結果は benchreport_dir/report.json に、基準の結果は baseline_dir/<名前>.json に保存します
+        - baseline を指定すると、gate に一致するベンチマークが基準より threshold % 以上遅くなった場合にエラーにします
+          - 基準の結果がない場合もエラーにします（比べずに成功させると、遅くなっても気づけないため）
+        - save_baseline を指定すると、エラーにならなかった場合に結果を基準として保存します
+        - 比べる基準に上書き保存すると、しきい値より小さな遅れが積み重なっても気づけないため、baseline と save_baseline には別の名前を指定します
+        
+        - `project_dir`     - プロジェクトのディレクトリーパス
+        - `features`        - フィーチャー
+        - `benchreport_dir` - ベンチマークレポートの出力先ディレクトリーパス
+        - `baseline_dir`    - 基準の結果の保存先ディレクトリーパス
+        - `baseline`        - 比べる基準の名前。不要の場合は None を指定可能
+        - `save_baseline`   - 保存する基準の名前。不要の場合は None を指定可能
+        - `threshold`       - しきい値（%）
+        - `gate`            - しきい値を適用するベンチマーク名のパターン（fnmatch 形式）
+        - `harness`         - ベンチマークのハーネス（libtest / criterion）
         """
-        args = [ self.__cargo_file,"doc","--no-deps" ]
-        if not out_dir is None:
-            args.extend([ "--target-dir",out_dir ])
+        if baseline is not None and baseline == save_baseline:
+            raise Exception("baseline and save-baseline must differ. (%s)" % (baseline))
         
-        env = os.environ
-        st = subprocess.run(args,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
+        cargs = [ self.__cargo_file,"bench" ]
+        if 0 < len(features):
+            cargs.extend([ "--features",",".join(features) ])
+        if harness == "libtest":
+            cargs.extend([ "--","-Z","unstable-options","--format","json" ])
+        
+        env = dict(os.environ)
+        env["RUSTC_BOOTSTRAP"] = "1"
+        
+        cbr = CargoBenchReport()
+        st = run_process(cargs,cwd=project_dir,stderr=sys.stderr,env=env,stdout_handler=cbr.feed)
         if st.returncode != 0:
             raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        
+        commit = git_commit(project_dir)
+        save_bench_report(os.path.join(benchreport_dir,"report.json"),cbr,commit)
+        
+        if baseline is not None:
+            base = load_bench_report(os.path.join(baseline_dir,baseline + ".json"))
+            if base is None:
+                raise Exception("baseline `%s` not found in `%s`. save it with `save-baseline` first. stop." % (baseline,baseline_dir))
+            regressions = cbr.compare(base.results(),threshold,gate)
+            if 0 < len(regressions):
+                lines = [ "%+8.1f %%  %.1f ns -> %.1f ns  %s" % (ratio,b,n,name) for name,b,n,ratio in regressions ]
+                raise Exception("benchmark regressed more than %s %% against `%s`. stop.\n\n%s" % (threshold,baseline,"\n".join(lines)))
+            print("no regression against `%s` (threshold %s %%)." % (baseline,threshold))
+        
+        if save_baseline is not None:
+            save_bench_report(os.path.join(baseline_dir,save_baseline + ".json"),cbr,commit)
+    
+    def __coverage(self,project_dir,cargs,env,profdir,covreport_dir,formats):
+        """
+        カバレッジレポートを作成します。
+        
+        - プロファイルは llvm-profdata で一度だけ（並列に）マージし、すべての形式をそのマージ結果から作成します
+        - テストバイナリーとプロファイルが前回と同じ場合は作成しません
+        
+        - `project_dir`   - プロジェクトのディレクトリーパス
+        - `cargs`         - cargo の引数
+        - `env`           - 環境変数
+        - `profdir`       - プロファイルの出力先ディレクトリーパス
+        - `covreport_dir` - カバレッジレポートの出力先ディレクトリーパス
+        - `formats`       - カバレッジレポートの形式
+        """
+        profiles = []
+        if os.path.exists(profdir):
+            profiles = sorted([ os.path.join(profdir,en) for en in os.listdir(profdir) if en.endswith(".profraw") ])
+        if len(profiles) == 0:
+            print("no coverage profiles. (%s)" % (profdir),file=sys.stderr)
+            return
+        
+        # テストバイナリーを列挙（ビルド済みのため、ビルドは行われない）
+        st = run_process(cargs + [ "--tests","--no-run","--message-format=json" ],cwd=project_dir,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,env=env)
+        if st.returncode != 0:
+            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        objects = []
+        for l in st.stdout.decode("utf-8").splitlines():
+            m = json.loads(l)
+            if m.get("reason") == "compiler-artifact" and m.get("executable") is not None:
+                objects.append(m["executable"])
+        
+        key = hashlib.md5(json.dumps([
+            formats,sorted([ digest_of_file(p) for p in profiles ]),[ digest_of_file(p) for p in objects ]
+        ]).encode("utf-8")).hexdigest()
+        keyfile = os.path.join(covreport_dir,".key")
+        if os.path.exists(keyfile):
+            with open(keyfile,"r") as f:
+                if f.read() == key:
+                    print("[SKIP] coverage (%s: up to date)" % (covreport_dir))
+                    return
+        
+        if not os.path.exists(covreport_dir):
+            os.makedirs(covreport_dir)
+        
+        tooldir  = llvm_tools_dir(project_dir)
+        profdata = os.path.join(covreport_dir,"coverage.profdata")
+        lcov     = os.path.join(covreport_dir,"lcov.info")
+        
+        st = run_process([
+            os.path.join(tooldir,"llvm-profdata"),"merge","-sparse","--num-threads=%d" % (cpu_budget()),"-o",profdata
+        ] + profiles,cwd=project_dir,stdout=sys.stdout,stderr=sys.stderr)
+        if st.returncode != 0:
+            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        
+        args = [ os.path.join(tooldir,"llvm-cov"),"export","--format=lcov","--instr-profile",profdata,"--ignore-filename-regex","/.cargo/registry/|/rustc/" ]
+        for i,o in enumerate(objects):
+            args.extend([ o ] if i == 0 else [ "--object",o ])
+        with open(lcov,"wb") as f:
+            st = run_process(args,cwd=project_dir,stdout=f,stderr=sys.stderr)
+        if st.returncode != 0:
+            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        
+        # lcov は llvm-cov の出力をそのまま使い、それ以外は grcov で変換する
+        # - HTML形式      : covreport_dir
+        # - Cobertura形式 : covreport_dir/cobertura.xml
+        outputs = { "html":covreport_dir,"cobertura":os.path.join(covreport_dir,"cobertura.xml") }
+        results = run_parallel([
+            (lambda fmt: lambda: run_process([
+                "grcov",lcov,"-s",project_dir,"-t",fmt,"--branch","--ignore-not-existing","-o",outputs[fmt]
+            ],cwd=project_dir,stdout=sys.stdout,stderr=sys.stderr))(fmt) for fmt in formats if fmt in outputs
+        ],use_jobserver=True)
+        for st in results:
+            if st.returncode != 0:
+                raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        if not "lcov" in formats:
+            os.remove(lcov)
+        
+        with open(keyfile,"w") as f:
+            f.write(key)
+    
+    def __test_failed(self,project_dir,cargs,targs,env,names,ts):
+        """
+        名前を指定してテストを実行します。
+        
+        - doc テスト（`<ファイル> - <項目> (line <行>)`）は、それ以外のテストとは別に実行します
+        
+        - `project_dir` - プロジェクトのディレクトリーパス
+        - `cargs`       - cargo の引数
+        - `targs`       - テストハーネスの引数
+        - `env`         - 環境変数
+        - `names`       - テスト名
+        - `ts`          - 出力の受け取り先
+        """
+        docs  = [ n for n in names if re.search(r" - .*\(line \d+\)$",n) ]
+        tests = [ n for n in names if not n in docs ]
+        
+        st = None
+        if 0 < len(tests):
+            st = run_process(cargs + [ "--tests","--" ] + targs + [ "--exact" ] + tests,cwd=project_dir,stderr=subprocess.STDOUT,env=env,stdout_handler=ts.handler())
+            if st.returncode != 0:
+                return st
+        if 0 < len(docs):
+            st = run_process(cargs + [ "--doc","--" ] + targs + [ "--exact" ] + docs,cwd=project_dir,stderr=subprocess.STDOUT,env=env,stdout_handler=ts.handler())
+        return st
+    
+    def __test_sharded(self,project_dir,cargs,targs,env,shards,timings,ts,excludes=[]):
+        """
+        テストをシャードに分けて並行実行します。
+        
+        - doc テストは、シャードとは別の1プロセスで実行します
+        
+        - `project_dir` - プロジェクトのディレクトリーパス
+        - `cargs`       - cargo の引数
+        - `targs`       - テストハーネスの引数
+        - `env`         - 環境変数
+        - `shards`      - シャードの数
+        - `timings`     - テストごとの前回の実行時間
+        - `ts`          - 出力の受け取り先
+        - `excludes`    - 実行しないテスト名
+        """
+        st = run_process(cargs + [ "--tests","--no-run" ],cwd=project_dir,stdout=sys.stdout,stderr=sys.stderr,env=env)
+        if st.returncode != 0:
+            return st
+        
+        st = run_process(cargs + [ "--tests","--","--list","--format","terse" ],cwd=project_dir,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,env=env)
+        if st.returncode != 0:
+            return st
+        names = sorted(set(re.findall(r"(?m)^(.*): test$",st.stdout.decode("utf-8"))) - set(excludes))
+        
+        jobs = []
+        for names in partition_by_timing(names,timings,shards):
+            jobs.append(cargs + [ "--tests","--" ] + targs + [ "--exact" ] + names)
+        if os.path.exists(os.path.join(project_dir,"src","lib.rs")):
+            skips = []
+            if 0 < len(excludes):
+                skips.append("--exact")
+                for name in excludes:
+                    skips.extend([ "--skip",name ])
+            jobs.append(cargs + [ "--doc","--" ] + targs + skips)
+        
+        results = run_parallel([
+            (lambda a: lambda: run_process(a,cwd=project_dir,stderr=subprocess.STDOUT,env=env,stdout_handler=ts.handler()))(a) for a in jobs
+        ],use_jobserver=True)
+        for r in results:
+            if r.returncode != 0:
+                return r
+        return st
+    
+    def stress(self,project_dir,workdir,kind,processes,threads,count):
+        """
+        一時ファイル（一時ディレクトリー）を複数のプロセス・スレッドから同じディレクトリーに作成し、プロセスごとの結果を返します。
+        
+        - examples/stress.rs を `stress` フィーチャー付きでビルドして実行します
+        
+        - `project_dir` - プロジェクトのディレクトリーパス
+        - `workdir`     - 一時ファイルを作成するディレクトリーパス
+        - `kind`        - 作成するもの（file / dir）
+        - `processes`   - プロセスの数
+        - `threads`     - プロセスあたりのスレッドの数
+        - `count`       - スレッドあたりの作成数
+        
+        - プロセスはジョブサーバーのトークンを待たずにすべて同時に起動します
+        - 作成していた期間が重ならないプロセスがある場合は、競合を測定できていないので例外を送出します
+        """
+        st = run_process(
+            [ self.__cargo_file,"build","--release","--features","stress","--example","stress" ],
+            cwd=project_dir,stdout=sys.stdout,stderr=sys.stderr
+        )
+        if st.returncode != 0:
+            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        
+        exe = os.path.join(project_dir,"target","release","examples","stress")
+        # すべてのプロセスが起動してから、そろって作成を始める
+        start_at = int((time.time() + 1 + 0.05 * processes) * 1000)
+        
+        def work():
+            st = run_process(
+                [ exe,workdir,kind,str(threads),str(count),str(start_at) ],
+                cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr
+            )
+            if st.returncode != 0:
+                raise Exception("error occurred. stop. (%d)" % (st.returncode))
+            return json.loads(st.stdout.decode("utf-8"))
+        
+        results = run_parallel([ work ] * processes)
+        
+        # 最後に始めたプロセスが、最初に終わったプロセスより前に始めていれば、全プロセスが同時に作成していた期間がある
+        started_at  = max([ r["started_at"] for r in results ])
+        finished_at = min([ r["finished_at"] for r in results ])
+        if finished_at <= started_at:
+            raise Exception("stress processes did not run concurrently. (last start %.3f s after first finish)" % (started_at - finished_at))
+        return results
+    
+    def required_features(self,project_dir):
+        """
+        テストとサンプルのターゲットごとに、必要なフィーチャー（Cargo.toml の `required-features`）を返します。
+        
+        - 戻り値は `(<test / example>,<ターゲット名>)` とフィーチャーのリストの辞書で、必要なフィーチャーがないターゲットは含みません
+        
+        - `project_dir` - プロジェクトのディレクトリーパス
+        """
+        st = run_process(
+            [ self.__cargo_file,"metadata","--no-deps","--format-version","1" ],
+            cwd=project_dir,stdout=subprocess.PIPE,stderr=sys.stderr
+        )
+        if st.returncode != 0:
+            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        
+        res = {}
+        for pkg in json.loads(st.stdout.decode("utf-8"))["packages"]:
+            for t in pkg["targets"]:
+                for kind in t["kind"]:
+                    if kind in [ "test","example" ] and 0 < len(t.get("required-features",[])):
+                        res[(kind,t["name"])] = t["required-features"]
+        return res
+    
+    def doc(self,project_dir,out_dir):
+        """
+        ドキュメントを作成します。
+        
+        - `project_dir` - プロジェクトのディレクトリーパス
+        - `out_dir`     - ドキュメントの出力先ディレクトリーのパス。`None`の場合はデフォルトの出力先に出力されます（targets）。
+        """
+        args = [ self.__cargo_file,"doc","--no-deps" ]
+        if not out_dir is None:
+            args.extend([ "--target-dir",out_dir ])
+        
+        env = os.environ
+        st = run_process(args,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
+        if st.returncode != 0:
+            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+
+class UnsupportedOpError(Exception):
+    
+    def __init__(self,op):
+        """
+        新しいUnsupportedOpErrorインスタンスを生成します。
+        
+        - `op` - 操作名
+        """
+        super().__init__("unsupported op. (%s)" % (op))
+        self.op = op
+
+class OpCancelled(Exception):
+    """
+    操作がキャンセルされたことを表す例外です。
+    """
+    pass
+
+class CancelToken(object):
+    
+    def __init__(self):
+        """
+        新しいCancelTokenインスタンスを生成します。
+        """
+        self.__lock  = threading.Lock()
+        self.__event = threading.Event()
+        self.__procs = set()
+    
+    def cancel(self):
+        """
+        キャンセルします。
+        
+        - 実行中のプロセスは終了させます
+        """
+        with self.__lock:
+            self.__event.set()
+            procs = list(self.__procs)
+        for p in procs:
+            terminate_process(p)
+    
+    def cancelled(self):
+        """
+        キャンセルされているかどうかを返します。
+        """
+        return self.__event.is_set()
+    
+    def attach(self,proc):
+        """
+        実行中のプロセスを登録します。
+        
+        - `proc` - プロセス
+        """
+        with self.__lock:
+            self.__procs.add(proc)
+            if self.__event.is_set():
+                terminate_process(proc)
+    
+    def detach(self,proc):
+        """
+        終了したプロセスの登録を解除します。
+        
+        - `proc` - プロセス
+        """
+        with self.__lock:
+            self.__procs.discard(proc)
+
+# MAKEFLAGS のジョブサーバーの指定
+# - GNU make 4.4 以降は名前付きパイプ（fifo:<パス>）、それより前は引き継いだパイプのファイルディスクリプター
+JOBSERVER_FIFO_PATTERN = r"--jobserver-auth=fifo:(\S+)"
+JOBSERVER_FDS_PATTERN  = r"--jobserver-(?:auth|fds)=(\d+),(\d+)"
+
+class Jobserver(object):
+    
+    def __init__(self,tokens,fds=None,fifo=None):
+        """
+        新しいJobserverインスタンスを生成します。
+        
+        - GNU make 互換のジョブサーバー（トークンを入れたパイプ）で、build.py の操作と子プロセス（cargo の rustc など）の並行数をまとめて制限します
+        - 子プロセスには MAKEFLAGS / CARGO_MAKEFLAGS でパイプを知らせます
+        - build.py 自身が1つ目のトークン（暗黙のトークン）を持つため、パイプには tokens - 1 個のトークンを入れます
+        - 暗黙のトークンはパイプに入れられないため、lend() で同じプロセスのスレッドに貸し出します
+        
+        - `tokens` - トークンの数
+        - `fds`    - 既存のジョブサーバーのパイプ（読み込み側、書き込み側）
+        - `fifo`   - 既存のジョブサーバーの名前付きパイプのパス。fds と fifo を省略した場合は新しく作成します
+        """
+        self.__tokens = tokens
+        self.__owner  = fds is None and fifo is None
+        self.__opened = []
+        if fifo is not None:
+            fd  = os.open(fifo,os.O_RDWR)
+            fds = (fd,fd)
+            self.__opened.append(fd)
+        if fds is None:
+            fds = os.pipe()
+            os.write(fds[1],b"+" * (tokens - 1))
+            self.__opened.extend(fds)
+        self.__fds = fds
+        
+        # 貸し出されて、空いている暗黙のトークンの数
+        self.__cond  = threading.Condition()
+        self.__local = 0
+        
+        # 待つ間にキャンセルを確かめられるよう、自分だけノンブロッキングで読む
+        # - パイプの O_NONBLOCK は子プロセスと共有されるため、/proc から別に開く
+        try:
+            self.__rfd = os.open("/proc/self/fd/%d" % (fds[0]),os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self.__rfd = None
+    
+    @staticmethod
+    def from_environ(environ):
+        """
+        build.py を起動した make のジョブサーバーを返します。ない場合は None を返します。
+        
+        - `environ` - 環境変数
+        """
+        flags = environ.get("MAKEFLAGS","")
+        m = re.search(r"(?:^|\s)-j(\d+)",flags)
+        tokens = int(m[1]) if m is not None else os.cpu_count() or 1
+        
+        m = re.search(JOBSERVER_FIFO_PATTERN,flags)
+        if m is not None:
+            try:
+                return Jobserver(tokens,fifo=m[1])
+            except OSError:
+                # make が終了して名前付きパイプが削除された
+                return None
+        
+        m = re.search(JOBSERVER_FDS_PATTERN,flags)
+        if m is None:
+            return None
+        fds = (int(m[1]),int(m[2]))
+        try:
+            for fd in fds:
+                os.fstat(fd)
+        except OSError:
+            # make がパイプを渡していない（レシピに `+` がない）
+            return None
+        return Jobserver(tokens,fds)
+    
+    def environ(self):
+        """
+        子プロセスに渡す環境変数を返します。
+        """
+        flags = "-j%d --jobserver-auth=%d,%d" % (self.__tokens,self.__fds[0],self.__fds[1])
+        if not self.__owner:
+            flags = os.environ.get("MAKEFLAGS",flags)
+        return { "MAKEFLAGS":flags,"CARGO_MAKEFLAGS":flags }
+    
+    def fds(self):
+        """
+        子プロセスに引き継ぐファイルディスクリプターを返します。
+        """
+        return self.__fds
+    
+    def tokens(self):
+        """
+        トークンの数（同時に使ってよい CPU の数）を返します。
+        """
+        return self.__tokens
+    
+    def acquire(self,token=None):
+        """
+        トークンを1つ受け取ります。空くまで待ちます。
+        
+        - 貸し出された暗黙のトークンが空いていれば、パイプより先に使います（戻り値は None）
+        
+        - `token` - キャンセルトークン
+        """
+        fd = self.__fds[0] if self.__rfd is None else self.__rfd
+        while True:
+            if token is not None and token.cancelled():
+                raise OpCancelled()
+            with self.__cond:
+                if 0 < self.__local:
+                    self.__local -= 1
+                    return None
+            # 暗黙のトークンが返されたことに気づけるよう、短い間隔で待つ
+            r,_,_ = select.select([ fd ],[],[],0.05)
+            if len(r) == 0:
+                continue
+            try:
+                b = os.read(fd,1)
+            except BlockingIOError:
+                # 別のプロセスが先に受け取った
+                continue
+            if 0 < len(b):
+                return b
+    
+    def release(self,b):
+        """
+        受け取ったトークンを返します。
+        
+        - `b` - acquire() が返したトークン
+        """
+        if b is None:
+            with self.__cond:
+                self.__local += 1
+                self.__cond.notify_all()
+        else:
+            os.write(self.__fds[1],b)
+    
+    def lend(self):
+        """
+        呼び出したスレッドが持つトークンを、同じプロセスのほかのスレッドに貸し出します。
+        
+        - トークンを持ったまま、ほかのスレッドがトークンを待つ（パイプが空だと終わらない）ことがないように使います
+        - 貸し出している間は、トークンを使う処理（プロセスの実行など）をしないでください
+        """
+        self.release(None)
+    
+    def reclaim(self):
+        """
+        lend() で貸し出したトークンを取り戻します。使っているスレッドが返すまで待ちます。
+        """
+        with self.__cond:
+            while self.__local == 0:
+                self.__cond.wait()
+            self.__local -= 1
+    
+    def close(self):
+        """
+        パイプを閉じます。
+        """
+        if self.__rfd is not None:
+            os.close(self.__rfd)
+            self.__rfd = None
+        for fd in self.__opened:
+            os.close(fd)
+        self.__opened = []
+
+# 実行中の操作の情報（スレッドごと）
+# - `prefix`    - 出力に付ける接頭辞。None の場合は付けない
+# - `token`     - キャンセルトークン
+# - `trace`     - トレースの記録
+# - `sink`      - 出力の送り先（常駐サーバーのクライアント）。None の場合はコンソールに出力する
+# - `jobserver` - ジョブサーバー。None の場合は並行数を制限しない
+op_local = threading.local()
+
+OP_STATE_KEYS = [ "prefix","token","trace","sink","jobserver" ]
+
+def op_state():
+    """
+    現在のスレッドの操作の情報を返します。
+    
+    - 別のスレッドに引き継ぐ場合に使います
+    """
+    return dict([ (k,getattr(op_local,k,None)) for k in OP_STATE_KEYS ])
+
+def set_op_state(state):
+    """
+    現在のスレッドに操作の情報を設定します。
+    
+    - `state` - op_state() で得た操作の情報
+    """
+    for k,v in state.items():
+        setattr(op_local,k,v)
+
+def cpu_budget():
+    """
+    同時に使ってよい CPU の数を返します。
+    
+    - ジョブサーバーがある場合はトークンの数（`--cpus` または make の -j）、ない場合は CPU の数です
+    """
+    jobserver = getattr(op_local,"jobserver",None)
+    if jobserver is not None:
+        return jobserver.tokens()
+    return os.cpu_count() or 1
+
+def install_console():
+    """
+    sys.stdout / sys.stderr を ConsoleStream に置き換えます。
+    
+    - 置き換え済みの場合は何もしません
+    """
+    if not isinstance(sys.stdout,ConsoleStream):
+        sys.stdout = ConsoleStream(sys.stdout,1)
+    if not isinstance(sys.stderr,ConsoleStream):
+        sys.stderr = ConsoleStream(sys.stderr,2)
+
+def is_console_redirected():
+    """
+    現在のスレッドの出力に、接頭辞を付けるか、送り先があるかどうかを返します。
+    """
+    return getattr(op_local,"prefix",None) is not None or getattr(op_local,"sink",None) is not None
+
+class ConsoleStream(object):
+    
+    def __init__(self,stream,fd):
+        """
+        新しいConsoleStreamインスタンスを生成します。
+        
+        - sys.stdout / sys.stderr と置き換え、スレッドごとに、行単位で操作の接頭辞を付けたり、送り先を切り替えたりします
+        
+        - `stream` - 出力先のストリーム
+        - `fd`     - 送り先に伝えるファイル記述子の番号（1: 標準出力, 2: 標準エラー出力）
+        """
+        self.__stream  = stream
+        self.__fd      = fd
+        self.__lock    = threading.Lock()
+        self.__pending = {}
+    
+    def write(self,s):
+        if not is_console_redirected():
+            return self.__stream.write(s)
+        
+        with self.__lock:
+            key   = threading.get_ident()
+            lines = (self.__pending.pop(key,"") + s).split("\n")
+            rest  = lines.pop()
+            if rest != "":
+                self.__pending[key] = rest
+            for l in lines:
+                self.__emit(l)
+            if 0 < len(lines):
+                self.__stream.flush()
+        return len(s)
+    
+    def flush(self):
+        self.__stream.flush()
+    
+    def flush_line(self):
+        """
+        現在のスレッドが書き込んだ、改行で終わっていない出力を書き出します。
+        """
+        with self.__lock:
+            rest = self.__pending.pop(threading.get_ident(),None)
+            if rest is not None:
+                self.__emit(rest)
+                self.__stream.flush()
+    
+    def fileno(self):
+        return self.__stream.fileno()
+    
+    def __emit(self,line):
+        prefix = getattr(op_local,"prefix",None)
+        sink   = getattr(op_local,"sink",None)
+        line   = ("" if prefix is None else prefix) + line + "\n"
+        if sink is None:
+            self.__stream.write(line)
+        else:
+            sink(self.__fd,line)
+    
+    def __getattr__(self,name):
+        return getattr(self.__stream,name)
+
+class FingerprintStore(object):
+    
+    def __init__(self,path):
+        """
+        新しいFingerprintStoreインスタンスを生成します。
+        
+        - ファイルごとに (サイズ, 更新日時[ns], ハッシュ) を記録し、サイズと更新日時が変わったファイルだけハッシュを計算し直します
+        - 操作ごとに、最後に成功したときの入力のダイジェストを記録します
+        
+        - `path` - 保存先ファイルのパス
+        """
+        self.__path  = path
+        self.__lock  = threading.RLock()
+        self.__files = {}
+        self.__ops   = {}
+        self.hashed_bytes = 0
+        
+        if os.path.exists(path):
+            try:
+                with open(path,"rb") as f:
+                    obj = json.load(f)
+                self.__files = obj["files"]
+                self.__ops   = obj["ops"]
+            except Exception:
+                # 壊れている場合は作り直す
+                self.__files = {}
+                self.__ops   = {}
+    
+    def hash_file(self,path,st=None):
+        """
+        ファイルのハッシュを返します。
+        
+        - サイズと更新日時が記録と同じ場合は、ファイルを読まずに記録したハッシュを返します
+        
+        - `path` - ファイルのパス
+        - `st`   - ファイルの stat。省略時は取得します
+        """
+        if st is None:
+            st = os.stat(path)
+        key = os.path.abspath(path)
+        with self.__lock:
+            rec = self.__files.get(key)
+        if rec is not None and rec[0] == st.st_size and rec[1] == st.st_mtime_ns:
+            return rec[2]
+        
+        h = digest_of_file(path)
+        with self.__lock:
+            self.hashed_bytes += st.st_size
+            self.__files[key] = [ st.st_size,st.st_mtime_ns,h ]
+        return h
+    
+    def record_file(self,path,h):
+        """
+        ハッシュが分かっているファイル（コピーしたファイルなど）のハッシュを記録します。
+        
+        - `path` - ファイルのパス
+        - `h`    - ハッシュ
+        """
+        st = os.stat(path)
+        with self.__lock:
+            self.__files[os.path.abspath(path)] = [ st.st_size,st.st_mtime_ns,h ]
+    
+    def fingerprint(self,basedir,inputs):
+        """
+        入力ファイルのハッシュを返します。
+        
+        - ディレクトリーは中のファイルをすべて対象にします
+        - 存在しない入力は無視します（削除されたファイルはダイジェストの差分として現れます）
+        
+        - `basedir` - 基準ディレクトリーのパス
+        - `inputs`  - 入力（ファイルまたはディレクトリー）のパスのリスト。basedir からの相対パス
+        """
+        files = {}
+        
+        def walk(p):
+            with os.scandir(p) as it:
+                for en in it:
+                    if en.is_dir():
+                        walk(en.path)
+                    elif en.is_file():
+                        files[os.path.relpath(en.path,basedir)] = self.hash_file(en.path,en.stat())
+        
+        for i in inputs:
+            p = os.path.join(basedir,i)
+            if os.path.isdir(p):
+                walk(p)
+            elif os.path.isfile(p):
+                files[os.path.relpath(p,basedir)] = self.hash_file(p)
+        return files
+    
+    def is_up_to_date(self,key,digest):
+        """
+        操作が最後に成功したときと、入力のダイジェストが同じかどうかを返します。
+        
+        - `key`    - 操作のキー
+        - `digest` - 入力のダイジェスト
+        """
+        with self.__lock:
+            rec = self.__ops.get(key)
+        return rec is not None and rec["digest"] == digest
+    
+    def last_files(self,key):
+        """
+        操作が最後に成功したときの入力ファイルのハッシュを返します。記録がない場合は None を返します。
+        
+        - `key` - 操作のキー
+        """
+        with self.__lock:
+            rec = self.__ops.get(key)
+        return None if rec is None else rec["files"]
+    
+    def record_op(self,key,digest,files):
+        """
+        操作が成功したときの入力を記録し、保存します。
+        
+        - `key`    - 操作のキー
+        - `digest` - 入力のダイジェスト
+        - `files`  - 入力ファイルのハッシュ
+        """
+        with self.__lock:
+            self.__ops[key] = { "digest":digest,"files":files }
+            self.save()
+    
+    def save(self):
+        """
+        保存します。
+        """
+        with self.__lock:
+            d = os.path.dirname(self.__path)
+            if not os.path.exists(d):
+                os.makedirs(d)
+            tmp = self.__path + ".tmp"
+            with open(tmp,"w") as f:
+                json.dump({ "files":self.__files,"ops":self.__ops },f)
+            os.replace(tmp,self.__path)
+
+def wasm_pack_build(project_dir,out_dir):
+    """
+    wasm-packでビルドします。
+    
+    - `project_dir` - プロジェクトのディレクトリーパス
+    - `out_dir`     - 出力先ディレクトリーのパス
+    """
+    args = [
+        "wasm-pack","build","--release","--target","web","--out-name","wasm","--out-dir",out_dir
+    ]
+    env = dict(os.environ)
+    env["RUSTFLAGS"] = "--cfg=web_sys_unstable_apis"
+    
+    st = run_process(args,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
+    if st.returncode != 0:
+        raise Exception("error occurred. stop. (%d)" % (st.returncode))
+
+# 事前に圧縮する出力ファイルの拡張子
+COMPRESSIBLE_EXTS = [ ".wasm",".js",".mjs",".css",".html",".svg",".json",".txt" ]
+
+def compress_asset(path,fmt):
+    """
+    ファイルを圧縮して <path>.<fmt> に書き出し、圧縮後のサイズを返します。
+    
+    - プロセスプールから呼び出すため、モジュールの関数にしています
+    - gz は gzip モジュール、br は brotli コマンドで圧縮します
+    
+    - `path` - ファイルのパス
+    - `fmt`  - 圧縮形式（gz / br）
+    """
+    dst = path + "." + fmt
+    tmp = dst + ".tmp"
+    if fmt == "gz":
+        with open(path,"rb") as fi,open(tmp,"wb") as fo:
+            # 内容が同じなら同じ出力になるよう、日時を記録しない
+            with gzip.GzipFile(filename="",mode="wb",compresslevel=9,fileobj=fo,mtime=0) as gz:
+                shutil.copyfileobj(fi,gz,1024 * 1024)
+    elif fmt == "br":
+        st = subprocess.run([ "brotli","--force","--quality=11","--output=" + tmp,path ],stdout=subprocess.DEVNULL,stderr=subprocess.PIPE)
+        if st.returncode != 0:
+            raise Exception("brotli failed. (%s: %s)" % (path,st.stderr.decode("utf-8","replace").strip()))
+    else:
+        raise Exception("unsupported compression. (%s)" % (fmt))
+    os.replace(tmp,dst)
+    return os.stat(dst).st_size
+
+def wasm_post_process(out_dir,optimize,formats,budgets,report_file,store):
+    """
+    wasm-pack の出力を、配信用に仕上げます。
+    
+    - optimize を指定すると、.wasm を wasm-opt で最適化します
+    - 出力ファイルを formats の形式で圧縮し、<ファイル>.gz / <ファイル>.br を書き出します（プロセスプールで並行実行します）
+    - 前回圧縮したときから内容が変わっていないファイルは、圧縮し直しません
+    - 圧縮前後のサイズを report_file に記録し、budgets を超えたファイルがあればエラーにします
+    
+    - `out_dir`     - wasm-pack の出力先ディレクトリーのパス
+    - `optimize`    - wasm-opt の最適化オプション（`-Oz` など）。不要の場合は None
+    - `formats`     - 圧縮形式（gz / br）のリスト
+    - `budgets`     - ファイル名のパターン（fnmatch 形式）ごとのサイズの上限（`raw` / `gz` / `br`、バイト数）
+    - `report_file` - サイズの記録先ファイルパス
+    - `store`       - ファイルのハッシュの記録先
+    """
+    if optimize is not None:
+        if shutil.which("wasm-opt") is None:
+            raise Exception("please install `wasm-opt` (binaryen) to optimize wasm.")
+        for en in sorted(os.listdir(out_dir)):
+            if not en.endswith(".wasm"):
+                continue
+            p = os.path.join(out_dir,en)
+            before = os.stat(p).st_size
+            st = run_process([ "wasm-opt",optimize,"-o",p + ".tmp",p ],stdout=sys.stdout,stderr=sys.stderr)
+            if st.returncode != 0:
+                raise Exception("error occurred. stop. (%d)" % (st.returncode))
+            os.replace(p + ".tmp",p)
+            print("wasm-opt %s: %d -> %d bytes" % (en,before,os.stat(p).st_size))
+    
+    if "br" in formats and shutil.which("brotli") is None:
+        raise Exception("please install `brotli` command to precompress assets.")
+    
+    assets = []
+    for pdir,_,files in os.walk(out_dir):
+        for en in files:
+            if os.path.splitext(en)[1] in COMPRESSIBLE_EXTS:
+                assets.append(os.path.join(pdir,en))
+    assets.sort()
+    
+    # 前回の記録（ファイルのハッシュと圧縮後のサイズ）
+    prev = {}
+    if os.path.exists(report_file):
+        with open(report_file,"r") as f:
+            prev = json.load(f)["assets"]
+    
+    sizes = {}
+    jobs  = []
+    for p in assets:
+        name = os.path.relpath(p,out_dir)
+        h    = store.hash_file(p)
+        rec  = { "digest":h,"raw":os.stat(p).st_size }
+        for fmt in formats:
+            old = prev.get(name,{})
+            if old.get("digest") == h and fmt in old and os.path.exists(p + "." + fmt) and os.stat(p + "." + fmt).st_size == old[fmt]:
+                rec[fmt] = old[fmt]
+            else:
+                jobs.append((name,p,fmt))
+        sizes[name] = rec
+    
+    if 0 < len(jobs):
+        # 圧縮は CPU を使うため、スレッドではなくプロセスで並行実行する
+        # - スレッドを使っているプロセスを fork しないよう、spawn で起動する
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(jobs),cpu_budget()),mp_context=ctx) as pool:
+            futures = [ (name,fmt,pool.submit(compress_asset,p,fmt)) for name,p,fmt in jobs ]
+            for name,fmt,fu in futures:
+                sizes[name][fmt] = fu.result()
+    print("compressed %d files (%d up to date)." % (len(jobs),len(assets) * len(formats) - len(jobs)))
+    trace_count("assets_compressed",len(jobs))
+    
+    if not os.path.exists(os.path.dirname(report_file)):
+        os.makedirs(os.path.dirname(report_file))
+    with open(report_file,"w") as f:
+        json.dump({ "assets":sizes,"budgets":budgets },f,indent=2,sort_keys=True)
+    
+    over = []
+    for name,rec in sorted(sizes.items()):
+        print("  %10d raw  %s  %s" % (rec["raw"],"  ".join([ "%10d %s" % (rec[fmt],fmt) for fmt in formats ]),name))
+        for pattern,limits in budgets.items():
+            if not fnmatch.fnmatchcase(name,pattern):
+                continue
+            for kind,limit in limits.items():
+                if kind in rec and limit < rec[kind]:
+                    over.append("%s (%s): %d > %d bytes" % (name,kind,rec[kind],limit))
+    if 0 < len(over):
+        raise Exception("size budget exceeded. stop.\n\n%s" % ("\n".join(over)))
+
+def run_command(basedir,args,env):
+    """
+    コマンドを実行します。
+    
+    - `basedir` - 基準ディレクトリーのパス
+    - `args`    - コマンド
+    - `env`     - 環境変数
+    """
+    
+    ekv = dict(os.environ)
+    for k,v in env.items():
+        ekv[k] = v
+    
+    st = run_process(args,stdout=sys.stdout,stderr=sys.stderr,cwd=basedir,env=ekv)
+    if st.returncode != 0:
+        raise Exception("error occurred. stop. (%d)" % (st.returncode))
+
+def terminate_process(proc):
+    """
+    プロセスを終了させます。
+    
+    - POSIX の場合は、プロセスグループごと終了させます
+    
+    - `proc` - プロセス
+    """
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid,signal.SIGTERM)
+        else:
+            proc.terminate()
+    except OSError:
+        pass
+
+def trace_process(args,start,end,returncode,maxrss,maxrss_self=None):
+    """
+    実行中の操作のトレースに、プロセスの実行を記録します。
+    
+    - `args`       - コマンド
+    - `start`      - 開始日時
+    - `end`        - 終了日時
+    - `returncode` - 終了コード
+    - `maxrss`      - 子孫プロセスを含む最大メモリー使用量（KiB、wait4 の ru_maxrss）。不明な場合は None
+      - 回収された子孫プロセス（cargo が起動した rustc など）のうち最大の値を含みます
+      - exec 前の fork した build.py のメモリーも含むため、小さいプロセスでは build.py の大きさが下限になります
+    - `maxrss_self` - プロセス自身の exec 後の最大メモリー使用量（KiB、VmHWM）。子孫プロセスは含みません。不明な場合は None
+    """
+    rec = getattr(op_local,"trace",None)
+    if rec is None:
+        return
+    with rec["lock"]:
+        rec["processes"].append({
+            "args":[ str(a) for a in args ],"start":start,"end":end,"returncode":returncode,
+            "maxrss":maxrss,"maxrss_self":maxrss_self
+        })
+
+def process_peak_rss(pid):
+    """
+    プロセスの最大メモリー使用量（/proc/<pid>/status の VmHWM、KiB）を返します。読めない場合は None を返します。
+    
+    - exec 後のプログラムだけの値です（fork した build.py のメモリーを含みません）
+    
+    - `pid` - プロセスID
+    """
+    try:
+        with open("/proc/%d/status" % (pid),"r") as f:
+            for l in f:
+                if l.startswith("VmHWM:"):
+                    return int(l.split()[1])
+    except (OSError,ValueError):
+        pass
+    return None
+
+def trace_count(name,value):
+    """
+    実行中の操作のトレースに、カウンター（コピーしたバイト数など）を加算します。
+    
+    - `name`  - カウンター名
+    - `value` - 加算する値
+    """
+    rec = getattr(op_local,"trace",None)
+    if rec is None:
+        return
+    with rec["lock"]:
+        rec["counters"][name] = rec["counters"].get(name,0) + value
+
+def run_process(args,cwd=None,env=None,stdout=None,stderr=None,stdout_handler=None):
+    """
+    プロセスを実行し、終了を待ちます。
+    
+    - 操作の出力に接頭辞を付けている場合や送り先がある場合、コンソールへの出力はパイプで受けて ConsoleStream へ流します
+    - 操作がキャンセルされた場合は、プロセスを終了させて OpCancelled を送出します
+    
+    - `args`   - コマンド
+    - `cwd`    - 作業ディレクトリーのパス
+    - `env`    - 環境変数
+    - `stdout` - 標準出力の出力先。省略時は sys.stdout
+    - `stderr` - 標準エラー出力の出力先。省略時は sys.stderr
+    - `stdout_handler` - 標準出力を1行ずつ受け取る関数。指定した場合、stdout は無視されます
+    """
+    state = op_state()
+    token = state["token"]
+    if token is not None and token.cancelled():
+        raise OpCancelled()
+    
+    if stdout_handler is not None:
+        stdout = subprocess.PIPE
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+    
+    relays = []
+    if is_console_redirected():
+        if stdout is sys.stdout:
+            relays.append(("stdout",sys.stdout))
+            stdout = subprocess.PIPE
+        if stderr is sys.stderr:
+            relays.append(("stderr",sys.stderr))
+            stderr = subprocess.PIPE
+    
+    # ジョブサーバーを子プロセスに引き継ぐ
+    pass_fds = ()
+    jobserver = state["jobserver"]
+    if jobserver is not None:
+        env = dict(os.environ if env is None else env)
+        env.update(jobserver.environ())
+        pass_fds = jobserver.fds()
+    
+    # キャンセル時に子孫プロセスもまとめて終了できるよう、プロセスグループを分ける
+    started = time.time()
+    proc = subprocess.Popen(args,cwd=cwd,env=env,stdout=stdout,stderr=stderr,start_new_session=(os.name == "posix"),pass_fds=pass_fds)
+    if token is not None:
+        token.attach(proc)
+    
+    # トレースする場合は、プロセス自身の exec 後の最大メモリー使用量も実行中に読む（Popen は exec してから戻る）
+    # - 操作の最大メモリー使用量には、子孫プロセスを含む wait4 の値を使う。こちらは補助の値
+    peak    = [ None ]
+    reaped  = threading.Event()
+    sampler = None
+    if getattr(op_local,"trace",None) is not None and os.path.exists("/proc/%d/status" % (proc.pid)):
+        def sample():
+            while not reaped.is_set():
+                v = process_peak_rss(proc.pid)
+                if v is not None and (peak[0] is None or peak[0] < v):
+                    peak[0] = v
+                reaped.wait(0.05)
+        
+        sampler = threading.Thread(target=sample,daemon=True)
+        sampler.start()
+    
+    try:
+        def relay(pipe,stream):
+            set_op_state(state)
+            for l in iter(pipe.readline,b""):
+                stream.write(l.decode("utf-8","replace"))
+            stream.flush_line()
+        
+        threads = []
+        for name,stream in relays:
+            t = threading.Thread(target=relay,args=(getattr(proc,name),stream))
+            t.start()
+            threads.append(t)
+        
+        out = None
+        if stdout_handler is not None:
+            for l in iter(proc.stdout.readline,b""):
+                stdout_handler(l)
+        elif stdout == subprocess.PIPE and not "stdout" in [ r[0] for r in relays ]:
+            out = proc.stdout.read()
+        
+        maxrss = None
+        if os.name == "posix":
+            # 終了したプロセスの最大メモリー使用量を読んでから回収する（回収後は別のプロセスが同じ ID を使うことがある）
+            if sampler is not None:
+                os.waitid(os.P_PID,proc.pid,os.WEXITED | os.WNOWAIT)
+                reaped.set()
+                sampler.join()
+            # 子孫プロセスを含む最大メモリー使用量を得るため、wait4 で待つ
+            _,status,ru = os.wait4(proc.pid,0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            maxrss = ru.ru_maxrss
+        else:
+            proc.wait()
+        for t in threads:
+            t.join()
+    except BaseException:
+        terminate_process(proc)
+        raise
+    finally:
+        reaped.set()
+        if token is not None:
+            token.detach(proc)
+    
+    trace_process(args,started,time.time(),proc.returncode,maxrss,peak[0])
+    
+    if token is not None and token.cancelled():
+        raise OpCancelled()
+    
+    return subprocess.CompletedProcess(args,proc.returncode,out,None)
+
+def digest_of_file(file):
+    """
+    ファイル全体のハッシュを返します。
+    
+    - `file` - ファイルのパス
+    """
+    md5 = hashlib.md5()
+    with open(file,"rb") as f:
+        for b in iter(lambda: f.read(1024 * 1024),b""):
+            md5.update(b)
+    return md5.hexdigest()
+
+def merge_tree(source_dir,dest_dir,store,mode="copy",workers=1,mirror=False,quiet=False):
+    """
+    ディレクトリーツリーをマージします。
+    
+    - コピー時に更新日時もコピーし、サイズと更新日時が同じファイルは内容を読まずにスキップします
+    - サイズが同じで更新日時が異なる場合だけ、ファイル全体のハッシュを比べます
+    - コピー先のハッシュは store に記録するため、次回は読み直しません
+    - ファイルは一時ファイルに複製してから置き換えます（ハードリンクしたファイルを書き換えないため）
+    - workers を指定すると、ファイルの比較と複製をスレッドプールで並行実行します
+    - mirror を指定すると、マージ元にないファイルやディレクトリーをマージ先から削除します
+    
+    - `source_dir` - マージ元のディレクトリー
+    - `dest_dir`   - マージ先のディレクトリー
+    - `store`      - ハッシュの記録先
+    - `mode`       - 複製の方法（reflink / hardlink / copy）
+    - `workers`    - 並行実行する数
+    - `mirror`     - マージ元にないものを削除するかどうか
+    - `quiet`      - ファイルごとの結果を出力せず、集計だけを出力するかどうか
+    """
+    print("%s to %s" % (source_dir,dest_dir))
+    
+    stats  = { "files":0,"copied":0,"copied_bytes":0,"hashed_bytes":0,"deleted":0 }
+    hashed = store.hashed_bytes
+    lock   = threading.Lock()
+    
+    def report(p,result):
+        if not quiet:
+            # スレッドから出力した行が混ざらないようにする
+            with lock:
+                print("%-32s   %s" % (p,result))
+    
+    if not os.path.exists(dest_dir):
+        os.mkdir(dest_dir)
+    
+    entries = set()
+    tasks   = []
+    for pdir,dirs,files in os.walk(source_dir):
+        for en in dirs:
+            p = os.path.relpath(os.path.join(pdir,en),source_dir)
+            entries.add(p)
+            dest = os.path.join(dest_dir,p)
+            
+            if not os.path.exists(dest):
+                os.mkdir(dest)
+                report(p + "/","created")
+            else:
+                report(p + "/","skip")
+        
+        for en in files:
+            p = os.path.relpath(os.path.join(pdir,en),source_dir)
+            entries.add(p)
+            tasks.append(p)
+    
+    def merge_file(p):
+        src  = os.path.join(source_dir,p)
+        dest = os.path.join(dest_dir,p)
+        
+        sst = os.stat(src)
+        dst = os.stat(dest) if os.path.exists(dest) else None
+        
+        sh = None
+        if dst is not None and dst.st_size == sst.st_size:
+            if dst.st_mtime_ns == sst.st_mtime_ns:
+                report(p,"skip")
+                return
+            
+            sh = store.hash_file(src,sst)
+            if sh == store.hash_file(dest,dst):
+                # 次回は更新日時で判定できるようにそろえておく
+                os.utime(dest,ns=(dst.st_atime_ns,sst.st_mtime_ns))
+                store.record_file(dest,sh)
+                report(p,"skip")
+                return
+        
+        tmp = "%s.%d-%d.tmp" % (dest,os.getpid(),threading.get_ident())
+        how = clone_file(src,tmp,mode)
+        if how != "hardlink":
+            shutil.copymode(src,tmp)
+            os.utime(tmp,ns=(sst.st_atime_ns,sst.st_mtime_ns))
+        os.replace(tmp,dest)
+        if sh is not None:
+            store.record_file(dest,sh)
+        with lock:
+            stats["copied"] += 1
+            stats["copied_bytes"] += sst.st_size
+        report(p,"copied (%s)" % (how) if how != "copy" else "copied")
+    
+    stats["files"] = len(tasks)
+    if workers <= 1:
+        for p in tasks:
+            merge_file(p)
+    else:
+        # ファイルの読み書きを待つ間に、別のファイルを処理する
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers,initializer=set_op_state,initargs=(op_state(),)) as pool:
+            for fu in [ pool.submit(merge_file,p) for p in tasks ]:
+                fu.result()
+    
+    if mirror:
+        for pdir,dirs,files in os.walk(dest_dir,topdown=True):
+            for en in list(dirs):
+                p = os.path.relpath(os.path.join(pdir,en),dest_dir)
+                if p in entries:
+                    continue
+                dirs.remove(en)
+                if os.path.islink(os.path.join(pdir,en)):
+                    os.remove(os.path.join(pdir,en))
+                else:
+                    remove_tree(os.path.join(pdir,en))
+                stats["deleted"] += 1
+                report(p + "/","deleted")
+            for en in files:
+                p = os.path.relpath(os.path.join(pdir,en),dest_dir)
+                if not p in entries:
+                    os.remove(os.path.join(pdir,en))
+                    stats["deleted"] += 1
+                    report(p,"deleted")
+    
+    store.save()
+    
+    stats["hashed_bytes"] = store.hashed_bytes - hashed
+    trace_count("bytes_copied",stats["copied_bytes"])
+    trace_count("bytes_hashed",stats["hashed_bytes"])
+    print(
+        "%d files, %d copied (%d bytes), %d bytes hashed, %d deleted."
+        % (stats["files"],stats["copied"],stats["copied_bytes"],stats["hashed_bytes"],stats["deleted"])
+    )
+    return stats
+
+def remove_tree(dir):
+    """
+    ディレクトリーツリーを削除し、削除したファイルの合計サイズを返します。
+    
+    - `dir` - ディレクトリーのパス
+    """
+    size = 0
+    for pdir,dirs,files in os.walk(dir,topdown=False):
+        for en in files:
+            p = os.path.join(pdir,en)
+            size += os.lstat(p).st_size
+            os.remove(p)
+        for en in dirs:
+            p = os.path.join(pdir,en)
+            if os.path.islink(p):
+                os.remove(p)
+            else:
+                os.rmdir(p)
+    os.rmdir(dir)
+    return size
+
+def tree_size(path):
+    """
+    ファイル、またはディレクトリーツリーのファイルの合計サイズを返します。
+    
+    - `path` - パス
+    """
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size
+    
+    size = 0
+    with os.scandir(path) as it:
+        for en in it:
+            if en.is_dir(follow_symlinks=False):
+                size += tree_size(en.path)
+            else:
+                size += en.stat(follow_symlinks=False).st_size
+    return size
+
+class TrashBin(object):
+    
+    def __init__(self,dir,workers=4):
+        """
+        新しいTrashBinインスタンスを生成します。
+        
+        - 削除するディレクトリーをゴミ箱へ移動（同じファイルシステム内の rename）して、すぐに戻ります
+        - ゴミ箱の中身は、バックグラウンドのスレッドで並行して削除します
+        - 前回の build.py が削除し終えなかったものも、合わせて削除します
+        
+        - `dir`     - ゴミ箱のディレクトリーパス
+        - `workers` - 削除するスレッドの数
+        """
+        self.__dir     = dir
+        self.__workers = workers
+        self.__cond    = threading.Condition()
+        self.__tasks   = []
+        self.__roots   = {}
+        self.__threads = []
+        self.__started = False
+    
+    def move(self,path):
+        """
+        ファイルやディレクトリーをゴミ箱へ移動し、削除を予約します。
+        
+        - ゴミ箱と別のファイルシステムにある場合は、その場で削除します
+        - トレースを記録している場合は、移動したファイルの合計サイズを bytes_deleted に加算します
+        
+        - `path` - パス
+        """
+        with self.__cond:
+            if not self.__started:
+                self.__started = True
+                os.makedirs(self.__dir,exist_ok=True)
+                # 前回削除し終えなかったもの
+                for en in os.listdir(self.__dir):
+                    self.__submit(os.path.join(self.__dir,en))
+        
+        # サイズを調べるのは stat だけなので、削除より軽い（トレースしない場合は調べない）
+        size = tree_size(path) if getattr(op_local,"trace",None) is not None else 0
+        
+        root = tempfile.mkdtemp(dir=self.__dir)
+        try:
+            os.rename(path,os.path.join(root,os.path.basename(path)))
+            trace_count("bytes_deleted",size)
+        except OSError:
+            os.rmdir(root)
+            if os.path.isdir(path) and not os.path.islink(path):
+                trace_count("bytes_deleted",remove_tree(path))
+            else:
+                trace_count("bytes_deleted",os.lstat(path).st_size)
+                os.remove(path)
+            return
+        
+        with self.__cond:
+            self.__submit(root)
+    
+    def hand_off(self):
+        """
+        削除し終えていないものを、別のプロセス（`rm -rf`）に任せます。
+        
+        - build.py の終了を待たせないために使います
+        """
+        with self.__cond:
+            roots = list(self.__roots.keys())
+            self.__tasks = []
+        if len(roots) == 0:
+            return
+        subprocess.Popen(
+            [ "rm","-rf" ] + roots,
+            stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,start_new_session=True
+        )
+    
+    def __submit(self,root):
+        # 並行して削除できるよう、ディレクトリーをある程度の数に分ける
+        units = [ root ]
+        for _ in range(4):
+            if self.__workers * 4 <= len(units):
+                break
+            subdirs = []
+            for u in units:
+                try:
+                    with os.scandir(u) as it:
+                        subdirs.extend([ en.path for en in it if en.is_dir(follow_symlinks=False) ])
+                except OSError:
+                    pass
+            if len(subdirs) == 0:
+                break
+            units = subdirs
+        
+        self.__roots[root] = len(units)
+        self.__tasks.extend([ (root,u) for u in units ])
+        self.__cond.notify_all()
+        
+        while len(self.__threads) < self.__workers:
+            t = threading.Thread(target=self.__work,daemon=True)
+            t.start()
+            self.__threads.append(t)
+    
+    def __work(self):
+        while True:
+            with self.__cond:
+                while len(self.__tasks) == 0:
+                    self.__cond.wait()
+                root,unit = self.__tasks.pop(0)
+            
+            try:
+                if unit != root:
+                    remove_tree(unit)
+            except OSError:
+                shutil.rmtree(unit,ignore_errors=True)
+            
+            with self.__cond:
+                if not root in self.__roots:
+                    continue
+                self.__roots[root] -= 1
+                if 0 < self.__roots[root]:
+                    continue
+            
+            # 分けたディレクトリーをすべて削除したら、残った親ディレクトリーを削除する
+            shutil.rmtree(root,ignore_errors=True)
+            with self.__cond:
+                del self.__roots[root]
+                self.__cond.notify_all()
+
+# ゴミ箱のディレクトリーパスごとの TrashBin
+TRASH_BINS      = {}
+TRASH_BINS_LOCK = threading.Lock()
+
+def trash_bin(dir):
+    """
+    ゴミ箱を返します。
+    
+    - 同じディレクトリーには、同じインスタンスを返します（常駐サーバーでは、実行要求をまたいで削除を続けます）
+    
+    - `dir` - ゴミ箱のディレクトリーパス
+    """
+    with TRASH_BINS_LOCK:
+        if not dir in TRASH_BINS:
+            TRASH_BINS[dir] = TrashBin(dir)
+        return TRASH_BINS[dir]
+
+def hand_off_trash_bins():
+    """
+    すべてのゴミ箱について、削除し終えていないものを別のプロセスに任せます。
+    """
+    with TRASH_BINS_LOCK:
+        bins = list(TRASH_BINS.values())
+    for t in bins:
+        t.hand_off()
+
+# ioctl(FICLONE) のリクエスト番号（Linux）
+FICLONE = 0x40049409
+
+def clone_file(src,dst,mode="reflink"):
+    """
+    ファイルを複製し、実際に使った方法（reflink / hardlink / copy）を返します。
+    
+    - reflink: ファイルシステムが対応していれば、データを共有したまま複製します（書き換えても元のファイルに影響しません）
+    - hardlink: ハードリンクを作成します。作成できない場合はコピーします
+    - copy: コピーします（copy_file_data）
+    
+    - `src`  - 複製元のファイルのパス
+    - `dst`  - 複製先のファイルのパス
+    - `mode` - 複製の方法
+    """
+    if mode == "hardlink":
+        try:
+            os.link(src,dst)
+            return "hardlink"
+        except OSError:
+            pass
+    elif mode == "reflink":
+        with open(src,"rb") as fi,open(dst,"wb") as fo:
+            try:
+                fcntl.ioctl(fo.fileno(),FICLONE,fi.fileno())
+                return "reflink"
+            except OSError:
+                pass
+    
+    copy_file_data(src,dst)
+    return "copy"
+
+def copy_file_data(src,dst):
+    """
+    ファイルの内容をコピーします。
+    
+    - copy_file_range でカーネル内でコピーします（ファイルシステムによっては、データを共有したり、サーバー側でコピーしたりします）
+    - 使えない場合は shutil.copyfile（Linux では sendfile）でコピーします
+    
+    - `src` - コピー元のファイルのパス
+    - `dst` - コピー先のファイルのパス
+    """
+    if hasattr(os,"copy_file_range"):
+        with open(src,"rb") as fi,open(dst,"wb") as fo:
+            try:
+                size = os.fstat(fi.fileno()).st_size
+                done = 0
+                while done < size:
+                    n = os.copy_file_range(fi.fileno(),fo.fileno(),size - done)
+                    if n == 0:
+                        break
+                    done += n
+                return
+            except OSError:
+                # 別のファイルシステム間（古いカーネル）や、対応していないファイルシステム
+                pass
+    shutil.copyfile(src,dst)
+
+def shallow_file(dir,name):
+    """
+    ディレクトリー直下の成果物のファイル（隠しファイル、ディレクトリー、シンボリックリンクを除く）かどうかを返します。
+    
+    - `dir`  - ディレクトリーのパス
+    - `name` - ファイル名
+    """
+    p = os.path.join(dir,name)
+    return not name.startswith(".") and os.path.isfile(p) and not os.path.islink(p)
+
+class ArtifactCache(object):
+    
+    def __init__(self,dir,max_bytes,mode="reflink",store=None):
+        """
+        新しいArtifactCacheインスタンスを生成します。
+        
+        - 操作の出力を、内容のハッシュで名前を付けたファイル（objects）と、キーごとの一覧（entries）に分けて保存します
+        - 同じ内容のファイルは1つだけ保存します
+        - 合計サイズが max_bytes を超えた場合は、最後に使われたのが古いキーから削除します
+        - 複数の build.py から同時に使えるよう、ファイルロックをかけます
+        
+        - `dir`       - 保存先ディレクトリーのパス
+        - `max_bytes` - 合計サイズの上限
+        - `mode`      - 出力を戻す方法（reflink / hardlink / copy）
+        - `store`     - ファイルのハッシュの記録（FingerprintStore）。指定した場合、サイズと更新日時が同じファイルは読み直しません
+        """
+        self.__dir       = dir
+        self.__max_bytes = max_bytes
+        self.__mode      = mode
+        self.__store     = store
+    
+    def contains(self,key,outputs):
+        """
+        出力が保存されているかどうかを返します。
+        
+        - `key`     - キー
+        - `outputs` - 出力（ファイルまたはディレクトリー）のパスのリスト
+        """
+        with self.__locked(fcntl.LOCK_SH):
+            entry = self.__load_entry(key)
+            return entry is not None and sorted(entry["outputs"].keys()) == sorted(outputs)
+    
+    def restore(self,key,basedir,outputs):
+        """
+        保存した出力を戻します。戻した場合は True、保存されていない場合は False を返します。
+        
+        - 既存の出力は削除してから戻します（直下のファイルだけを保存したディレクトリーは、そのファイルだけを置き換えます）
+        
+        - `key`     - キー
+        - `basedir` - 基準ディレクトリーのパス
+        - `outputs` - 出力（ファイルまたはディレクトリー）のパスのリスト。basedir からの相対パス
+        """
+        with self.__locked(fcntl.LOCK_SH):
+            entry = self.__load_entry(key)
+            if entry is None or sorted(entry["outputs"].keys()) != sorted(outputs):
+                return False
+            
+            used = {}
+            for o,rec in entry["outputs"].items():
+                dst = os.path.join(basedir,o)
+                if rec.get("shallow",False) and os.path.isdir(dst):
+                    # ビルドツールの中間ファイルは残す
+                    for rel in rec["files"].keys():
+                        if os.path.lexists(os.path.join(dst,rel)):
+                            os.remove(os.path.join(dst,rel))
+                elif os.path.isdir(dst) and not os.path.islink(dst):
+                    remove_tree(dst)
+                elif os.path.lexists(dst):
+                    os.remove(dst)
+                
+                for d in rec["dirs"]:
+                    os.makedirs(os.path.join(dst,d),exist_ok=True)
+                for rel,(h,mode,mtime_ns) in rec["files"].items():
+                    p = os.path.normpath(os.path.join(dst,rel))
+                    if not os.path.exists(os.path.dirname(p)):
+                        os.makedirs(os.path.dirname(p))
+                    how = clone_file(self.__object_path(h,mode),p,self.__mode)
+                    used[how] = used.get(how,0) + 1
+                    if how != "hardlink":
+                        os.chmod(p,mode)
+                        os.utime(p,ns=(mtime_ns,mtime_ns))
+                    if self.__store is not None:
+                        self.__store.record_file(p,h)
+            
+            # 使われた日時を更新する（LRU）
+            os.utime(self.__entry_path(key))
+        
+        print("[CACHE] restored %d files (%s)" % (sum(used.values()),", ".join([ "%s %d" % (k,v) for k,v in sorted(used.items()) ])))
+        trace_count("artifact_files_restored",sum(used.values()))
+        return True
+    
+    def store(self,key,basedir,outputs,shallow=False):
+        """
+        出力を保存します。
+        
+        - `key`     - キー
+        - `basedir` - 基準ディレクトリーのパス
+        - `outputs` - 出力（ファイルまたはディレクトリー）のパスのリスト。basedir からの相対パス
+        - `shallow` - True の場合、ディレクトリーは直下のファイル（隠しファイルを除く）だけを保存します
+        """
+        with self.__locked(fcntl.LOCK_EX):
+            entry = { "outputs":{},"size":0 }
+            for o in outputs:
+                src = os.path.join(basedir,o)
+                rec = { "dirs":[],"files":{},"shallow":shallow }
+                if os.path.isfile(src):
+                    pairs = [ (src,".") ]
+                elif shallow:
+                    pairs = [ (os.path.join(src,en),en) for en in sorted(os.listdir(src)) if shallow_file(src,en) ]
+                else:
+                    pairs = []
+                    for pdir,dirs,files in os.walk(src):
+                        for en in dirs:
+                            rec["dirs"].append(os.path.relpath(os.path.join(pdir,en),src))
+                        for en in files:
+                            p = os.path.join(pdir,en)
+                            if os.path.isfile(p) and not os.path.islink(p):
+                                pairs.append((p,os.path.relpath(p,src)))
+                
+                for p,rel in pairs:
+                    st = os.stat(p)
+                    h  = self.__store_object(p,st)
+                    rec["files"][rel] = [ h,st.st_mode & 0o777,st.st_mtime_ns ]
+                    entry["size"] += st.st_size
+                entry["outputs"][o] = rec
+            
+            path = self.__entry_path(key)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = path + ".tmp"
+            with open(tmp,"w") as f:
+                json.dump(entry,f)
+            os.replace(tmp,path)
+            
+            self.__evict()
+    
+    def detach(self,basedir,outputs,shallow=False):
+        """
+        ハードリンクで戻した出力を、書き換えられるコピーに置き換えます。
+        
+        - ビルドツールが出力を書き換える前に呼び出し、保存したファイルが書き換えられないようにします
+        - ハードリンクで戻していない場合は何もしません
+        
+        - `basedir` - 基準ディレクトリーのパス
+        - `outputs` - 出力（ファイルまたはディレクトリー）のパスのリスト。basedir からの相対パス
+        - `shallow` - store() に指定した値
+        """
+        if self.__mode != "hardlink":
+            return
+        
+        count = 0
+        for o in outputs:
+            src = os.path.join(basedir,o)
+            if os.path.isfile(src):
+                paths = [ src ]
+            elif shallow:
+                paths = [ os.path.join(src,en) for en in os.listdir(src) if shallow_file(src,en) ] if os.path.isdir(src) else []
+            else:
+                paths = [ os.path.join(pdir,en) for pdir,_,files in os.walk(src) for en in files ]
+            for p in paths:
+                st = os.lstat(p)
+                # 保存したファイルは読み取り専用にしてある
+                if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2 or st.st_mode & 0o200:
+                    continue
+                tmp = p + ".tmp"
+                shutil.copyfile(p,tmp)
+                os.chmod(tmp,(st.st_mode & 0o777) | 0o200)
+                os.utime(tmp,ns=(st.st_atime_ns,st.st_mtime_ns))
+                os.replace(tmp,p)
+                count += 1
+        
+        if 0 < count:
+            print("[CACHE] detached %d hardlinked files" % (count))
+    
+    def __store_object(self,path,st):
+        h   = digest_of_file(path) if self.__store is None else self.__store.hash_file(path,st)
+        obj = self.__object_path(h,st.st_mode & 0o777)
+        if os.path.exists(obj):
+            return h
+        
+        if not os.path.exists(os.path.dirname(obj)):
+            os.makedirs(os.path.dirname(obj))
+        tmp = obj + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        clone_file(path,tmp,"reflink")
+        # ハードリンクで戻した出力が書き換えられないよう、読み取り専用にする
+        os.chmod(tmp,(st.st_mode & 0o555) | 0o444)
+        os.replace(tmp,obj)
+        return h
+    
+    def __evict(self):
+        entries = []
+        enddir  = os.path.join(self.__dir,"entries")
+        for en in os.listdir(enddir):
+            if en.endswith(".json"):
+                p = os.path.join(enddir,en)
+                entries.append((os.stat(p).st_mtime,p))
+        entries.sort()
+        
+        refs = {}
+        for _,p in entries:
+            refs[p] = self.__objects_of(p)
+        
+        def total():
+            objs = set()
+            for r in refs.values():
+                objs |= r
+            return objs,sum([ os.stat(o).st_size for o in objs if os.path.exists(o) ])
+        
+        objs,size = total()
+        evicted = 0
+        while self.__max_bytes < size and 1 < len(refs):
+            _,p = entries.pop(0)
+            os.remove(p)
+            del refs[p]
+            evicted += 1
+            objs,size = total()
+        
+        # どのキーからも参照されなくなったファイルを削除する
+        objdir = os.path.join(self.__dir,"objects")
+        for pdir,_,files in os.walk(objdir):
+            for en in files:
+                p = os.path.join(pdir,en)
+                if not p in objs:
+                    os.remove(p)
+        
+        if 0 < evicted:
+            print("[CACHE] evicted %d entries (%d bytes in cache)" % (evicted,size))
+    
+    def __objects_of(self,entry_path):
+        try:
+            with open(entry_path,"r") as f:
+                entry = json.load(f)
+        except Exception:
+            return set()
+        objs = set()
+        for rec in entry["outputs"].values():
+            for h,mode,_ in rec["files"].values():
+                objs.add(self.__object_path(h,mode))
+        return objs
+    
+    def __load_entry(self,key):
+        path = self.__entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path,"r") as f:
+                entry = json.load(f)
+        except Exception:
+            return None
+        # 一部のファイルが失われている場合は使わない
+        for rec in entry["outputs"].values():
+            for h,mode,_ in rec["files"].values():
+                if not os.path.exists(self.__object_path(h,mode)):
+                    return None
+        return entry
+    
+    def __entry_path(self,key):
+        return os.path.join(self.__dir,"entries",key + ".json")
+    
+    def __object_path(self,h,mode):
+        # 実行権限の有無で別のファイルにする（ハードリンクはパーミッションを共有するため）
+        return os.path.join(self.__dir,"objects",h[:2],h + (".x" if mode & 0o111 else ""))
+    
+    def __locked(self,op):
+        if not os.path.exists(self.__dir):
+            os.makedirs(self.__dir,exist_ok=True)
+        return FileLock(os.path.join(self.__dir,"lock"),op)
+
+class FileLock(object):
+    
+    def __init__(self,path,op):
+        """
+        新しいFileLockインスタンスを生成します。
+        
+        - with 文の間、ファイルロックをかけます
+        
+        - `path` - ロックファイルのパス
+        - `op`   - ロックの種類（fcntl.LOCK_SH / fcntl.LOCK_EX）
+        """
+        self.__path = path
+        self.__op   = op
+        self.__file = None
+    
+    def __enter__(self):
+        self.__file = open(self.__path,"a")
+        fcntl.flock(self.__file.fileno(),self.__op)
+        return self
+    
+    def __exit__(self,*args):
+        fcntl.flock(self.__file.fileno(),fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
+
+# ゲストへ送らないディレクトリー（.gitignore に関係なく除外する）
+SYNC_EXCLUDES = [ ".git",".trash","target","reports","tmp" ]
+
+def load_ignore_patterns(dir):
+    """
+    .gitignore のパターンを返します。
+    
+    - 否定（`!`）には対応していません
+    
+    - `dir` - プロジェクトのルートディレクトリーのパス
+    """
+    patterns = []
+    path = os.path.join(dir,".gitignore")
+    if os.path.exists(path):
+        with open(path,"r") as f:
+            for l in f:
+                l = l.strip()
+                if l == "" or l.startswith("#") or l.startswith("!"):
+                    continue
+                patterns.append(l)
+    return patterns
+
+def is_ignored(relpath,is_dir,patterns):
+    """
+    .gitignore のパターンに一致するかどうかを返します。
+    
+    - `relpath`  - ルートディレクトリーからの相対パス（区切りは `/`）
+    - `is_dir`   - ディレクトリーかどうか
+    - `patterns` - パターン
+    """
+    for p in patterns:
+        if p.endswith("/"):
+            if not is_dir:
+                continue
+            p = p[:-1]
+        if p.startswith("/"):
+            if fnmatch.fnmatch(relpath,p[1:]):
+                return True
+        elif "/" in p:
+            if fnmatch.fnmatch(relpath,p):
+                return True
+        elif fnmatch.fnmatch(relpath.split("/")[-1],p):
+            return True
+    return False
+
+def project_files(dir,excludes):
+    """
+    ゲストへ送るファイルの、ルートディレクトリーからの相対パスを返します。
+    
+    - `dir`      - プロジェクトのルートディレクトリーのパス
+    - `excludes` - 除外するディレクトリーの、ルートディレクトリーからの相対パス
+    """
+    excludes = SYNC_EXCLUDES + [ e.strip("/") for e in excludes ]
+    patterns = load_ignore_patterns(dir)
+    files    = []
+    
+    def walk(p):
+        with os.scandir(p) as it:
+            for en in it:
+                rel = os.path.relpath(en.path,dir).replace(os.sep,"/")
+                if en.is_dir():
+                    if not rel in excludes and not is_ignored(rel,True,patterns):
+                        walk(en.path)
+                elif en.is_file():
+                    if not is_ignored(rel,False,patterns):
+                        files.append(rel)
+    
+    walk(dir)
+    return files
+
+def sync_to_guest(vbm,hostdir,guestdir,excludes,extra_files,store,state_file):
+    """
+    プロジェクトをゲストのディレクトリーへ差分転送します。
+    
+    - 前回から変わったファイルだけを1つのアーカイブにまとめ、1回の copyto で送り、ゲストで展開します
+    - 前回から削除されたファイルは、ゲストでも削除します
+    - ゲストのディレクトリーが前回送ったものと異なる場合（仮想マシンを作り直したなど）は、すべて送り直します
+    
+    - `vbm`         - 仮想マシン
+    - `hostdir`     - プロジェクトのルートディレクトリーのパス
+    - `guestdir`    - ゲストのディレクトリーのパス
+    - `excludes`    - 除外するディレクトリーの、ルートディレクトリーからの相対パス
+    - `extra_files` - プロジェクト外から追加で送るファイル（ゲストでの相対パスとホストのパス）
+    - `store`       - ハッシュの記録先
+    - `state_file`  - 前回送ったファイルの記録先のパス
+    """
+    state = { "token":None,"files":{} }
+    if os.path.exists(state_file):
+        with open(state_file,"r") as f:
+            state = json.load(f)
+    
+    marker = guestdir + "/.build-py-sync"
+    if state["token"] is None or vbm.shell("test \"$(cat '%s' 2>/dev/null)\" = '%s'" % (marker,state["token"])) != 0:
+        state = { "token":None,"files":{} }
+        if vbm.shell("rm -rf '%s' && mkdir -p '%s'" % (guestdir,guestdir)) != 0:
+            raise Exception("can't prepare guest directory. (%s)" % (guestdir))
+    
+    files   = dict([ (rel,store.hash_file(os.path.join(hostdir,rel))) for rel in project_files(hostdir,excludes) ])
+    changed = [ rel for rel,h in files.items() if state["files"].get(rel) != h ]
+    deleted = [ rel for rel in state["files"] if not rel in files ]
+    token   = hashlib.md5(json.dumps(sorted(files.items())).encode("utf-8")).hexdigest()
+    print("sync to %s:%s (%d changed, %d deleted)" % (vbm.name(),guestdir,len(changed),len(deleted)))
+    
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir,".build-py-deleted"),"w") as f:
+            for rel in deleted:
+                f.write(rel + "\n")
+        with open(os.path.join(tmpdir,".build-py-sync"),"w") as f:
+            f.write(token)
+        
+        archive = os.path.join(tmpdir,"build-py-sync.tar.gz")
+        with tarfile.open(archive,"w|gz") as tar:
+            for rel in changed:
+                tar.add(os.path.join(hostdir,rel),arcname=rel)
+            for rel,path in extra_files:
+                tar.add(path,arcname=rel)
+            tar.add(os.path.join(tmpdir,".build-py-deleted"),arcname=".build-py-deleted")
+            tar.add(os.path.join(tmpdir,".build-py-sync"),arcname=".build-py-sync")
+        
+        vbm.copyto(archive,guestdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    
+    if vbm.shell(
+        "cd '%s' && tar -xzf build-py-sync.tar.gz && tr '\\n' '\\0' < .build-py-deleted | xargs -0 rm -f -- && rm -f build-py-sync.tar.gz .build-py-deleted" % (guestdir)
+    ) != 0:
+        raise Exception("can't extract archive in guest. (%s)" % (guestdir))
+    
+    state = { "token":token,"files":files }
+    if not os.path.exists(os.path.dirname(state_file)):
+        os.makedirs(os.path.dirname(state_file))
+    with open(state_file,"w") as f:
+        json.dump(state,f)
+    trace_count("files_sent",len(changed))
+
+def fetch_release_from_guest(vbm,guestdir,hostdir):
+    """
+    ゲストのリリースビルドの成果物（target/release 直下のファイル）を、1つのアーカイブにまとめて受け取ります。
+    
+    - アーカイブはゲストが作成したものなので、target/release 直下の通常のファイル以外を含む場合は展開せずに例外を送出します
+    
+    - `vbm`      - 仮想マシン
+    - `guestdir` - ゲストのプロジェクトのディレクトリーのパス
+    - `hostdir`  - 出力先ディレクトリーのパス
+    """
+    if vbm.shell(
+        "cd '%s' && find target/release -maxdepth 1 -type f | tar -czf build-py-release.tar.gz -T -" % (guestdir)
+    ) != 0:
+        raise Exception("can't create archive in guest. (%s)" % (guestdir))
+    
+    tmpdir = tempfile.mkdtemp()
+    try:
+        vbm.copyfrom(guestdir + "/build-py-release.tar.gz",tmpdir)
+        with tarfile.open(os.path.join(tmpdir,"build-py-release.tar.gz"),"r:gz") as tar:
+            members = tar.getmembers()
+            for m in members:
+                if not m.isfile() or os.path.dirname(m.name) != "target/release" or os.path.basename(m.name) in [ "",".",".." ]:
+                    raise Exception("unexpected member in release archive. stop. (%s)" % (m.name))
+            if hasattr(tarfile,"data_filter"):
+                tar.extractall(hostdir,members,filter="data")
+            else:
+                tar.extractall(hostdir,members)
+    finally:
+        shutil.rmtree(tmpdir)
+        vbm.shell("rm -f '%s/build-py-release.tar.gz'" % (guestdir))
+
+class InotifyWatcher(object):
+    
+    # inotify のイベント（sys/inotify.h）
+    IN_MODIFY      = 0x00000002
+    IN_ATTRIB      = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_ISDIR       = 0x40000000
+    
+    def __init__(self,paths):
+        """
+        新しいInotifyWatcherインスタンスを生成します。
+        
+        - Linux の inotify でファイルの変更を監視します
+        - ディレクトリーはサブディレクトリーも含めて監視します
+        
+        - `paths` - 監視するファイルまたはディレクトリーのパスのリスト
+        """
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+        self.__fd   = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+        
+        self.__wds   = {}
+        self.__trees = [ p for p in paths if os.path.isdir(p) ]
+        self.__files = set([ p for p in paths if not os.path.isdir(p) ])
+        for p in self.__trees:
+            self.__add_tree(p)
+        for p in self.__files:
+            # ファイルは親ディレクトリーを監視し、イベントを絞り込む
+            self.__add(os.path.dirname(p))
+    
+    def wait(self,timeout):
+        """
+        ファイルが変更されるまで待ち、変更されたパスを返します。タイムアウトした場合は空の集合を返します。
+        
+        - `timeout` - タイムアウトの秒数
+        """
+        changed = set()
+        r,_,_ = select.select([ self.__fd ],[],[],timeout)
+        if len(r) == 0:
+            return changed
+        
+        data = os.read(self.__fd,65536)
+        pos  = 0
+        while pos < len(data):
+            wd,mask,_,size = struct.unpack_from("iIII",data,pos)
+            name = data[pos + 16:pos + 16 + size].rstrip(b"\0").decode("utf-8","replace")
+            pos += 16 + size
+            
+            if not wd in self.__wds:
+                continue
+            p = os.path.join(self.__wds[wd],name)
+            if not self.__watched(p):
+                continue
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.__add_tree(p)
+            changed.add(p)
+        return changed
+    
+    def close(self):
+        """
+        監視を終了します。
+        """
+        os.close(self.__fd)
+    
+    def __watched(self,p):
+        if p in self.__files:
+            return True
+        for t in self.__trees:
+            if p.startswith(t + os.sep):
+                return True
+        return False
+    
+    def __add_tree(self,dir):
+        for pdir,_,_ in os.walk(dir):
+            self.__add(pdir)
+    
+    def __add(self,dir):
+        mask = (
+            self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        )
+        wd = self.__libc.inotify_add_watch(self.__fd,os.fsencode(dir),mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),"inotify_add_watch failed. (%s)" % (dir))
+        self.__wds[wd] = dir
+
+class PollingWatcher(object):
+    
+    def __init__(self,paths,interval=0.5):
+        """
+        新しいPollingWatcherインスタンスを生成します。
+        
+        - inotify が使えない環境向けに、ファイルのサイズと更新日時を定期的に調べて変更を検出します
+        
+        - `paths`    - 監視するファイルまたはディレクトリーのパスのリスト
+        - `interval` - 調べる間隔の秒数
+        """
+        self.__paths    = paths
+        self.__interval = interval
+        self.__snapshot = self.__scan()
+    
+    def wait(self,timeout):
+        """
+        ファイルが変更されるまで待ち、変更されたパスを返します。タイムアウトした場合は空の集合を返します。
+        
+        - `timeout` - タイムアウトの秒数
+        """
+        deadline = time.time() + timeout
+        while True:
+            time.sleep(max(0,min(self.__interval,deadline - time.time())))
+            
+            snapshot = self.__scan()
+            changed  = set([ p for p,s in snapshot.items() if self.__snapshot.get(p) != s ])
+            changed |= set([ p for p in self.__snapshot if not p in snapshot ])
+            self.__snapshot = snapshot
+            if 0 < len(changed) or deadline <= time.time():
+                return changed
+    
+    def close(self):
+        """
+        監視を終了します。
+        """
+        pass
+    
+    def __scan(self):
+        res = {}
+        
+        # エディターの保存（一時ファイルの作成と置き換え）などで、調べている間に消えたものは無視する
+        def walk(p):
+            try:
+                with os.scandir(p) as it:
+                    for en in it:
+                        if en.is_dir():
+                            walk(en.path)
+                        else:
+                            try:
+                                st = en.stat()
+                            except FileNotFoundError:
+                                continue
+                            res[en.path] = (st.st_size,st.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        
+        for p in self.__paths:
+            if os.path.isdir(p):
+                walk(p)
+            else:
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue
+                res[p] = (st.st_size,st.st_mtime_ns)
+        return res
 
-def last_modification_timestamp(dir):
+def create_watcher(paths):
     """
-    ディレクトリーの中にあるもののうち、最後に更新したファイルの日時を返します。
+    ファイルの変更を監視するインスタンスを返します。
     
-    - `dir` - ディレクトリーのパス
+    - inotify が使える場合は InotifyWatcher、使えない場合は PollingWatcher を返します
+    
+    - `paths` - 監視するファイルまたはディレクトリーのパスのリスト
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError,AttributeError):
+            pass
+    return PollingWatcher(paths)
+
+def watch(builder,runnames):
     """
-    t = os.stat(dir).st_mtime
+    入力ファイルを監視し、変更されるたびにサブコマンドを実行します（`build.py --watch`）。
     
-    for en in os.listdir(dir):
-        p = os.path.join(dir,en)
-        s = os.stat(p)
-        if t < s.st_mtime:
-            t = s.st_mtime
-        if os.path.isdir(p):
-            tt = last_modification_timestamp(p)
-            if t < tt:
-                t = tt
-    return t
+    - 短い間に続けて変更された場合は、変更が落ち着いてから実行します
+    - 実行中に変更された場合は、実行中の操作をキャンセルして実行し直します
+    - 入力が変わっていない操作は、前回の結果を使ってスキップします
+    
+    - `builder`  - ビルダー
+    - `runnames` - サブコマンド名のリスト
+    """
+    paths   = builder.watch_paths(runnames)
+    watcher = create_watcher(paths)
+    print("[WATCH] %s: %s" % (type(watcher).__name__,", ".join([ os.path.relpath(p) for p in paths ])))
+    
+    def run(token):
+        try:
+            builder.run(runnames,token)
+            print("[WATCH] done. waiting for changes...")
+        except OpCancelled:
+            print("[WATCH] cancelled.")
+        except Exception as err:
+            print("[WATCH] failed. waiting for changes...\n%s" % (str(err)),file=sys.stderr)
+    
+    token  = CancelToken()
+    worker = threading.Thread(target=run,args=(token,))
+    worker.start()
+    try:
+        while True:
+            changed = watcher.wait(1.0)
+            if len(changed) == 0:
+                continue
+            
+            # 保存が続いている間は待つ
+            while True:
+                more = watcher.wait(0.3)
+                if len(more) == 0:
+                    break
+                changed |= more
+            print("[WATCH] %d changed: %s" % (len(changed),", ".join(sorted([ os.path.relpath(p) for p in changed ])[:5])))
+            
+            token.cancel()
+            worker.join()
+            token  = CancelToken()
+            worker = threading.Thread(target=run,args=(token,))
+            worker.start()
+    except KeyboardInterrupt:
+        token.cancel()
+        worker.join()
+    finally:
+        watcher.close()
 
-def cargo_project_last_modification_timestamp(project_dir):
+def load_build_config(path):
     """
-    cargoプロジェクトの中にあるもののうち、最後に更新したファイルの日時を返します。
+    ビルド設定をロードします。
     
-    - 2021.12.4時点では、次の3つを対象にしています
-      - Cargo.toml
-      - src ディレクトリー
-      - tests ディレクトリー
-    - 今後リソースファイルも対象にする必要がありそうです
+    - `path` - パス
+    """
+    if not os.path.exists(path):
+        raise Exception("build.json not found in `%s`" % (os.path.dirname(path)))
     
-    - `dir` - ディレクトリーのパス
+    try:
+        with open(path,"rb") as f:
+            return json.load(f)
+    except Exception as err:
+        raise Exception("can't load build.json: %s" % (str(err)))
+
+DEFAULT_ENV = {
+    "cargo":"cargo",
+    "report-dir":"reports",
+    "state-dir":".build-py",
+    "vboxmanage":"VBoxManage",
+    "artifact-cache":"~/.cache/build-py/artifacts",
+    "artifact-cache-size":4096,
+    "artifact-cache-mode":"reflink"
+}
+
+def load_environment_config(path):
     """
-    t = os.stat(os.path.join(project_dir,"Cargo.toml")).st_mtime
+    ビルド設定をロードします。
     
-    tgtdirs = [
-        os.path.join(project_dir,"src"),
-        os.path.join(project_dir,"tests")
-    ]
-    for d in tgtdirs:
-        if not os.path.exists(d):
-            continue
-        tt = last_modification_timestamp(d)
-        if tt <= t:
+    - `path` - パス
+    """
+    obj = {}
+    if os.path.exists(path):
+        try:
+            with open(path,"rb") as f:
+                obj = json.load(f)
+        except Exception as err:
+            raise Exception("can't load build.json: %s" % (str(err)))
+    
+    for k,v in DEFAULT_ENV.items():
+        if k in obj:
             continue
-        t = tt
+        obj[k] = v
     
-    return t
+    return obj
 
-def wasm_pack_build(project_dir,out_dir):
+
+def affected_test_targets(project_dir,changed,features=[],required={}):
     """
-    wasm-packでビルドします。
+    変更されたファイルの影響を受けるテストターゲットを、cargo test の引数で返します。すべてのテストを実行する必要がある場合は None を返します。
+    
+    - `tests/<name>.rs`、`tests/<name>/main.rs` 以下は、そのテストターゲットだけに影響します
+    - `examples/<name>.rs` は、そのサンプル（ビルドできるかどうか）だけに影響します
+    - `benches` 以下は、テストに影響しません
+    - それ以外（`src`、`Cargo.toml`、`tests` の共通モジュールなど）は、すべてのテストに影響します
+    - 必要なフィーチャーが有効でないターゲットは、すべてのテストを実行してもビルドされないため、影響を受けません
     
     - `project_dir` - プロジェクトのディレクトリーパス
-    - `out_dir`     - 出力先ディレクトリーのパス
+    - `changed`     - 変更されたファイル（project_dir からの相対パス）
+    - `features`    - 有効にするフィーチャー
+    - `required`    - ターゲットごとに必要なフィーチャー（Cargo.required_features() の戻り値）
     """
-    args = [
-        "wasm-pack","build","--release","--target","web","--out-name","wasm","--out-dir",out_dir
-    ]
-    env = os.environ
-    env["RUSTFLAGS"] = "--cfg=web_sys_unstable_apis"
+    targets = []
+    for p in changed:
+        parts = p.replace(os.sep,"/").split("/")
+        if parts[0] == "benches":
+            continue
+        elif parts[0] == "tests" and len(parts) == 2 and parts[1].endswith(".rs"):
+            a = [ "--test",parts[1][:-3] ]
+        elif parts[0] == "tests" and 2 < len(parts) and os.path.exists(os.path.join(project_dir,"tests",parts[1],"main.rs")):
+            a = [ "--test",parts[1] ]
+        elif parts[0] == "examples" and len(parts) == 2 and parts[1].endswith(".rs"):
+            a = [ "--example",parts[1][:-3] ]
+        else:
+            return None
+        
+        if not all(f in features for f in required.get((a[0][2:],a[1]),[])):
+            continue
+        if not a in targets:
+            targets.append(a)
+    return [ v for a in targets for v in a ]
+
+def partition_by_timing(names,timings,n):
+    """
+    テストを、実行時間の合計がなるべく均等になるように n 個に分けます。
     
-    try:
-        st = subprocess.run(args,stdout=sys.stdout,stderr=sys.stderr,cwd=project_dir,env=env)
-        if st.returncode != 0:
-            raise Exception("error occurred. stop. (%d)" % (st.returncode))
-    finally:
-        del env["RUSTFLAGS"]
+    - 実行時間の長いテストから順に、合計が最も短いグループに入れます
+    - 実行時間が分からないテストは、分かっているテストの平均とみなします
+    
+    - `names`   - テスト名のリスト
+    - `timings` - テストごとの実行時間
+    - `n`       - 分ける数
+    """
+    known = [ timings[t] for t in names if t in timings ]
+    avg   = sum(known) / len(known) if 0 < len(known) else 1.0
+    
+    heap   = [ (0.0,i) for i in range(min(n,len(names))) ]
+    groups = [ [] for _ in heap ]
+    for t in sorted(names,key=lambda t: timings.get(t,avg),reverse=True):
+        total,i = heapq.heappop(heap)
+        groups[i].append(t)
+        heapq.heappush(heap,(total + timings.get(t,avg),i))
+    return groups
 
-def run_command(basedir,args,env):
+def run_parallel(funcs,use_jobserver=False):
     """
-    コマンドを実行します。
+    関数をそれぞれ別のスレッドで実行し、すべての戻り値を返します。
     
-    - `basedir` - 基準ディレクトリーのパス
-    - `args`    - コマンド
-    - `env`     - 環境変数
+    - 実行中の操作の情報（キャンセルトークン、出力の接頭辞など）を引き継ぎます
+    - `use_jobserver` が True でジョブサーバーがある場合、それぞれの関数はトークンを受け取ってから実行します
+      - 呼び出したスレッドのトークンは関数に貸し出すため、パイプが空でも1つずつ実行されます
+      - ホストの CPU を使う処理だけに指定します。仮想マシンでのビルドや、同時に動かすこと自体が目的の処理には指定しません
+    - いずれかが例外を送出した場合は、すべての終了を待ってから最初の例外を送出します
+    
+    - `funcs`         - 関数のリスト
+    - `use_jobserver` - ジョブサーバーのトークンを受け取ってから実行するかどうか
     """
+    state   = op_state()
+    results = [ None ] * len(funcs)
+    errors  = []
     
-    ekv = os.environ
-    for k,v in env.items():
-        ekv[k] = v
+    jobserver = state["jobserver"] if use_jobserver else None
+    
+    def work(i,func):
+        set_op_state(state)
+        held = False
+        b    = None
+        try:
+            if jobserver is not None:
+                b    = jobserver.acquire(state["token"])
+                held = True
+            results[i] = func()
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            if held:
+                jobserver.release(b)
     
+    threads = [ threading.Thread(target=work,args=(i,f)) for i,f in enumerate(funcs) ]
+    if jobserver is not None:
+        jobserver.lend()
     try:
-        st = subprocess.run(args,stdout=sys.stdout,stderr=sys.stderr,cwd=basedir,env=ekv)
-        if st.returncode != 0:
-            raise Exception("error occurred. stop. (%d)" % (st.returncode))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
     finally:
-        for k in env.keys():
-            del ekv[k]
+        if jobserver is not None:
+            jobserver.reclaim()
+    
+    if 0 < len(errors):
+        raise errors[0]
+    return results
 
-def md5_of_file(file):
-    md5 = hashlib.md5()
-    with open(file,"rb") as f:
-        md5.update(f.read(4096))
-    return md5.hexdigest()
+def stress_report(results,kind,processes,threads,count):
+    """
+    stress の結果をまとめたレポートを返します。
+    
+    - `results`   - プロセスごとの結果
+    - `kind`      - 作成したもの（file / dir）
+    - `processes` - プロセスの数
+    - `threads`   - プロセスあたりのスレッドの数
+    - `count`     - スレッドあたりの作成数
+    """
+    latencies = sorted([ l for r in results for l in r["latencies"] ])
+    created   = sum([ r["created"] for r in results ])
+    elapsed   = max([ r["finished_at"] for r in results ]) - min([ r["started_at"] for r in results ])
+    
+    def percentile(p):
+        if len(latencies) == 0:
+            return 0
+        return latencies[min(len(latencies) - 1,int(len(latencies) * p / 100))] / 1000
+    
+    return {
+        "kind":kind,"processes":processes,"threads":threads,"count":count,
+        "created":created,
+        "failures":sum([ r["failures"] for r in results ]),
+        "retries":sum([ r["retries"] for r in results ]),
+        "elapsed":elapsed,
+        "overlap":min([ r["finished_at"] for r in results ]) - max([ r["started_at"] for r in results ]),
+        "creations_per_sec":created / elapsed if 0 < elapsed else 0,
+        "latency_us":{ "p50":percentile(50),"p99":percentile(99),"max":percentile(100) }
+    }
 
-def merge_tree(source_dir,dest_dir):
+def query_main(mydir,envs,argv):
     """
-    ディレクトリーツリーをマージします。
+    テストの実行履歴を調べます（`build.py query ...`）。
     
-    - `source_dir` - マージ元のディレクトリー
-    - `dest_dir`   - マージ先のディレクトリー
+    - `mydir` - プロジェクトのルートディレクトリーのパス
+    - `envs`  - 環境設定（env.json）
+    - `argv`  - コマンドライン引数
     """
-    print("%s to %s" % (source_dir,dest_dir))
+    ap = argparse.ArgumentParser(prog="build.py query",description="cargo-test の実行履歴を調べます")
+    ap.add_argument("kind",choices=[ "slowest","regressions","flaky" ],help="slowest: 遅いテスト, regressions: 遅くなったテスト, flaky: 不安定なテスト")
+    ap.add_argument("--limit",type=int,default=20,help="表示する件数を指定します（slowest）")
+    ap.add_argument("--threshold",type=float,default=20,help="遅くなったとみなす割合(%%)を指定します（regressions）")
+    ap.add_argument("--window",type=int,default=10,help="対象にする直近の実行の数を指定します")
+    ap.add_argument("--report-dir",default=envs["report-dir"],help="cargo-test の report-dir を指定します")
+    ap.add_argument("--features",help="対象にする実行のフィーチャーをカンマ区切りで指定します（既定値は最後に記録した実行のフィーチャー）")
+    ap.add_argument("--filter",default="",help="対象にする実行のテストの絞り込み（`--test <name>` など）を指定します（既定値はすべてのテストを実行したもの）")
+    qargs = ap.parse_args(argv)
     
-    if not os.path.exists(dest_dir):
-        os.mkdir(dest_dir)
+    path = os.path.join(mydir,envs["state-dir"],qargs.report_dir,"history.sqlite3")
+    if not os.path.exists(path):
+        print("no test history. (%s)" % (path),file=sys.stderr)
+        return 1
     
-    for pdir,dirs,files in os.walk(source_dir):
-        for en in dirs:
-            p = os.path.relpath(os.path.join(pdir,en),source_dir)
-            print("%-32s   " % (p + "/"),end="")
-            dest = os.path.join(dest_dir,p)
-            
-            if not os.path.exists(dest):
-                os.mkdir(dest)
-                print("created")
-            else:
-                print("skip")
+    history = TestHistory(path)
+    if qargs.features is None:
+        features = history.latest_features()
+    else:
+        features = [ f for f in qargs.features.split(",") if f != "" ]
+    print("features: %s, filter: %s" % (",".join(features) or "(none)",qargs.filter or "(all tests)"))
+    
+    if qargs.kind == "slowest":
+        for target,name,avg,mx,n in history.slowest(qargs.limit,qargs.window,features,qargs.filter):
+            print("%10.3f s  (max %.3f s, %d runs)  %s (%s)" % (avg,mx,n,name,target))
+    elif qargs.kind == "regressions":
+        for target,name,base,latest,ratio in history.regressions(qargs.threshold,qargs.window,features,qargs.filter):
+            print("%+8.1f %%  %.3f s -> %.3f s  %s (%s)" % (ratio,base,latest,name,target))
+    else:
+        for target,name,ok,failed,commits in history.flaky(qargs.window,features,qargs.filter):
+            print("%3d ok  %3d failed  (%d commits)  %s (%s)" % (ok,failed,commits,name,target))
+    return 0
+
+def resolve_ops(cmds):
+    """
+    build.json の操作リストに、依存関係を付けて返します。
+    
+    - `id` を省略した操作には `<op>#<インデックス>` を割り当てます
+    - `needs` を省略した操作は直前の操作に依存します（従来どおり、順番に実行されます）
+    - 並行実行してよい操作には `needs` を明示します（依存しない場合は `[]`）
+    
+    - `cmds` - 操作リスト
+    """
+    nodes = []
+    ids   = set()
+    prev  = None
+    for i,cmd in enumerate(cmds):
+        id = cmd["id"] if "id" in cmd else "%s#%d" % (cmd["op"],i)
+        if id in ids:
+            raise Exception("duplicate op id. (%s)" % (id))
+        ids.add(id)
         
-        for en in files:
-            src = os.path.join(pdir,en)
-            p = os.path.relpath(src,source_dir)
-            print("%-32s   " % (p),end="")
-            dest = os.path.join(dest_dir,p)
+        if "needs" in cmd:
+            needs = list(cmd["needs"])
+        else:
+            needs = [] if prev is None else [ prev ]
+        
+        nodes.append({ "id":id,"cmd":cmd,"needs":needs })
+        prev = id
+    
+    for n in nodes:
+        for d in n["needs"]:
+            if not d in ids:
+                raise Exception("unknown op id in needs. (%s -> %s)" % (n["id"],d))
+    
+    return topological_sort(nodes)
+
+def merge_ops(scripts,runnames):
+    """
+    複数のサブコマンドの操作リストを1つにまとめ、依存関係の順に返します。
+    
+    - サブコマンドは指定した順に実行します（依存する操作がない操作は、前のサブコマンドのすべての操作に依存します）
+    - 先に指定したサブコマンドに操作名と引数が同じ操作がある場合は、その操作の結果を使います（共有した操作の id を `shared` に記録します）
+      - delete を含むサブコマンドより前の操作は、結果が削除されている可能性があるため共有しません
+    - 複数のサブコマンドを指定した場合、操作の id は `<サブコマンド名>/<id>` になります（2回目以降は `<サブコマンド名>#<回数>/<id>`）
+    
+    - `scripts`  - ビルド設定（build.json）
+    - `runnames` - サブコマンド名のリスト
+    """
+    if len(runnames) == 1:
+        return resolve_ops(scripts[runnames[0]])
+    
+    nodes  = []
+    first  = {}
+    prev   = []
+    counts = {}
+    for name in runnames:
+        counts[name] = counts.get(name,0) + 1
+        label = name if counts[name] == 1 else "%s#%d" % (name,counts[name])
+        
+        # サブコマンド内の id -> まとめた操作リストでの id のリスト
+        alias = {}
+        for n in resolve_ops(scripts[name]):
+            needs = []
+            for d in n["needs"]:
+                needs += [ a for a in alias[d] if not a in needs ]
+            if len(n["needs"]) == 0:
+                needs += [ p for p in prev if not p in needs ]
             
-            smd5 = md5_of_file(src)
-            dmd5 = md5_of_file(dest) if os.path.exists(dest) else None
-            if smd5 == dmd5:
-                print("skip")
+            id  = "%s/%s" % (label,n["id"])
+            key = op_key(n["cmd"])
+            if key in first and first[key][0] != label:
+                origin = first[key][1]
+                origin["shared"].append(id)
+                alias[n["id"]] = [ origin["id"] ] + [ d for d in needs if d != origin["id"] ]
                 continue
             
-            shutil.copyfile(src,dest)
-            print("copied")
+            node = { "id":id,"cmd":n["cmd"],"needs":needs,"shared":[] }
+            first.setdefault(key,(label,node))
+            alias[n["id"]] = [ id ]
+            nodes.append(node)
+        
+        prev = []
+        for ids in alias.values():
+            prev += [ a for a in ids if not a in prev ]
+        if any([ cmd["op"] == "delete" for cmd in scripts[name] ]):
+            first = {}
+    
+    return nodes
 
-def load_build_config(path):
+def topological_sort(nodes):
     """
-    ビルド設定をロードします。
+    操作を依存関係の順に並べ替えます。
     
-    - `path` - パス
+    - 依存関係のない操作どうしは、元の順番を保ちます
+    
+    - `nodes` - 操作リスト
     """
-    if not os.path.exists(path):
-        raise Exception("build.json not found in `%s`" % (os.path.dirname(path)))
+    done   = set()
+    sorted = []
+    rest   = list(nodes)
+    while 0 < len(rest):
+        ready = [ n for n in rest if all(d in done for d in n["needs"]) ]
+        if len(ready) == 0:
+            raise Exception("circular dependency in needs. (%s)" % (", ".join([ n["id"] for n in rest ])))
+        for n in ready:
+            done.add(n["id"])
+            sorted.append(n)
+            rest.remove(n)
+    return sorted
+
+def estimate_schedule(nodes,durations,jobs):
+    """
+    操作リストの実行時間を見積もり、合計時間とクリティカルパスの組を返します。
     
-    try:
-        with open(path,"rb") as f:
-            return json.load(f)
-    except Exception as err:
-        raise Exception("can't load build.json: %s" % (str(err)))
+    - 合計時間は、OpScheduler と同じく、依存する操作が終わったものから順に jobs 個まで並行実行するとして求めます
+    - クリティカルパスは、依存関係をたどって実行時間の合計が最も長くなる操作の id のリストです
+    
+    - `nodes`     - 操作リスト
+    - `durations` - 操作の id と実行時間（秒）の辞書
+    - `jobs`      - 並行実行する操作の最大数
+    """
+    nodes = topological_sort(nodes)
+    
+    finish = {}
+    prev   = {}
+    for n in nodes:
+        start = 0.0
+        for d in n["needs"]:
+            if start <= finish[d]:
+                start = finish[d]
+                prev[n["id"]] = d
+        finish[n["id"]] = start + durations[n["id"]]
+    
+    path = []
+    id   = max(nodes,key=lambda n: finish[n["id"]])["id"] if 0 < len(nodes) else None
+    while id is not None:
+        path.insert(0,id)
+        id = prev.get(id)
+    
+    clock   = 0.0
+    pending = list(nodes)
+    running = []
+    done    = set()
+    while 0 < len(pending) or 0 < len(running):
+        for n in list(pending):
+            if max(jobs,1) <= len(running):
+                break
+            if all(d in done for d in n["needs"]):
+                pending.remove(n)
+                heapq.heappush(running,(clock + durations[n["id"]],n["id"]))
+        clock,id = heapq.heappop(running)
+        done.add(id)
+    return (clock,path)
 
-DEFAULT_ENV = {
-    "cargo":"cargo"
-}
+class Tracer(object):
+    
+    def __init__(self):
+        """
+        新しいTracerインスタンスを生成します。
+        
+        - 操作ごとに、開始・終了日時、実行したプロセス（コマンド、終了コード、最大メモリー使用量）、カウンターを記録します
+        """
+        self.__lock    = threading.Lock()
+        self.__records = []
+        self.__threads = {}
+    
+    def begin(self,node):
+        """
+        操作の記録を開始し、記録を返します。
+        
+        - `node` - 操作
+        """
+        rec = {
+            "id":node["id"],"op":node["cmd"]["op"],"start":time.time(),"end":None,"status":None,
+            "processes":[],"counters":{},"lock":threading.Lock()
+        }
+        with self.__lock:
+            rec["tid"] = self.__threads.setdefault(threading.get_ident(),len(self.__threads) + 1)
+            self.__records.append(rec)
+        return rec
+    
+    def end(self,rec,status):
+        """
+        操作の記録を終了します。
+        
+        - `rec`    - 記録
+        - `status` - 結果（ok / restored / skipped / failed / cancelled）
+        """
+        rec["end"]    = time.time()
+        rec["status"] = status
+    
+    def records(self):
+        """
+        記録を返します。
+        """
+        with self.__lock:
+            return [ dict([ (k,v) for k,v in r.items() if k != "lock" ]) for r in self.__records ]
+    
+    def save(self,path):
+        """
+        記録を保存します。
+        
+        - 拡張子が .jsonl の場合は1操作1行の JSON、それ以外は Chrome のトレースイベント形式で保存します
+        
+        - `path` - 保存先ファイルのパス
+        """
+        records = self.records()
+        with open(path,"w") as f:
+            if path.endswith(".jsonl"):
+                for r in records:
+                    f.write(json.dumps(r) + "\n")
+                return
+            
+            pid    = os.getpid()
+            events = []
+            for r in records:
+                if r["end"] is None:
+                    continue
+                maxrss = [ p["maxrss"] for p in r["processes"] if p["maxrss"] is not None ]
+                args   = { "status":r["status"] }
+                args.update(r["counters"])
+                if 0 < len(maxrss):
+                    args["peak_rss_kib"] = max(maxrss)
+                events.append({
+                    "name":r["id"],"cat":r["op"],"ph":"X","pid":pid,"tid":r["tid"],
+                    "ts":r["start"] * 1000000,"dur":(r["end"] - r["start"]) * 1000000,"args":args
+                })
+                for p in r["processes"]:
+                    events.append({
+                        "name":os.path.basename(p["args"][0]),"cat":"process","ph":"X","pid":pid,"tid":r["tid"],
+                        "ts":p["start"] * 1000000,"dur":(p["end"] - p["start"]) * 1000000,
+                        "args":{
+                            "cmd":" ".join(p["args"]),"exit_code":p["returncode"],
+                            "max_rss_kib":p["maxrss"],"max_rss_self_kib":p["maxrss_self"]
+                        }
+                    })
+            json.dump({ "traceEvents":events,"displayTimeUnit":"ms" },f)
 
-def load_environment_config(path):
+class OpScheduler(object):
+    
+    def __init__(self,jobs):
+        """
+        新しいOpSchedulerインスタンスを生成します。
+        
+        - `jobs` - 並行実行する操作の最大数
+        """
+        self.__jobs = max(1,jobs)
+    
+    def run(self,nodes,execute,token=None):
+        """
+        依存関係を守りながら操作を実行します。
+        
+        - 並行実行する場合、操作の出力には `[<id>] ` の接頭辞を付けます
+        - ジョブサーバーがある場合、それぞれの操作はトークンを受け取ってから実行します（build.py のトークンは操作に貸し出します）
+        - いずれかの操作が失敗した場合、実行中の操作をキャンセルし、以降の操作は開始しません
+        
+        - `nodes`   - 依存関係の順に並んだ操作リスト
+        - `execute` - 操作を実行する関数
+        - `token`   - キャンセルトークン。外部から実行をキャンセルする場合に指定します
+        """
+        if token is None:
+            token = CancelToken()
+        if self.__jobs == 1:
+            op_local.token = token
+            try:
+                for n in nodes:
+                    if token.cancelled():
+                        raise OpCancelled()
+                    execute(n)
+            finally:
+                op_local.token = None
+            return
+        
+        install_console()
+        
+        state     = op_state()
+        cond      = threading.Condition()
+        pending   = list(nodes)
+        running   = {}
+        done      = set()
+        errors    = []
+        jobserver = state["jobserver"]
+        
+        def work(node):
+            set_op_state(state)
+            op_local.token  = token
+            op_local.prefix = "[%s] " % (node["id"])
+            err  = None
+            held = False
+            b    = None
+            try:
+                if jobserver is not None:
+                    b    = jobserver.acquire(token)
+                    held = True
+                execute(node)
+            except BaseException as e:
+                err = e
+            finally:
+                if held:
+                    jobserver.release(b)
+                sys.stdout.flush_line()
+                sys.stderr.flush_line()
+            
+            with cond:
+                del running[node["id"]]
+                if err is None:
+                    done.add(node["id"])
+                elif isinstance(err,OpCancelled):
+                    print("cancelled.",file=sys.stderr)
+                else:
+                    errors.append(err)
+                    token.cancel()
+                cond.notify_all()
+        
+        if jobserver is not None:
+            jobserver.lend()
+        try:
+            with cond:
+                while True:
+                    if len(errors) == 0 and not token.cancelled():
+                        for n in list(pending):
+                            if self.__jobs <= len(running):
+                                break
+                            if not all(d in done for d in n["needs"]):
+                                continue
+                            pending.remove(n)
+                            t = threading.Thread(target=work,args=(n,))
+                            running[n["id"]] = t
+                            t.start()
+                    if len(running) == 0:
+                        break
+                    cond.wait()
+        except BaseException:
+            token.cancel()
+            for t in list(running.values()):
+                t.join()
+            raise
+        finally:
+            if jobserver is not None:
+                jobserver.reclaim()
+        
+        if 0 < len(errors):
+            raise errors[0]
+        if token.cancelled():
+            raise OpCancelled()
+
+SUPPORTED_OPS = [
+    "cargo-build","cargo-run","cargo-test","cargo-bench","cargo-doc","stress","mkdir","copy","delete","wasm-pack","command",
+    "virtual-box-open","virtual-box-close","virtual-box-command","virtual-box-cargo-build"
+]
+
+# 操作の既定の入力（args["dir"] からの相対パス）
+CARGO_INPUTS      = [ "Cargo.toml","Cargo.lock","build.rs","src" ]
+CARGO_TEST_INPUTS = CARGO_INPUTS + [ "tests","examples" ]
+
+# 出力を ArtifactCache に保存する操作
+ARTIFACT_OPS = [ "cargo-build","wasm-pack" ]
+
+# 操作の結果に影響する環境変数
+ENV_INPUTS = [ "RUSTFLAGS","RUSTDOCFLAGS","RUSTC_BOOTSTRAP","RUSTUP_TOOLCHAIN","CARGO_TARGET_DIR","CARGO_BUILD_TARGET" ]
+
+# --plan の状態と、実行時間の記録（トレースの結果）の対応
+PLAN_STATUSES = { "up-to-date":"skipped","cached":"restored","run":"ok" }
+
+def op_key(cmd):
     """
-    ビルド設定をロードします。
+    操作を識別するキーを返します。
+    
+    - 操作名と引数が同じであれば、同じキーになります
+    
+    - `cmd` - 操作
+    """
+    return hashlib.md5(json.dumps({ "op":cmd["op"],"args":cmd["args"] },sort_keys=True).encode("utf-8")).hexdigest()
+
+class Builder(object):
+    
+    def __init__(self,mydir,scripts,envs,options,store=None,vms=None):
+        """
+        新しいBuilderインスタンスを生成します。
+        
+        - `mydir`   - プロジェクトのルートディレクトリーのパス
+        - `scripts` - ビルド設定（build.json）
+        - `envs`    - 環境設定（env.json）
+        - `options` - コマンドライン引数
+        - `store`   - 入力のハッシュの記録先。None の場合は新しく読み込みます
+        - `vms`     - 仮想マシンのセッション。None の場合は新しく作成します
+        """
+        if store is None:
+            store = FingerprintStore(os.path.join(mydir,envs["state-dir"],"cache","fingerprints.json"))
+        if vms is None:
+            vms = VirtualBoxRegistry(envs["vboxmanage"])
+        
+        self.__mydir   = mydir
+        self.__scripts = scripts
+        self.__envs    = envs
+        self.__options = options
+        self.__store   = store
+        self.__tracer  = Tracer()
+        self.__history = OpHistory(os.path.join(mydir,envs["state-dir"],"cache","ops.sqlite3"))
+        self.__vms     = vms
+        
+        self.__artifacts = None
+        if envs["artifact-cache"] is not None:
+            self.__artifacts = ArtifactCache(
+                os.path.expanduser(envs["artifact-cache"]),envs["artifact-cache-size"] * 1024 * 1024,envs["artifact-cache-mode"],store
+            )
+    
+    def plan(self,runnames):
+        """
+        サブコマンドの操作リストを、依存関係の順に返します。
+        
+        - `runnames` - サブコマンド名のリスト
+        """
+        nodes = merge_ops(self.__scripts,runnames)
+        for n in nodes:
+            if not n["cmd"]["op"] in SUPPORTED_OPS:
+                raise UnsupportedOpError(n["cmd"]["op"])
+        return nodes
+    
+    def run(self,runnames,token=None):
+        """
+        サブコマンドを実行します。
+        
+        - `runnames` - サブコマンド名のリスト
+        - `token`    - キャンセルトークン
+        """
+        nodes = self.plan(runnames)
+        for n in nodes:
+            if 0 < len(n.get("shared",[])):
+                print("[SHARED] %s (%s): %s" % (n["cmd"]["op"],n["id"],", ".join(n["shared"])))
+        
+        # make から起動された場合は make のジョブサーバーを使う
+        jobserver = Jobserver.from_environ(os.environ)
+        if jobserver is None:
+            jobserver = Jobserver(self.__options.cpus or os.cpu_count() or 1)
+        op_local.jobserver = jobserver
+        keys  = dict([ (n["id"],op_key(n["cmd"])) for n in nodes ])
+        begin = len(self.__tracer.records())
+        try:
+            OpScheduler(self.__options.jobs).run(nodes,self.execute,token)
+            self.__report_estimates(nodes,keys,self.__tracer.records()[begin:])
+        finally:
+            op_local.jobserver = None
+            jobserver.close()
+            self.__history.record(self.__tracer.records()[begin:],keys,git_commit(self.__mydir))
+            if self.__options.trace is not None:
+                self.__tracer.save(self.__options.trace)
+    
+    def dry_run(self,runnames):
+        """
+        サブコマンドを実行せずに、操作ごとの状態と見積もった実行時間、クリティカルパスを表示します。
+        
+        - 状態は up-to-date（スキップ）、cached（保存した出力を戻す）、run（実行）のいずれかです
+        - 実行時間は、同じ状態で実行したときの直近 `--plan-window` 回の中央値です
+        
+        - `runnames` - サブコマンド名のリスト
+        """
+        nodes    = self.plan(runnames)
+        statuses = dict([ (n["id"],self.__check(n)["status"]) for n in nodes ])
+        medians  = self.__history.medians(
+            [ (op_key(n["cmd"]),PLAN_STATUSES[statuses[n["id"]]]) for n in nodes ],self.__options.plan_window
+        )
+        
+        durations = {}
+        unknown   = 0
+        for n in nodes:
+            d = medians.get((op_key(n["cmd"]),PLAN_STATUSES[statuses[n["id"]]]))
+            if d is None:
+                unknown += 1
+            durations[n["id"]] = d or 0.0
+            print("%-10s %10s  %s (%s)" % (
+                statuses[n["id"]],"?" if d is None else "%.2f s" % (d),n["cmd"]["op"],n["id"]
+            ))
+        
+        total,path = estimate_schedule(nodes,durations,self.__options.jobs)
+        print("estimated total: %.2f s (-j%d, serial %.2f s)" % (total,self.__options.jobs,sum(durations.values())))
+        print("critical path: %.2f s  %s" % (sum([ durations[id] for id in path ])," -> ".join(path)))
+        if 0 < unknown:
+            print("%d ops have no history and are counted as 0 s." % (unknown))
+    
+    def __report_estimates(self,nodes,keys,records):
+        """
+        操作ごとに、見積もった実行時間と実際の実行時間を表示します。
+        
+        - 見積もりは、実行結果と同じ状態で実行したときの直近 `--plan-window` 回の中央値です
+        - 1つも見積もれない場合（初回の実行など）は表示しません
+        - 合計時間の見積もりでは、見積もれない操作には実際の実行時間を使います
+        
+        - `nodes`   - 操作リスト
+        - `keys`    - 操作の id と op_key() の辞書
+        - `records` - 今回の実行のトレースの記録
+        """
+        records = dict([ (r["id"],r) for r in records if r["status"] in PLAN_STATUSES.values() ])
+        medians = self.__history.medians(
+            [ (keys[id],r["status"]) for id,r in records.items() ],self.__options.plan_window
+        )
+        if len(medians) == 0:
+            return
+        
+        estimated = {}
+        for n in nodes:
+            r = records.get(n["id"])
+            if r is None:
+                continue
+            actual = r["end"] - r["start"]
+            d = medians.get((keys[n["id"]],r["status"]))
+            estimated[n["id"]] = actual if d is None else d
+            if d is None:
+                print("[PLAN] %-8s %10s -> %8.2f s  %s (%s)" % (r["status"],"?",actual,n["cmd"]["op"],n["id"]))
+            else:
+                print("[PLAN] %-8s %8.2f s -> %8.2f s (%+.2f s)  %s (%s)" % (
+                    r["status"],d,actual,actual - d,n["cmd"]["op"],n["id"]
+                ))
+        
+        done = [ n for n in nodes if n["id"] in estimated ]
+        if len(done) == len(nodes):
+            start = min([ r["start"] for r in records.values() ])
+            end   = max([ r["end"] for r in records.values() ])
+            total,_ = estimate_schedule(nodes,estimated,self.__options.jobs)
+            print("[PLAN] total %.2f s -> %.2f s (%+.2f s)" % (total,end - start,end - start - total))
     
-    - `path` - パス
-    """
-    obj = {}
-    if os.path.exists(path):
+    def watch_paths(self,runnames):
+        """
+        サブコマンドの操作の入力のうち、存在するもののパスを返します。
+        
+        - `runnames` - サブコマンド名のリスト
+        """
+        paths = []
+        for n in self.plan(runnames):
+            spec = self.__cache_spec(n["cmd"])
+            if spec is not None:
+                inputs = spec["inputs"]
+            elif "dir" in n["cmd"]["args"]:
+                inputs = [ os.path.join(n["cmd"]["args"]["dir"],i) for i in CARGO_TEST_INPUTS ]
+            else:
+                continue
+            for i in inputs:
+                p = os.path.normpath(os.path.join(self.__mydir,i))
+                if os.path.exists(p) and not p in paths:
+                    paths.append(p)
+        return paths
+    
+    def execute(self,node):
+        """
+        操作を実行します。
+        
+        - 実行の様子をトレースに記録します
+        
+        - `node` - 操作
+        """
+        rec    = self.__tracer.begin(node)
+        status = "failed"
+        op_local.trace = rec
         try:
-            with open(path,"rb") as f:
-                obj = json.load(f)
-        except Exception as err:
-            raise Exception("can't load build.json: %s" % (str(err)))
+            status = self.__execute_if_needed(node)
+        except OpCancelled:
+            status = "cancelled"
+            raise
+        finally:
+            op_local.trace = None
+            self.__tracer.end(rec,status)
     
-    for k,v in DEFAULT_ENV.items():
-        if k in obj:
-            continue
-        obj[k] = v
+    def __execute_if_needed(self,node):
+        """
+        操作を実行し、結果（ok / restored / skipped）を返します。
+        
+        - 入力と出力が分かる操作は、前回成功したときから入力が変わっておらず、出力がそろっている場合はスキップします
+        
+        - `node` - 操作
+        """
+        cmd   = node["cmd"]
+        check = self.__check(node)
+        if check["status"] == "up-to-date":
+            print("[SKIP] %s (%s: up to date)" % (cmd["op"],node["id"]))
+            return "skipped"
+        if check["spec"] is None:
+            self.__execute(cmd)
+            return "ok"
+        
+        # 同じ入力でビルドしたことがあれば、保存した出力を戻す
+        spec     = check["spec"]
+        artifact = check["artifact"]
+        status   = "ok"
+        if check["status"] == "cached" and self.__artifacts.restore(artifact,self.__mydir,spec["outputs"]):
+            print("[CACHE] %s (%s: restored)" % (cmd["op"],node["id"]))
+            status = "restored"
+        else:
+            if artifact is not None:
+                self.__artifacts.detach(self.__mydir,spec["outputs"],spec["shallow"])
+            self.__execute(cmd)
+            if artifact is not None:
+                self.__artifacts.store(artifact,self.__mydir,spec["outputs"],spec["shallow"])
+        
+        # 実行中に入力が変更された場合に次回検出できるよう、実行前のダイジェストを記録する
+        self.__store.record_op(check["key"],check["digest"],check["files"])
+        return status
     
-    return obj
-
-if __name__ == "__main__":
-    ap = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog=textwrap.dedent('''\
-            build.json にサブコマンドを追加し、以下の操作を複数、順番自由に行うことができます。
-            
-            サポートしている操作:
-              - cargo-build   リリースビルドします
-              - cargo-run     リリースビルドして実行します
-              - cargo-test    テストを実行します
-              - cargo-doc     ドキュメントを作成します
-              - mkdir         ディレクトリーを作成します
-              - copy          ディレクトリーをコピーします
-              - delete        ファイルやディレクトリーを削除します
-              - wasm-pack     Web Assemblyを作成します
-              - command       任意のコマンドを実行します
-              - virtual-box-open      VirtualBoxの仮想マシンを起動します
-              - virtual-box-close     VirtualBoxの仮想マシンを終了します
-              - virtual-box-command   VirtualBoxの仮想マシンで任意のコマンドを実行します
-              - virtual-box-build     VirtualBoxの仮想マシンでリリースビルドします
-        ''')
-    )
-    ap.add_argument("name",nargs=1,help="build.json に宣言されたサブコマンドを指定します")
-    ap.add_argument("program_args",nargs="*")
+    def __check(self,node):
+        """
+        操作を実行する必要があるかどうかを調べます。
+        
+        - 結果の `status` は up-to-date（スキップ）、cached（保存した出力を戻す）、run（実行）のいずれかです
+        - 入力と出力が分からない操作は、常に run です（`spec` は None）
+        
+        - `node` - 操作
+        """
+        cmd  = node["cmd"]
+        spec = self.__cache_spec(cmd)
+        if spec is None:
+            return { "status":"run","spec":None }
+        
+        key    = op_key(cmd)
+        files  = self.__store.fingerprint(self.__mydir,spec["inputs"])
+        digest = hashlib.md5(json.dumps([
+            key,sorted(files.items()),[ os.environ.get(k) for k in spec["env"] ],self.__envs,spec["options"]
+        ],sort_keys=True).encode("utf-8")).hexdigest()
+        
+        artifact = None
+        if self.__artifacts is not None and cmd["op"] in ARTIFACT_OPS:
+            artifact = hashlib.md5(json.dumps([
+                key,sorted([ (p,h) for p,h in files.items() ]),
+                rust_toolchain_version(os.path.join(self.__mydir,cmd["args"]["dir"])),
+                [ os.environ.get(k) for k in spec["env"] ],spec["shallow"]
+            ]).encode("utf-8")).hexdigest()
+        
+        outputs = all([ os.path.exists(os.path.join(self.__mydir,o)) for o in spec["outputs"] ])
+        if outputs and not self.__options.force and self.__store.is_up_to_date(key,digest):
+            status = "up-to-date"
+        elif artifact is not None and not self.__options.force and self.__artifacts.contains(artifact,spec["outputs"]):
+            status = "cached"
+        else:
+            status = "run"
+        return { "status":status,"spec":spec,"key":key,"digest":digest,"files":files,"artifact":artifact }
     
-    apargs = ap.parse_args(sys.argv[1:])
-    if hasattr(apargs,"help"):
-        ap.print_help()
-        sys.exit(1)
+    def __virtual_box_cargo_build(self,vbm,args,outdir):
+        """
+        仮想マシンでリリースビルドし、成果物を受け取ります。
+        
+        - `vbm`    - 仮想マシン
+        - `args`   - 操作の引数
+        - `outdir` - 成果物の出力先ディレクトリーのパス
+        """
+        mydir = self.__mydir
+        
+        tmpdir = tempfile.mkdtemp()
+        envfile = os.path.join(tmpdir,"env.json")
+        with open(envfile,"w+") as f:
+            json.dump({ "cargo":args["cargo"] },f)
+        
+        try:
+            if args.get("transfer","copy") == "archive":
+                # 差分だけをアーカイブで送り、リリースビルドの成果物だけを受け取る
+                projdir = args.get("guest-dir","/tmp/build-py-" + os.path.basename(mydir))
+                sync_to_guest(
+                    vbm,mydir,projdir,[ args["output"] ],[ ("env.json",envfile) ],self.__store,
+                    os.path.join(mydir,self.__envs["state-dir"],"cache","vbox-%s.json" % (re.sub(r"[^\w.-]","_",vbm.name())))
+                )
+                vbm.command([ "/usr/local/bin/python3",projdir + "/build.py","build" ])
+                fetch_release_from_guest(vbm,projdir,outdir)
+            else:
+                projdir = vbm.mktemp(True)
+                vbm.copyto(mydir,projdir)
+                vbm.copyto(envfile,projdir)
+                vbm.command([ "/usr/local/bin/python3",projdir + "/build.py","build" ])
+                vbm.copyfrom(projdir + "/target",outdir)
+        finally:
+            shutil.rmtree(tmpdir)
     
-    runname = apargs.name[0]
+    def __cache_spec(self,cmd):
+        """
+        操作の入力と出力を返します。スキップできない操作の場合は None を返します。
+        
+        - 操作に `inputs` / `outputs`（build.py からの相対パス）、`env-inputs`（環境変数名）を指定すると、既定値を置き換えます
+        - `command` は `inputs` を指定した場合だけスキップの対象になります
+        - `shallow` が True の操作は、ArtifactCache に出力のディレクトリー直下の成果物だけを保存します
+          （cargo-build の target/release。deps や incremental などは cargo が管理するため保存しません）
+        
+        - `cmd` - 操作
+        """
+        op      = cmd["op"]
+        args    = cmd["args"]
+        options = {}
+        
+        if op == "cargo-build":
+            inputs  = [ os.path.join(args["dir"],i) for i in CARGO_INPUTS ]
+            outputs = [ os.path.join(args["dir"],"target","release") ]
+        elif op == "cargo-doc":
+            inputs  = [ os.path.join(args["dir"],i) for i in CARGO_INPUTS ]
+            outputs = [ args["out"] if "out" in args else os.path.join(args["dir"],"target","doc") ]
+        elif op == "wasm-pack":
+            inputs  = [ os.path.join(args["dir"],i) for i in CARGO_INPUTS ]
+            outputs = [ args["out"] ]
+        elif op == "cargo-test":
+            inputs  = [ os.path.join(args["dir"],i) for i in CARGO_TEST_INPUTS ]
+            outputs = [ os.path.join(args["report-dir"],"unittest","matrix.json" if "matrix" in args else "report.json") ]
+            options = { "coverage":not self.__options.no_coverage }
+        elif op == "command" and "inputs" in cmd:
+            inputs  = []
+            outputs = []
+        else:
+            return None
+        
+        if "inputs" in cmd:
+            inputs = cmd["inputs"]
+        if "outputs" in cmd:
+            outputs = cmd["outputs"]
+        
+        return {
+            "inputs":inputs,"outputs":outputs,"env":ENV_INPUTS + cmd.get("env-inputs",[]),"options":options,
+            "shallow":op == "cargo-build"
+        }
     
-    mydir   = os.path.dirname(os.path.abspath(__file__))
-    scripts = load_build_config(os.path.join(mydir,"build.json"))
-    envs    = load_environment_config(os.path.join(mydir,"env.json"))
+    def __test_matrix(self,cmd,tgt,rptdir,covdir,histfile):
+        """
+        フィーチャーの組み合わせごとに、テストを並行実行します。
+        
+        - 組み合わせごとに、ビルドの出力先（<dir>/target/matrix/<名前>）、ユニットテストレポート（<report-dir>/unittest/<名前>）、
+          カバレッジレポート（<report-dir>/coverage/<名前>）を分けます
+        - すべての組み合わせの結果を <report-dir>/unittest/matrix.json にまとめます
+        
+        - `cmd`    - 操作
+        - `tgt`    - プロジェクトのディレクトリーパス
+        - `rptdir` - レポートの出力先ディレクトリーパス
+        - `covdir` - カバレッジレポートの出力先ディレクトリーパス。不要の場合は None
+        - `histfile` - テストの実行履歴のパス
+        """
+        args    = cmd["args"]
+        changed = None if self.__options.full else self.__changed_files(cmd,tgt)
+        combos  = [ (re.sub(r"[^\w.-]","_","+".join(f)) if 0 < len(f) else "default",f) for f in args["matrix"] ]
+        
+        # 並行実行するテストの出力を、組み合わせの名前で見分けられるようにする
+        install_console()
+        
+        def run(name,features):
+            op_local.prefix = "%s[%s] " % (op_local.prefix or "",name)
+            error = None
+            try:
+                Cargo(self.__envs["cargo"]).test(
+                    tgt,features,
+                    os.path.join(rptdir,"unittest",name,"report.json"),
+                    None if covdir is None else os.path.join(covdir,name),
+                    args["threads"],
+                    args.get("shards",1),
+                    TestHistory(histfile),
+                    args.get("coverage-formats",[ "html","cobertura" ]),
+                    changed,
+                    os.path.join(tgt,"target","matrix",name)
+                )
+            except OpCancelled:
+                raise
+            except Exception as err:
+                error = str(err)
+            
+            stats = None
+            rptfile = os.path.join(rptdir,"unittest",name,"report.json")
+            if os.path.exists(rptfile):
+                stats = load_cargo_test_report(rptfile).stats()
+            return { "features":features,"status":"ok" if error is None else "failed","stats":stats,"error":error }
+        
+        results = run_parallel([ (lambda name,features: lambda: run(name,features))(name,features) for name,features in combos ],use_jobserver=True)
+        matrix  = dict(zip([ name for name,_ in combos ],results))
+        
+        rptfile = os.path.join(rptdir,"unittest","matrix.json")
+        if not os.path.exists(os.path.dirname(rptfile)):
+            os.makedirs(os.path.dirname(rptfile))
+        with open(rptfile,"w") as f:
+            json.dump(matrix,f,indent=2)
+        
+        for name,r in matrix.items():
+            sts = r["stats"] or { "test_count":0,"passed":0,"failed":0 }
+            print("%-7s %-30s %d tests, %d passed, %d failed." % (r["status"],name,sts["test_count"],sts["passed"],sts["failed"]))
+        
+        failed = [ name for name,r in matrix.items() if r["status"] != "ok" ]
+        if 0 < len(failed):
+            raise Exception("error occurred in %s. stop.\n\n%s" % (", ".join(failed),"\n".join([ matrix[name]["error"] for name in failed ])))
     
-    if not runname in scripts:
-        print("name not found in build.json. (%s)" % (runname),file=sys.stderr)
-        sys.exit(3)
+    def __changed_files(self,cmd,basedir):
+        """
+        操作が前回成功したときから変更された入力ファイルを、basedir からの相対パスで返します。
+        記録がない場合や、入力ファイル以外（環境変数など）だけが変わった場合は None を返します。
+        
+        - `cmd`     - 操作
+        - `basedir` - 基準ディレクトリーのパス
+        """
+        last = self.__store.last_files(op_key(cmd))
+        if last is None:
+            return None
+        
+        files   = self.__store.fingerprint(self.__mydir,self.__cache_spec(cmd)["inputs"])
+        changed = [ os.path.relpath(os.path.join(self.__mydir,p),basedir) for p in sorted(set(files) | set(last)) if files.get(p) != last.get(p) ]
+        return changed if 0 < len(changed) else None
     
-    cmds = scripts[runname]
-    for cmd in cmds:
-        op = cmd["op"]
-        args = cmd["args"]
+    def __execute(self,cmd):
+        """
+        操作を実行します。
+        
+        - `cmd` - 操作
+        """
+        mydir = self.__mydir
+        envs  = self.__envs
+        op    = cmd["op"]
+        args  = cmd["args"]
         
         if op == "cargo-build":
             tgt = os.path.join(mydir,args["dir"])
@@ -523,17 +4209,45 @@ if __name__ == "__main__":
             tgt = os.path.join(mydir,args["dir"])
             
             c = Cargo(envs["cargo"])
-            c.run(tgt,apargs.program_args)
+            c.run(tgt,self.__options.program_args)
         elif op == "cargo-test":
             tgt    = os.path.join(mydir,args["dir"])
             rptdir = os.path.join(mydir,args["report-dir"])
             
+            # 実行履歴は clean で削除しない state-dir に蓄積する
+            histfile = os.path.join(mydir,envs["state-dir"],args["report-dir"],"history.sqlite3")
+            
+            covdir = os.path.join(rptdir,"coverage")
+            if self.__options.no_coverage or not args.get("coverage",True):
+                covdir = None
+            
+            if "matrix" in args:
+                self.__test_matrix(cmd,tgt,rptdir,covdir,histfile)
+            else:
+                c = Cargo(envs["cargo"])
+                c.test(
+                    tgt,args["features"],
+                    os.path.join(rptdir,"unittest","report.json"),
+                    covdir,
+                    args["threads"],
+                    args.get("shards",1),
+                    TestHistory(histfile),
+                    args.get("coverage-formats",[ "html","cobertura" ]),
+                    None if self.__options.full else self.__changed_files(cmd,tgt)
+                )
+        elif op == "cargo-bench":
+            tgt = os.path.join(mydir,args["dir"])
+            
             c = Cargo(envs["cargo"])
-            c.test(
-                tgt,args["features"],
-                os.path.join(rptdir,"unittest","report.json"),
-                os.path.join(rptdir,"coverage"),
-                args["threads"]
+            c.bench(
+                tgt,args.get("features",[]),
+                os.path.join(mydir,args["report-dir"],"bench"),
+                os.path.join(mydir,self.__envs["state-dir"],"bench","baselines"),
+                args.get("baseline"),
+                args.get("save-baseline"),
+                args.get("threshold",10),
+                args.get("gate",[ "*" ]),
+                args.get("harness","libtest")
             )
         elif op == "cargo-doc":
             tgt = os.path.join(mydir,args["dir"])
@@ -543,57 +4257,489 @@ if __name__ == "__main__":
             
             c = Cargo(envs["cargo"])
             c.doc(tgt,out)
+        elif op == "stress":
+            tgt  = os.path.join(mydir,args["dir"])
+            kind = args.get("kind","file")
+            
+            workdir = tempfile.mkdtemp(dir=args.get("work-dir"))
+            try:
+                c = Cargo(envs["cargo"])
+                results = c.stress(tgt,workdir,kind,args["processes"],args["threads"],args["count"])
+            finally:
+                shutil.rmtree(workdir)
+            
+            report = stress_report(results,kind,args["processes"],args["threads"],args["count"])
+            report["commit"] = git_commit(tgt)
+            
+            rptfile = os.path.join(mydir,args["report-dir"],"stress","%s-%dx%d.json" % (kind,args["processes"],args["threads"]))
+            if not os.path.exists(os.path.dirname(rptfile)):
+                os.makedirs(os.path.dirname(rptfile))
+            with open(rptfile,"w") as f:
+                json.dump(report,f,indent=2)
+            
+            print(
+                "%d created, %d failures, %d retries in %.3f s (%.0f /s). latency p50 %.1f us, p99 %.1f us."
+                % (report["created"],report["failures"],report["retries"],report["elapsed"],report["creations_per_sec"],report["latency_us"]["p50"],report["latency_us"]["p99"])
+            )
         elif op == "mkdir":
             os.mkdir(args["target"])
         elif op == "copy":
             merge_tree(
                 os.path.join(mydir,args["source"]),
-                os.path.join(mydir,args["dest"])
+                os.path.join(mydir,args["dest"]),
+                self.__store,
+                args.get("mode","copy"),
+                args.get("workers",8),
+                args.get("mirror",False),
+                args.get("quiet",False)
             )
         elif op == "delete":
             tgt = os.path.join(mydir,args["target"])
             
             if os.path.exists(tgt):
-                if os.path.isdir(tgt):
-                    shutil.rmtree(tgt)
-                elif os.path.isfile(tgt):
-                    os.remove(tgt)
+                if os.path.isdir(tgt) or os.path.isfile(tgt):
+                    trash_bin(os.path.join(mydir,".trash")).move(tgt)
                 else:
                     raise Exception("unexpected state. (%s)" % (tgt))
         elif op == "wasm-pack":
             tgt = os.path.join(mydir,args["dir"])
             
-            wasm_pack_build(tgt,os.path.join(mydir,args["out"]))
+            out = os.path.join(mydir,args["out"])
+            
+            wasm_pack_build(tgt,out)
+            if args.get("optimize") is not None or 0 < len(args.get("compress",[])) or "budgets" in args:
+                wasm_post_process(
+                    out,args.get("optimize"),args.get("compress",[]),args.get("budgets",{}),
+                    os.path.join(mydir,envs["report-dir"],"wasm","%s-sizes.json" % (os.path.basename(os.path.normpath(out)))),
+                    self.__store
+                )
         elif op == "command":
             tgt = os.path.join(mydir,args["dir"])
             
             run_command(tgt,args["args"],args["env"])
         elif op == "virtual-box-open":
-            vbm = VirtualBoxMachine(args["vm"])
+            self.__vms.open(args["vm"],args.get("boot-timeout",300))
         elif op == "virtual-box-close":
-            vbm = VirtualBoxMachine(args["vm"])
-            vbm.close()
+            self.__vms.close(args["vm"])
         elif op == "virtual-box-command":
-            vbm = VirtualBoxMachine(args["vm"])
+            vbm = self.__vms.open(args["vm"],args.get("boot-timeout",300))
             vbm.command(args["args"])
         elif op == "virtual-box-cargo-build":
-            vbm = VirtualBoxMachine(args["vm"])
-            
             outdir = os.path.join(mydir,args["output"])
             
-            tmpdir = tempfile.mkdtemp()
-            envfile = os.path.join(tmpdir,"env.json")
-            with open(envfile,"w+") as f:
-                json.dump({ "cargo":args["cargo"] },f)
-            
+            if "vms" in args:
+                # 複数の仮想マシンで並行してビルドし、成果物は仮想マシンごとのディレクトリーに受け取る
+                # - ビルドは仮想マシンで動くので、ホストのジョブサーバーのトークンは受け取らない
+                run_parallel([
+                    (lambda vm: lambda: self.__virtual_box_cargo_build(
+                        self.__vms.open(vm,args.get("boot-timeout",300)),args,os.path.join(outdir,vm)
+                    ))(vm) for vm in args["vms"]
+                ])
+            else:
+                self.__virtual_box_cargo_build(self.__vms.open(args["vm"],args.get("boot-timeout",300)),args,outdir)
+        else:
+            raise UnsupportedOpError(op)
+
+def daemon_socket_path(mydir):
+    """
+    常駐サーバーのソケットのパスを返します。
+    
+    - ほかのユーザーが接続できないよう、$XDG_RUNTIME_DIR か、一時ディレクトリーに作成した自分だけが使えるディレクトリー（0700）に置きます
+    
+    - `mydir` - プロジェクトのルートディレクトリーのパス
+    """
+    key = hashlib.md5(mydir.encode("utf-8")).hexdigest()[:12]
+    
+    d = os.environ.get("XDG_RUNTIME_DIR")
+    if d is None or not os.path.isdir(d):
+        d = os.path.join(tempfile.gettempdir(),"build-py-%d" % (os.getuid()))
+        try:
+            os.mkdir(d,0o700)
+        except FileExistsError:
+            pass
+    
+    # ほかのユーザーが先に作成したディレクトリーは使わない
+    st = os.lstat(d)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise Exception("socket directory is not private. (%s)" % (d))
+    return os.path.join(d,"build-py-%s.sock" % (key))
+
+class BuildServer(object):
+    
+    def __init__(self,mydir):
+        """
+        新しいBuildServerインスタンスを生成します。
+        
+        - 設定、入力のハッシュ、仮想マシンのセッションを保持したまま、クライアントからの実行要求を処理します
+        - build.json / env.json は、更新された場合だけ読み込み直します
+        - 実行要求は1つずつ処理します（環境変数をクライアントのものに置き換えて実行するため）
+        
+        - `mydir` - プロジェクトのルートディレクトリーのパス
+        """
+        self.__mydir   = mydir
+        self.__lock    = threading.Lock()
+        self.__mtimes  = None
+        self.__scripts = None
+        self.__envs    = None
+        self.__store   = None
+        self.__vms     = None
+    
+    def handle(self,request,sink,token=None):
+        """
+        実行要求を処理し、終了コードを返します。
+        
+        - 実行中は、作業ディレクトリーもクライアントのものに変更します
+        
+        - `request` - 実行要求（`argv`: コマンドライン引数、`env`: 環境変数、`cwd`: 作業ディレクトリー）
+        - `sink`    - 出力の送り先
+        - `token`   - キャンセルトークン。クライアントが切断した場合にキャンセルします
+        """
+        with self.__lock:
+            cwd     = os.getcwd()
+            environ = dict(os.environ)
+            os.environ.clear()
+            os.environ.update(request["env"])
+            # クライアントから引き継いだファイルディスクリプターの番号は、このプロセスでは別のもの（ソケットなど）を指すため、
+            # パイプのジョブサーバーは使わない（名前付きパイプはパスで開けるので使う）
+            for k in [ "MAKEFLAGS","CARGO_MAKEFLAGS","MFLAGS" ]:
+                if re.search(JOBSERVER_FDS_PATTERN,os.environ.get(k,"")) is not None:
+                    del os.environ[k]
+            op_local.sink = sink
             try:
-                projdir = vbm.mktemp(True)
-                vbm.copyto(mydir,projdir)
-                vbm.copyto(envfile,projdir)
-                vbm.command([ "/usr/local/bin/python3",projdir + "/build.py","build" ])
-                vbm.copyfrom(projdir + "/target",outdir)
+                os.chdir(request.get("cwd",cwd))
+                return self.__handle(request["argv"],token)
+            except SystemExit as err:
+                return err.code if isinstance(err.code,int) else 1
+            except OpCancelled:
+                print("cancelled.",file=sys.stderr)
+                return 130
+            except Exception:
+                traceback.print_exc()
+                return 1
             finally:
-                shutil.rmtree(tmpdir)
+                op_local.sink = None
+                os.chdir(cwd)
+                os.environ.clear()
+                os.environ.update(environ)
+    
+    def __handle(self,argv,token):
+        self.__load()
+        
+        if 0 < len(argv) and argv[0] == "query":
+            return query_main(self.__mydir,self.__envs,argv[1:])
+        
+        ap = create_argument_parser()
+        apargs = ap.parse_args(argv)
+        if apargs.serve or apargs.watch:
+            ap.error("--serve and --watch are not available through the server")
+        if apargs.name is None:
+            ap.error("the following arguments are required: name")
+        
+        return run_build(self.__mydir,apargs,self.__scripts,self.__envs,self.__store,self.__vms,token)
+    
+    def __load(self):
+        paths  = [ os.path.join(self.__mydir,"build.json"),os.path.join(self.__mydir,"env.json") ]
+        mtimes = [ os.stat(p).st_mtime_ns if os.path.exists(p) else None for p in paths ]
+        if mtimes == self.__mtimes:
+            return
+        
+        scripts = load_build_config(paths[0])
+        envs    = load_environment_config(paths[1])
+        if envs != self.__envs:
+            self.__store = FingerprintStore(os.path.join(self.__mydir,envs["state-dir"],"cache","fingerprints.json"))
+            self.__vms   = VirtualBoxRegistry(envs["vboxmanage"])
+        self.__scripts = scripts
+        self.__envs    = envs
+        self.__mtimes  = mtimes
+
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+    
+    def handle(self):
+        # サーバーと同じユーザーからの接続だけを受け付ける
+        creds = self.connection.getsockopt(socket.SOL_SOCKET,socket.SO_PEERCRED,struct.calcsize("3i"))
+        _,uid,_ = struct.unpack("3i",creds)
+        if uid != os.getuid():
+            print("rejected connection from uid %d." % (uid),file=sys.stderr)
+            return
+        
+        lock = threading.Lock()
+        
+        def send(msg):
+            with lock:
+                try:
+                    self.wfile.write((json.dumps(msg) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                except OSError:
+                    # クライアントが切断した場合は出力を捨てる
+                    pass
+        
+        line = self.rfile.readline()
+        if not line:
+            # 起動確認のための接続
+            return
+        request = json.loads(line.decode("utf-8"))
+        
+        # クライアントが切断した（Ctrl+C で終了した場合を含む）ら、実行をキャンセルする
+        token    = CancelToken()
+        finished = threading.Event()
+        
+        def monitor():
+            try:
+                while self.connection.recv(4096):
+                    pass
+            except OSError:
+                pass
+            if not finished.is_set():
+                print("client disconnected. cancelling.",file=sys.stderr)
+                token.cancel()
+        
+        threading.Thread(target=monitor,daemon=True).start()
+        try:
+            code = self.server.build_server.handle(request,lambda fd,data: send({ "fd":fd,"data":data }),token)
+            send({ "exit":code })
+        finally:
+            finished.set()
+            try:
+                self.connection.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+def serve(mydir):
+    """
+    常駐サーバーとして、クライアントからの実行要求を処理します（`build.py --serve`）。
+    
+    - `mydir` - プロジェクトのルートディレクトリーのパス
+    """
+    path = daemon_socket_path(mydir)
+    if os.path.exists(path):
+        s = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+            print("server is already running. (%s)" % (path),file=sys.stderr)
+            return 1
+        except OSError:
+            # 前回のサーバーが残したソケット
+            os.remove(path)
+        finally:
+            s.close()
+    
+    install_console()
+    
+    # 接続を受け付ける前に、自分だけが読み書きできるようにする
+    server = socketserver.ThreadingUnixStreamServer(path,BuildRequestHandler,bind_and_activate=False)
+    umask  = os.umask(0o077)
+    try:
+        server.server_bind()
+    finally:
+        os.umask(umask)
+    os.chmod(path,0o600)
+    server.server_activate()
+    server.daemon_threads = True
+    server.build_server = BuildServer(mydir)
+    # SIGTERM でもソケットを片付けてから終了する
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+    print("listening on %s" % (path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        hand_off_trash_bins()
+    return 0
+
+def request_to_server(mydir,argv):
+    """
+    常駐サーバーに実行を要求し、出力を受け取って終了コードを返します。サーバーが起動していない場合は None を返します。
+    
+    - `mydir` - プロジェクトのルートディレクトリーのパス
+    - `argv`  - コマンドライン引数
+    """
+    s = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        s.connect(daemon_socket_path(mydir))
+    except OSError:
+        s.close()
+        return None
+    
+    try:
+        s.sendall((json.dumps({ "argv":argv,"env":dict(os.environ),"cwd":os.getcwd() }) + "\n").encode("utf-8"))
+        for l in s.makefile("rb"):
+            msg = json.loads(l.decode("utf-8"))
+            if "exit" in msg:
+                return msg["exit"]
+            stream = sys.stdout if msg["fd"] == 1 else sys.stderr
+            stream.write(msg["data"])
+            stream.flush()
+    except KeyboardInterrupt:
+        # 切断すると、サーバーは実行をキャンセルする
+        return 130
+    finally:
+        s.close()
+    
+    print("connection closed by server.",file=sys.stderr)
+    return 1
+
+def create_argument_parser():
+    """
+    コマンドライン引数のパーサーを返します。
+    """
+    ap = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent('''\
+            build.json にサブコマンドを追加し、以下の操作を複数、順番自由に行うことができます。
+            
+            サポートしている操作:
+              - cargo-build   リリースビルドします
+              - cargo-run     リリースビルドして実行します
+              - cargo-test    テストを実行します
+              - cargo-bench   ベンチマークを実行し、基準の結果と比べます
+              - cargo-doc     ドキュメントを作成します
+              - stress        複数のプロセス・スレッドから一時ファイルを作成し、作成速度と衝突を測定します
+              - mkdir         ディレクトリーを作成します
+              - copy          ディレクトリーをコピーします（`mode`: reflink / hardlink / copy、`workers`、`mirror`、`quiet`）
+              - delete        ファイルやディレクトリーを削除します（.trash へ移動し、バックグラウンドで削除します）
+              - wasm-pack     Web Assemblyを作成します（`optimize` で wasm-opt、`compress` で gz / br の事前圧縮、`budgets` でサイズの上限）
+              - command       任意のコマンドを実行します
+              - virtual-box-open      VirtualBoxの仮想マシンを起動します
+              - virtual-box-close     VirtualBoxの仮想マシンを終了します
+              - virtual-box-command   VirtualBoxの仮想マシンで任意のコマンドを実行します
+              - virtual-box-cargo-build   VirtualBoxの仮想マシンでリリースビルドします（`vms` で複数の仮想マシンで並行ビルド）
+            
+            `build.py check-virtualbox` は、VirtualBox の代わりに tools/fake-vboxmanage.py を使って、
+            virtual-box-cargo-build の転送、ビルド、成果物の受け取りを確かめます。
+            
+            操作には `id` と `needs`（依存する操作の id のリスト）を指定できます。
+            `needs` を省略した操作は直前の操作の後に実行されます。
+            `-j` を指定すると、依存関係のない操作を並行実行します。
+            並行実行する操作と、cargo などが起動するプロセスは、GNU make 互換のジョブサーバー
+            （MAKEFLAGS / CARGO_MAKEFLAGS）で `--cpus` 個のトークンを分け合います。
+            `build.py check-jobserver` は、トークンが1つだけでも test / test-matrix が止まらずに終わることを確かめます。
+            
+            cargo-build / cargo-doc / wasm-pack / cargo-test と、`inputs` を指定した command は、
+            前回成功したときから入力（ファイルの内容と環境変数）が変わっていなければスキップします。
+            入力と出力は操作の `inputs` / `outputs` / `env-inputs` で変更できます。
+            
+            cargo-build の成果物（target/release 直下のファイル）と wasm-pack の出力は env.json の `artifact-cache`（null で無効）に保存し、
+            同じ入力（ソース、Cargo.toml、ツールチェーン、環境変数、フィーチャー）でビルドしたことがあれば、
+            ビルドせずに `artifact-cache-mode`（reflink / hardlink / copy）で戻します。
+            保存先の合計サイズは `artifact-cache-size`（MiB）までで、古く使われたものから削除します。
+            hardlink で戻したファイルは読み取り専用になり、build.py が次にビルドする前にコピーに置き換えます。
+            
+            cargo-test は前回失敗したテストを先に実行し、続けて前回成功したときから変更されたファイルの
+            影響を受けるテストターゲット（tests/<name>.rs なら --test <name>、src などはすべて）だけを実行します。
+            カバレッジを測定する場合と `--full` を指定した場合は、すべてのテストを実行します。
+            
+            cargo-test に `matrix`（フィーチャーのリストのリスト）を指定すると、組み合わせごとに
+            ビルドの出力先を分けてテストを並行実行し、結果を <report-dir>/unittest/matrix.json にまとめます。
+            
+            実行の履歴や基準の結果は env.json の `state-dir`（既定値は .build-py）に保存し、clean で削除する reports とは別に残します。
+            
+            cargo-test の実行結果は <state-dir>/<report-dir>/history.sqlite3 に蓄積され、
+            `build.py query slowest|regressions|flaky` で調べることができます。
+            フィーチャーと実行したテストの絞り込みが同じ実行どうしを比べます（`--features`、`--filter` で指定）。
+            
+            cargo-bench は結果を <state-dir>/bench/baselines/<save-baseline>.json に保存し、
+            `baseline` の結果より `threshold` % 以上遅くなった `gate` のベンチマークがあれば失敗します（`baseline` の結果がない場合も失敗します）。
+            `baseline` と `save-baseline` には別の名前を指定します。`build.py bench` は固定の基準 main と比べて
+            結果を latest に保存し、基準の更新は `build.py bench-baseline` で明示的に行います。
+            
+            サブコマンドは `build.py build test doc` のように複数指定でき、指定した順に実行します。
+            別のサブコマンドと操作名と引数が同じ操作は、1回だけ実行します（delete を含むサブコマンドをまたぐ場合を除きます）。
+            同じサブコマンドを `build.py build clean build` のように繰り返し指定することもできます。
+            
+            操作の実行時間は <state-dir>/cache/ops.sqlite3 に蓄積されます。`--plan` を指定すると、実行せずに
+            操作ごとの状態（up-to-date / cached / run）と、同じ状態で実行したときの直近の実行時間の中央値、
+            見積もった合計時間とクリティカルパスを表示します。実行後は見積もりと実際の実行時間を比べて表示します。
+            
+            `build.py --serve` で常駐サーバーを起動しておくと、`build.py --client <name>` は
+            設定の読み込みやツールチェーンのチェック結果、入力のハッシュを使い回して実行します。
+            ソケットは $XDG_RUNTIME_DIR（ない場合は一時ディレクトリーの build-py-<uid>）に作成し、同じユーザーからの接続だけを受け付けます。
+            クライアントの環境変数と作業ディレクトリーで実行し、クライアントを Ctrl+C で止めると実行をキャンセルします。
+        ''')
+    )
+    ap.add_argument("name",nargs="?",help="build.json に宣言されたサブコマンドを指定します（続けて複数指定できます）")
+    ap.add_argument("program_args",nargs="*")
+    ap.add_argument("-j","--jobs",type=int,default=1,help="並行実行する操作の最大数を指定します")
+    ap.add_argument("--cpus",type=int,help="操作と子プロセス（rustc など）で同時に使う CPU の数を指定します（ジョブサーバーのトークン数。既定値は CPU の数）")
+    ap.add_argument("-f","--force",action="store_true",help="入力が変わっていない操作もスキップせずに実行します")
+    ap.add_argument("--no-coverage",action="store_true",help="cargo-test でカバレッジを測定しません")
+    ap.add_argument("--full",action="store_true",help="cargo-test で、変更の影響を受けるテストだけでなく、すべてのテストを実行します")
+    ap.add_argument("--watch",action="store_true",help="入力ファイルを監視し、変更されるたびにサブコマンドを実行します")
+    ap.add_argument("--serve",action="store_true",help="常駐サーバーとして起動し、--client からの実行要求を受け付けます")
+    ap.add_argument("--client",action="store_true",help="常駐サーバーで実行します。サーバーが起動していない場合は、このプロセスで実行します")
+    ap.add_argument("--plan",action="store_true",help="実行せずに、操作ごとの状態と見積もった実行時間、クリティカルパスを表示します")
+    ap.add_argument("--plan-window",type=int,default=10,metavar="N",help="実行時間の見積もりに使う、直近の実行の数を指定します")
+    ap.add_argument("--trace",metavar="FILE",help="操作ごとの実行時間などを記録します（.jsonl の場合は JSON Lines、それ以外は Chrome のトレースイベント形式）")
+    
+    return ap
+
+def run_build(mydir,apargs,scripts,envs,store=None,vms=None,token=None):
+    """
+    サブコマンドを実行し、終了コードを返します。
+    
+    - `mydir`   - プロジェクトのルートディレクトリーのパス
+    - `apargs`  - コマンドライン引数
+    - `scripts` - ビルド設定（build.json）
+    - `envs`    - 環境設定（env.json）
+    - `store`   - 入力のハッシュの記録先。None の場合は新しく読み込みます
+    - `vms`     - 仮想マシンのセッション。None の場合は新しく作成します
+    - `token`   - キャンセルトークン
+    """
+    if not apargs.name in scripts:
+        print("name not found in build.json. (%s)" % (apargs.name),file=sys.stderr)
+        return 3
+    
+    # 続けて指定したサブコマンド名も（同じ名前を繰り返した場合も）順番に実行し、残りはプログラムの引数にする
+    runnames = [ apargs.name ]
+    while 0 < len(apargs.program_args) and apargs.program_args[0] in scripts:
+        runnames.append(apargs.program_args.pop(0))
+    
+    builder = Builder(mydir,scripts,envs,apargs,store,vms)
+    try:
+        if apargs.plan:
+            builder.dry_run(runnames)
+        elif apargs.watch:
+            watch(builder,runnames)
         else:
-            print("unsupported op. (%s)" % (op),file=sys.stderr)
-            sys.exit(4)
\ No newline at end of file
+            builder.run(runnames,token)
+    except UnsupportedOpError as err:
+        print("unsupported op. (%s)" % (err.op),file=sys.stderr)
+        return 4
+    return 0
+
+if __name__ == "__main__":
+    mydir = os.path.dirname(os.path.abspath(__file__))
+    
+    if "--client" in sys.argv[1:]:
+        # 常駐サーバーが起動していなければ、このプロセスで実行する
+        sys.argv = [ a for a in sys.argv if a != "--client" ]
+        code = request_to_server(mydir,sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+    
+    if 1 < len(sys.argv) and sys.argv[1] == "query":
+        envs = load_environment_config(os.path.join(mydir,"env.json"))
+        sys.exit(query_main(mydir,envs,sys.argv[2:]))
+    
+    ap = create_argument_parser()
+    apargs = ap.parse_args(sys.argv[1:])
+    if hasattr(apargs,"help"):
+        ap.print_help()
+        sys.exit(1)
+    
+    if apargs.serve:
+        sys.exit(serve(mydir))
+    if apargs.name is None:
+        ap.error("the following arguments are required: name")
+    
+    scripts = load_build_config(os.path.join(mydir,"build.json"))
+    envs    = load_environment_config(os.path.join(mydir,"env.json"))
+    
+    try:
+        code = run_build(mydir,apargs,scripts,envs)
+    finally:
+        # 削除の終了を待たずに終了する
+        hand_off_trash_bins()
+    sys.exit(code)
@@ -0,0 +1,80 @@
+//! Create temporary files or directories from many threads in a shared directory.
+//! 
+//! ```shell
+//! cargo run --release --features stress --example stress -- <dir> <file|dir> <threads> <count> <start-at>
+//! ```
+//! 
+//! - `start-at` - UNIX time (ms) to start at, so that several processes start together.
+//! 
+//! Print the result as one JSON line. `started_at` / `finished_at` are UNIX times (s), so that the caller can check the processes really ran together.
+
+use std::{
+    thread,
+    time::{ Duration,Instant,SystemTime,UNIX_EPOCH }
+};
+use maketemp::{ TempDir,TempFile };
+
+fn main() {
+    let args:Vec<String> = std::env::args().collect();
+    if args.len() != 6 {
+        eprintln!("usage: stress <dir> <file|dir> <threads> <count> <start-at>");
+        std::process::exit(2);
+    }
+    let dir = args[1].clone();
+    let kind = args[2].clone();
+    let threads:usize = args[3].parse().unwrap();
+    let count:usize = args[4].parse().unwrap();
+    let start_at:u128 = args[5].parse().unwrap();
+    
+    let now = SystemTime::now().duration_since(UNIX_EPOCH).unwrap().as_millis();
+    if now < start_at {
+        thread::sleep(Duration::from_millis((start_at - now) as u64));
+    }
+    
+    let started_at = SystemTime::now().duration_since(UNIX_EPOCH).unwrap().as_secs_f64();
+    let started = Instant::now();
+    let handles:Vec<_> = (0..threads).map(|_| {
+        let dir = dir.clone();
+        let kind = kind.clone();
+        thread::spawn(move || {
+            let mut latencies = Vec::with_capacity(count);
+            let mut failures = 0;
+            // keep created entries until the end, so that later names collide with them.
+            let mut files = Vec::new();
+            let mut dirs = Vec::new();
+            for _ in 0..count {
+                let t = Instant::now();
+                let ok = if kind == "dir" {
+                    TempDir::open_with(&dir,"stress-").map(|v| dirs.push(v)).is_ok()
+                } else {
+                    TempFile::open_with(&dir,"stress-","").map(|v| files.push(v)).is_ok()
+                };
+                latencies.push(t.elapsed().as_nanos());
+                if !ok { failures += 1; }
+            }
+            let elapsed = started.elapsed();
+            (latencies,failures,elapsed,files,dirs)
+        })
+    }).collect();
+    
+    let mut latencies = Vec::new();
+    let mut failures = 0;
+    let mut elapsed = Duration::from_secs(0);
+    let mut entries = Vec::new();
+    for h in handles {
+        let (l,f,e,files,dirs) = h.join().unwrap();
+        latencies.extend(l);
+        failures += f;
+        elapsed = elapsed.max(e);
+        entries.push((files,dirs));
+    }
+    let finished_at = SystemTime::now().duration_since(UNIX_EPOCH).unwrap().as_secs_f64();
+    let retries = maketemp::retry_count();
+    drop(entries);
+    
+    let latencies:Vec<String> = latencies.iter().map(|v| v.to_string()).collect();
+    println!(
+        "{{ \"created\":{},\"failures\":{},\"retries\":{},\"elapsed\":{},\"started_at\":{},\"finished_at\":{},\"latencies\":[{}] }}",
+        latencies.len() - failures,failures,retries,elapsed.as_secs_f64(),started_at,finished_at,latencies.join(",")
+    );
+}
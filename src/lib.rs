@@ -33,11 +33,23 @@ use std::{
     time::{ Duration,SystemTime,UNIX_EPOCH }
 };
 
+#[cfg(feature = "stress")]
+static RETRIES:std::sync::atomic::AtomicUsize = std::sync::atomic::AtomicUsize::new(0);
+
+/// Return how many times a name collided and was retried. (`stress` feature only)
+#[cfg(feature = "stress")]
+#[doc(hidden)]
+pub fn retry_count() -> usize {
+    RETRIES.load(std::sync::atomic::Ordering::Relaxed)
+}
+
 fn make_path<P:AsRef<Path>,N1:AsRef<str>,N2:AsRef<str>>(dir:P,prefix:N1,suffix:N2) -> std::path::PathBuf {
     loop {
         let now = SystemTime::now().duration_since(UNIX_EPOCH).unwrap().as_micros();
         let p = dir.as_ref().join(format!("{}{}{}",prefix.as_ref(),now,suffix.as_ref()));
         if !p.exists() { return p; }
+        #[cfg(feature = "stress")]
+        RETRIES.fetch_add(1,std::sync::atomic::Ordering::Relaxed);
         std::thread::sleep(Duration::from_micros(1));
     };
 }
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+VirtualBox の代わりに、ホストで仮想マシンの操作を再現する VBoxManage です（build.py の VirtualBox の操作のテスト用）。
+
+- env.json の `vboxmanage` にこのスクリプトのパスを指定して使います
+- 仮想マシンごとに `$FAKE_VBOX_ROOT/<名前>` をゲストとみなし、ゲストの /tmp をその下の tmp に置き換えます
+  - ゲストのコマンドは、ホストの MAKEFLAGS などを引き継がず、HOME を `$FAKE_VBOX_ROOT/<名前>/home` にして実行します
+- startvm から `$FAKE_VBOX_BOOT_DELAY` 秒（既定値は 0）経つまで、guestcontrol は失敗します（起動待ちの再現）
+- 呼び出しを `$FAKE_VBOX_ROOT/calls.jsonl` に記録します（仮想マシン名、コマンド、引数、開始・終了日時、終了コード）
+
+サポートしているコマンド:
+  - list runningvms
+  - startvm <名前>
+  - controlvm <名前> poweroff
+  - guestcontrol <名前> run / copyto / copyfrom / mkdir / mktemp
+"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# ゲストの環境に引き継がない環境変数（ホストのジョブサーバーなど）
+HOST_ONLY_ENV = [ "MAKEFLAGS","CARGO_MAKEFLAGS","MFLAGS" ]
+
+def vm_dir(root,name):
+    return os.path.join(root,re.sub(r"[^\w.-]","_",name))
+
+def to_host(root,name,s):
+    """
+    ゲストのパス（を含む文字列）の /tmp を、仮想マシンのディレクトリーの tmp に置き換えます。
+    
+    - `root` - 仮想マシンのディレクトリーの親ディレクトリーのパス
+    - `name` - 仮想マシンの名前
+    - `s`    - ゲストのパス、またはゲストのパスを含むシェルスクリプト
+    """
+    tmp = os.path.join(vm_dir(root,name),"tmp")
+    return re.sub(r"(?<![\w.-])/tmp(?=/|'|\"|\s|$)",lambda m: tmp,s)
+
+def to_guest(root,name,path):
+    """
+    ホストのパスを、ゲストのパスに戻します。
+    
+    - `root` - 仮想マシンのディレクトリーの親ディレクトリーのパス
+    - `name` - 仮想マシンの名前
+    - `path` - ホストのパス
+    """
+    return "/" + os.path.relpath(path,vm_dir(root,name)).replace(os.sep,"/")
+
+def is_running(root,name):
+    return os.path.exists(os.path.join(vm_dir(root,name),"running"))
+
+def parse_options(argv,flags):
+    """
+    オプションと、それ以外の引数に分けます。
+    
+    - `--` 以降は、すべてそれ以外の引数として扱います
+    
+    - `argv`  - 引数
+    - `flags` - 値を取らないオプション
+    """
+    opts = {}
+    rest = []
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a == "--":
+            rest.extend(argv[i + 1:])
+            break
+        if a.startswith("--"):
+            if a in flags:
+                opts[a] = True
+            else:
+                opts[a] = argv[i + 1]
+                i += 1
+        else:
+            rest.append(a)
+        i += 1
+    return opts,rest
+
+def guest_environ(root,name):
+    env = dict(os.environ)
+    for k in HOST_ONLY_ENV:
+        env.pop(k,None)
+    # ツールチェーンは、ホストのものをそのまま使う
+    for k,d in [ ("RUSTUP_HOME",".rustup"),("CARGO_HOME",".cargo"),("PYENV_ROOT",".pyenv") ]:
+        if not k in env and os.path.exists(os.path.expanduser(os.path.join("~",d))):
+            env[k] = os.path.expanduser(os.path.join("~",d))
+    env["HOME"] = os.path.join(vm_dir(root,name),"home")
+    return env
+
+def guestcontrol(root,name,argv):
+    if not is_running(root,name):
+        print("VBoxManage: error: Machine \"%s\" is not running" % (name),file=sys.stderr)
+        return 1
+    with open(os.path.join(vm_dir(root,name),"running"),"r") as f:
+        booted = float(f.read())
+    if time.time() < booted + float(os.environ.get("FAKE_VBOX_BOOT_DELAY","0")):
+        print("VBoxManage: error: The guest execution service is not ready (yet)",file=sys.stderr)
+        return 1
+    
+    cmd = argv[0]
+    opts,rest = parse_options(argv[1:],[ "--recursive","--directory" ])
+    
+    if cmd == "run":
+        # run --exe <実行ファイル> -- <argv0> <引数>...
+        exe = to_host(root,name,opts["--exe"])
+        if os.path.basename(exe).startswith("python"):
+            exe = sys.executable
+        args = [ exe ] + [ to_host(root,name,a) for a in rest[1:] ]
+        return subprocess.call(args,cwd=os.path.join(vm_dir(root,name),"home"),env=guest_environ(root,name))
+    elif cmd == "copyto":
+        # copyto [--recursive] <ホストのパス>... <ゲストのディレクトリー>
+        dst = to_host(root,name,rest[-1])
+        for src in rest[:-1]:
+            if os.path.isdir(src):
+                shutil.copytree(src,dst,dirs_exist_ok=True)
+            else:
+                shutil.copy2(src,os.path.join(dst,os.path.basename(src)) if os.path.isdir(dst) else dst)
+        return 0
+    elif cmd == "copyfrom":
+        # copyfrom [--recursive] --target-directory <ホストのディレクトリー> <ゲストのパス>...
+        dst = opts["--target-directory"]
+        os.makedirs(dst,exist_ok=True)
+        for src in rest:
+            src = to_host(root,name,src)
+            if os.path.isdir(src):
+                shutil.copytree(src,os.path.join(dst,os.path.basename(src)),dirs_exist_ok=True)
+            else:
+                shutil.copy2(src,os.path.join(dst,os.path.basename(src)))
+        return 0
+    elif cmd == "mkdir":
+        for d in rest:
+            os.makedirs(to_host(root,name,d),exist_ok=True)
+        return 0
+    elif cmd == "mktemp":
+        tmpdir = to_host(root,name,opts.get("--tmpdir","/tmp"))
+        prefix = rest[0].rstrip("X")
+        if "--directory" in opts:
+            print("Directory name: %s" % (to_guest(root,name,tempfile.mkdtemp(prefix=prefix,dir=tmpdir))))
+        else:
+            fd,path = tempfile.mkstemp(prefix=prefix,dir=tmpdir)
+            os.close(fd)
+            print("File name: %s" % (to_guest(root,name,path)))
+        return 0
+    
+    print("VBoxManage: error: unsupported guestcontrol command. (%s)" % (cmd),file=sys.stderr)
+    return 2
+
+def main(argv):
+    root = os.environ["FAKE_VBOX_ROOT"]
+    
+    if argv[:2] == [ "list","runningvms" ]:
+        for i,name in enumerate(sorted(os.listdir(root))):
+            if is_running(root,name):
+                print("\"%s\" {00000000-0000-0000-0000-%012d}" % (name,i))
+        return 0
+    elif argv[0] == "startvm":
+        name = argv[1]
+        os.makedirs(os.path.join(vm_dir(root,name),"tmp"),exist_ok=True)
+        os.makedirs(os.path.join(vm_dir(root,name),"home"),exist_ok=True)
+        with open(os.path.join(vm_dir(root,name),"running"),"w") as f:
+            f.write(str(time.time()))
+        return 0
+    elif argv[0] == "controlvm" and argv[2] == "poweroff":
+        name = argv[1]
+        if not is_running(root,name):
+            return 1
+        os.remove(os.path.join(vm_dir(root,name),"running"))
+        return 0
+    elif argv[0] == "guestcontrol":
+        return guestcontrol(root,argv[1],argv[2:])
+    
+    print("VBoxManage: error: unsupported command. (%s)" % (" ".join(argv)),file=sys.stderr)
+    return 2
+
+if __name__ == "__main__":
+    started = time.time()
+    code    = main(sys.argv[1:])
+    
+    rec = {
+        "vm":sys.argv[2] if sys.argv[1] in [ "startvm","controlvm","guestcontrol" ] else None,
+        "command":sys.argv[1] if sys.argv[1] != "guestcontrol" else sys.argv[3],
+        "args":sys.argv[1:],"start":started,"end":time.time(),"returncode":code
+    }
+    fd = os.open(os.path.join(os.environ["FAKE_VBOX_ROOT"],"calls.jsonl"),os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        os.write(fd,(json.dumps(rec) + "\n").encode("utf-8"))
+    finally:
+        os.close(fd)
+    sys.exit(code)
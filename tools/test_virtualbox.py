@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+build.py の VirtualBox の操作を、tools/fake-vboxmanage.py を使ってテストします。
+
+```shell
+python3 tools/test_virtualbox.py
+```
+
+- プロジェクトを一時ディレクトリーにコピーし、その build.py を偽の VBoxManage で実行します
+- 1台の仮想マシンでの差分転送・ビルド・成果物の受け取りと、2台の仮想マシンでの並行ビルドを確かめます
+- ゲストでのビルドには、ホストの cargo を使います
+"""
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+
+ROOT_DIR   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VBOXMANAGE = os.path.join(ROOT_DIR,"tools","fake-vboxmanage.py")
+
+# プロジェクトのうち、ゲストでのビルドに必要なもの
+PROJECT_FILES = [ "build.py","build.json","Cargo.toml",".gitignore","src","tests","examples","benches" ]
+
+def load_build_module():
+    spec   = importlib.util.spec_from_file_location("build",os.path.join(ROOT_DIR,"build.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class VirtualBoxTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir  = tempfile.mkdtemp()
+        self.vboxdir = os.path.join(self.tmpdir,"vbox")
+        self.projdir = os.path.join(self.tmpdir,"project")
+        os.makedirs(self.vboxdir)
+        os.makedirs(self.projdir)
+        for name in PROJECT_FILES:
+            src = os.path.join(ROOT_DIR,name)
+            if os.path.isdir(src):
+                shutil.copytree(src,os.path.join(self.projdir,name))
+            elif os.path.exists(src):
+                shutil.copy2(src,os.path.join(self.projdir,name))
+        
+        op = { "output":"vbox-out","cargo":"cargo","transfer":"archive","guest-dir":"/tmp/build-py-project","boot-timeout":60 }
+        with open(os.path.join(self.projdir,"build.json"),"r") as f:
+            scripts = json.load(f)
+        scripts["vbox-build"]  = [ { "op":"virtual-box-cargo-build","args":dict(op,vm="vm1") } ]
+        scripts["vbox-fanout"] = [ { "op":"virtual-box-cargo-build","args":dict(op,vms=[ "vm1","vm2" ]) } ]
+        with open(os.path.join(self.projdir,"build.json"),"w") as f:
+            json.dump(scripts,f)
+        with open(os.path.join(self.projdir,"env.json"),"w") as f:
+            json.dump({ "vboxmanage":VBOXMANAGE,"artifact-cache":None },f)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def build(self,*args):
+        """
+        コピーしたプロジェクトの build.py を実行し、トレースを返します。
+        
+        - `args` - build.py の引数
+        """
+        trace = os.path.join(self.tmpdir,"trace.jsonl")
+        env   = dict(os.environ)
+        env["FAKE_VBOX_ROOT"]       = self.vboxdir
+        env["FAKE_VBOX_BOOT_DELAY"] = "0.5"
+        for k in [ "MAKEFLAGS","CARGO_MAKEFLAGS","MFLAGS" ]:
+            env.pop(k,None)
+        
+        st = subprocess.run(
+            [ sys.executable,os.path.join(self.projdir,"build.py"),"--trace",trace,"-f" ] + list(args),
+            cwd=self.projdir,env=env,stdout=subprocess.PIPE,stderr=subprocess.STDOUT
+        )
+        self.assertEqual(st.returncode,0,st.stdout.decode("utf-8","replace"))
+        with open(trace,"r") as f:
+            return [ json.loads(l) for l in f ]
+    
+    def calls(self,command=None):
+        """
+        偽の VBoxManage の呼び出しを返します。
+        
+        - `command` - 絞り込むコマンド（run / copyto など）。None の場合はすべて
+        """
+        with open(os.path.join(self.vboxdir,"calls.jsonl"),"r") as f:
+            calls = [ json.loads(l) for l in f ]
+        os.remove(os.path.join(self.vboxdir,"calls.jsonl"))
+        return [ c for c in calls if command is None or c["command"] == command ]
+    
+    def guest_path(self,vm,path):
+        return os.path.join(self.vboxdir,vm,"tmp","build-py-project",path)
+    
+    def test_archive_sync_build_fetch(self):
+        with open(os.path.join(self.projdir,"notes.txt"),"w") as f:
+            f.write("to be deleted\n")
+        
+        records = self.build("vbox-build")
+        self.assertLess(10,records[0]["counters"]["files_sent"])
+        self.assertTrue(os.path.isfile(os.path.join(self.projdir,"vbox-out","target","release","libmaketemp.rlib")))
+        self.assertTrue(os.path.isfile(self.guest_path("vm1","notes.txt")))
+        # 起動を待ってからビルドし、プロジェクトは1回の copyto で送る
+        calls = self.calls()
+        self.assertEqual([ c["command"] for c in calls ][:3],[ "list","startvm","run" ])
+        self.assertEqual(1,len([ c for c in calls if c["command"] == "copyto" ]))
+        
+        # 2回目は、変更したファイルだけを送り、削除したファイルはゲストでも削除する
+        with open(os.path.join(self.projdir,"src","lib.rs"),"a") as f:
+            f.write("\n// changed\n")
+        os.remove(os.path.join(self.projdir,"notes.txt"))
+        
+        records = self.build("vbox-build")
+        self.assertEqual(1,records[0]["counters"]["files_sent"])
+        self.assertFalse(os.path.exists(self.guest_path("vm1","notes.txt")))
+        with open(self.guest_path("vm1","src/lib.rs"),"r") as f:
+            self.assertTrue(f.read().endswith("// changed\n"))
+        calls = self.calls()
+        self.assertEqual(0,len([ c for c in calls if c["command"] == "startvm" ]))
+        self.assertEqual(1,len([ c for c in calls if c["command"] == "copyto" ]))
+    
+    def test_fan_out_to_two_vms(self):
+        # トークンが1つでも、仮想マシンでのビルドはホストのトークンを待たずに並行して進む
+        self.build("--cpus","1","vbox-fanout")
+        
+        for vm in [ "vm1","vm2" ]:
+            self.assertTrue(os.path.isfile(os.path.join(self.projdir,"vbox-out",vm,"target","release","libmaketemp.rlib")),vm)
+            self.assertTrue(os.path.isfile(self.guest_path(vm,"build.py")),vm)
+        self.assertFalse(os.path.exists(os.path.join(self.projdir,"vbox-out","target")))
+        
+        calls = self.calls()
+        self.assertEqual(1,len([ c for c in calls if c["command"] == "list" ]))
+        self.assertEqual([ "vm1","vm2" ],sorted([ c["vm"] for c in calls if c["command"] == "startvm" ]))
+        
+        # 仮想マシンごとの最初の呼び出しから最後の呼び出しまでの期間が重なっていれば、並行して操作している
+        spans = {}
+        for c in calls:
+            if c["vm"] is not None:
+                s,e = spans.get(c["vm"],(c["start"],c["end"]))
+                spans[c["vm"]] = (min(s,c["start"]),max(e,c["end"]))
+        self.assertLess(max([ s for s,e in spans.values() ]),min([ e for s,e in spans.values() ]))
+    
+    def test_fetch_rejects_unsafe_members(self):
+        build = load_build_module()
+        
+        for name,kind in [ ("../escape","file"),("/tmp/escape","file"),("target/release/../../escape","file"),("target/release/link","symlink") ]:
+            archive = os.path.join(self.tmpdir,"build-py-release.tar.gz")
+            with tarfile.open(archive,"w:gz") as tar:
+                ti = tarfile.TarInfo(name)
+                if kind == "symlink":
+                    ti.type     = tarfile.SYMTYPE
+                    ti.linkname = "/etc/passwd"
+                    tar.addfile(ti)
+                else:
+                    ti.size = 4
+                    tar.addfile(ti,io.BytesIO(b"evil"))
+            
+            class Guest(object):
+                def shell(self,script):
+                    return 0
+                def copyfrom(self,guestdir,hostdir):
+                    shutil.copy2(archive,hostdir)
+            
+            hostdir = os.path.join(self.tmpdir,"out")
+            with self.assertRaises(Exception,msg=name):
+                build.fetch_release_from_guest(Guest(),"/tmp/build-py-project",hostdir)
+            self.assertFalse(os.path.exists(hostdir),name)
+            self.assertFalse(os.path.exists(os.path.join(self.tmpdir,"escape")),name)
+
+if __name__ == "__main__":
+    unittest.main()